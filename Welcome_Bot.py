@@ -1,20 +1,31 @@
 import os
 from dotenv import load_dotenv
 import asyncio
-from aiogram import Bot, Dispatcher, F
+from aiogram import BaseMiddleware, Bot, Dispatcher, F
 from aiogram.types import (
     Message,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     CallbackQuery,
-    ChatMemberUpdated
+    ChatMemberUpdated,
+    FSInputFile,
+    Update,
+    User
 )
 from aiogram.types import ChatPermissions
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 import logging
 import time
-from dataclasses import dataclass
+import re
+from dataclasses import dataclass, field
+from collections import OrderedDict, deque
+import heapq
+import itertools
 import signal
 from typing import cast
 import html
@@ -22,17 +33,94 @@ import html
 load_dotenv()
 
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='{"time":"%(asctime)s","level":"%(levelname)s","message":"%(message)s"}'
-)
+# ================== LOGGING (1.6.16) ==================
+# Records are JSON-encoded and written by a QueueListener thread; the event
+# loop only enqueues. log_event() fields become top-level JSON keys.
+# LOG_SAMPLE_RATES="JOIN_SOURCE=0.1,KEYWORD_TRIGGER=0.25" keeps only that
+# share of high-volume events (the kept ones carry sample_rate).
+import json
+import queue
+import random
+import atexit
+from logging.handlers import QueueHandler, QueueListener
+
+
+class JsonFormatter(logging.Formatter):
+    # record keys a log_event field must not overwrite
+    RESERVED_KEYS = frozenset({"time", "level", "message", "exc"})
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            for key, value in fields.items():
+                data[f"field_{key}" if key in self.RESERVED_KEYS else key] = value
+        if record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str, separators=(",", ":"))
+
+
+class _OffloopQueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # resolve args/traceback now (objects may change later); encode in the listener
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def _parse_sample_rates(raw: str) -> dict[str, float]:
+    rates = {}
+    for item in raw.split(","):
+        name, _, value = item.partition("=")
+        if not name.strip() or not value.strip():
+            continue
+        try:
+            rates[name.strip()] = min(max(float(value), 0.0), 1.0)
+        except ValueError:
+            pass
+    return rates
+
+
+def setup_logging() -> QueueListener:
+    stream = logging.StreamHandler()
+    stream.setFormatter(JsonFormatter())
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, stream, respect_handler_level=True)
+
+    root = logging.getLogger()
+    root.handlers.clear()
+    root.addHandler(_OffloopQueueHandler(log_queue))
+    root.setLevel(logging.INFO)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+LOG_LISTENER = setup_logging()
+LOG_SAMPLE_RATES = _parse_sample_rates(os.getenv("LOG_SAMPLE_RATES", ""))
+LOG_SAMPLED_OUT: dict[str, int] = {}
+
 
 # Structured logging helper
-def log_event(event: str, **fields):
+def log_event(event: str, level: int = logging.INFO, **fields):
     """
     Structured logging helper with correlation context support.
     If 'chat' and 'user' provided — builds correlation_id.
     """
+    rate = LOG_SAMPLE_RATES.get(event)
+    if rate is not None and rate < 1:
+        if random.random() >= rate:
+            LOG_SAMPLED_OUT[event] = LOG_SAMPLED_OUT.get(event, 0) + 1
+            return
+        fields["sample_rate"] = rate
+
     base = {"event": event}
 
     chat_id = fields.get("chat")
@@ -42,55 +130,40 @@ def log_event(event: str, **fields):
 
     base.update(fields)
 
-    parts = [f"{k}={v}" for k, v in base.items()]
-    logging.info(" | ".join(parts))
+    logging.log(level, event, extra={"fields": base})
 
 
 # ================== VERSION ==================
+# v1.6.23 — Online gzip registry backups (full + differential), retention, schedule, /registry_restore
+# v1.6.22 — JSONL registry snapshot + uid index, REGISTRY_LAZY_LOAD, time-to-first-update
+# v1.6.21 — REGISTRY_BACKEND=compact (array columns, label bitmask, uint32 time)
+# v1.6.20 — Incremental registry aggregates, /registry_stats <chat_id> | check
+# v1.6.19 — Streaming /export_registry (CSV/JSONL[.gz] document, filters)
+# v1.6.18 — TELEGRAM_API_URL, fake Bot API server for offline load/fault tests
+# v1.6.17 — Join span tracing (OTLP JSON file) and /trace_last
+# v1.6.16 — Off-loop JSON logging (QueueListener), log_event sampling
+# v1.6.15 — Prometheus /metrics (handler/API latency, queue, cache, registry)
+# v1.6.14 — Chat-sharded worker processes, SQLite lease leadership (replaces PID lock)
+# v1.6.13 — Webhook ingestion mode (UPDATE_MODE=webhook), polling backoff reset
+# v1.6.12 — Persistent welcome image file_id cache with re-upload fallback
+# v1.6.11 — Pre-rendered welcome templates/keyboards, /config_reload
+# v1.6.10 — Config-driven keyword trigger engine with a single precompiled matcher
+# v1.6.9 — Bounded LRU/TTL caches replace clear-on-overflow dedup dicts
+# v1.6.8 — Outbound Bot API rate limiter with priorities and RetryAfter retries
+# v1.6.7 — Concurrent join pipeline with per-chat ordering
+# v1.6.6 — Durable auto-delete queue (survives restarts)
+# v1.6.5 — Bulk auto-delete via deleteMessages, grouped per chat
+# v1.6.4 — Deadline-ordered auto-delete scheduler keyed by (chat_id, message_id)
+# v1.6.3 — Cached bot identity and per-chat permissions (my_chat_member aware)
+# v1.6.2 — Pluggable RegistryStore, SQLite backend with secondary indexes
+# v1.6.1 — Write-behind registry flusher, /registry_flush
+# v1.6.0 — Append-only registry journal with background compaction
 # v1.5.9.1000 — Async registry lock, mute logic hardening, registry mutation protection
-VERSION = "1.5.9.1000"
+VERSION = "1.6.23"
 # v1.5.2 — Source → Badge (UX)
 # Branch 1.5.x started
 # Goal: user context, source attribution, badges, persistence preparation
 
-# ================== 1.4.5 UX & FLOOD SAFETY ==================
-# Simple single-instance lock to avoid parallel polling
-LOCK_FILE = "/tmp/welcome_bot.lock"
-# =============================================================
-import errno
-
-def acquire_startup_lock() -> bool:
-    if os.path.exists(LOCK_FILE):
-        try:
-            with open(LOCK_FILE, "r") as f:
-                pid = int(f.read().strip())
-
-            # Проверяем, жив ли процесс
-            os.kill(pid, 0)
-            logging.error(
-                f"STARTUP | lock exists, process alive | pid={pid}"
-            )
-            return False
-
-        except ValueError:
-            logging.warning("STARTUP | invalid lock file, recreating")
-        except ProcessLookupError:
-            logging.warning("STARTUP | stale lock detected, recreating")
-        except PermissionError:
-            logging.error("STARTUP | no permission to check PID")
-            return False
-        except OSError as e:
-            if e.errno != errno.ESRCH:
-                logging.error(f"STARTUP | lock check failed | error={e}")
-                return False
-
-    try:
-        with open(LOCK_FILE, "w") as f:
-            f.write(str(os.getpid()))
-        return True
-    except Exception as e:
-        logging.error(f"STARTUP | failed to create lock | error={e}")
-        return False
 # ================== FEATURE FLAGS (1.3.x) ==================
 # ================== FEATURE FLAGS (1.3.x) ==================
 FEATURE_WELCOME_ENABLED = True
@@ -152,6 +225,7 @@ class Config:
     bot_token: str
     project_name: str
     storage_url: str
+    triggers_file: str
     auto_delete_seconds: int
     mute_new_users: bool
     mute_seconds: int
@@ -162,6 +236,34 @@ class Config:
     support_url: str | None
     bot_mode: str
     welcome_image_url: str | None
+    registry_flush_interval: float
+    registry_backend: str
+    registry_db_file: str
+    registry_lazy_load: bool
+    join_workers: int
+    rate_limit_global_per_second: float
+    rate_limit_group_per_minute: float
+    autodelete_persist: bool
+    autodelete_db_file: str
+    update_mode: str
+    webhook_url: str | None
+    webhook_path: str
+    webhook_host: str
+    webhook_port: int
+    webhook_secret: str | None
+    shard_workers: int
+    shared_state_db: str
+    lease_ttl_seconds: float
+    metrics_port: int
+    metrics_host: str
+    trace_file: str
+    trace_sample_rate: float
+    telegram_api_url: str | None
+    backup_dir: str
+    backup_full_interval_hours: float
+    backup_diff_interval_minutes: float
+    backup_keep_full: int
+    backup_keep_diff: int
 
 
 def _env_bool(key: str, default: bool) -> bool:
@@ -189,6 +291,11 @@ def load_config() -> Config:
     except ValueError:
         raise RuntimeError("WELCOME_DELAY_SECONDS должен быть числом")
 
+    try:
+        registry_flush_interval = float(os.getenv("REGISTRY_FLUSH_INTERVAL_SECONDS", "1"))
+    except ValueError:
+        raise RuntimeError("REGISTRY_FLUSH_INTERVAL_SECONDS должен быть числом")
+
     mute_new_users = _env_bool("MUTE_NEW_USERS", True)
 
     admin_ids: set[int] = set()
@@ -222,10 +329,77 @@ def load_config() -> Config:
 
     welcome_image_url = os.getenv("WELCOME_IMAGE_URL")
 
+    registry_backend = os.getenv("REGISTRY_BACKEND", "json").lower()
+    if registry_backend not in {"json", "compact", "sqlite"}:
+        raise RuntimeError("REGISTRY_BACKEND должен быть json, compact или sqlite")
+    registry_db_file = os.getenv("REGISTRY_DB_FILE", "user_registry.db")
+
+    try:
+        join_workers = max(int(os.getenv("JOIN_WORKERS", "8")), 1)
+    except ValueError:
+        raise RuntimeError("JOIN_WORKERS должен быть числом")
+
+    try:
+        rate_limit_global_per_second = float(os.getenv("RATE_LIMIT_GLOBAL_PER_SECOND", "30"))
+        rate_limit_group_per_minute = float(os.getenv("RATE_LIMIT_GROUP_PER_MINUTE", "20"))
+    except ValueError:
+        raise RuntimeError("RATE_LIMIT_GLOBAL_PER_SECOND и RATE_LIMIT_GROUP_PER_MINUTE должны быть числами")
+
+    update_mode = os.getenv("UPDATE_MODE", "polling").lower()
+    if update_mode not in {"polling", "webhook"}:
+        raise RuntimeError("UPDATE_MODE должен быть polling или webhook")
+
+    try:
+        webhook_port = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8080")))
+    except ValueError:
+        raise RuntimeError("WEBHOOK_PORT должен быть числом")
+
+    webhook_path = os.getenv("WEBHOOK_PATH", "/webhook")
+    if not webhook_path.startswith("/"):
+        webhook_path = "/" + webhook_path
+
+    webhook_secret = os.getenv("WEBHOOK_SECRET")
+    if update_mode == "webhook":
+        if not webhook_secret:
+            raise RuntimeError("WEBHOOK_SECRET обязателен в режиме webhook")
+        if not re.fullmatch(r"[A-Za-z0-9_-]{1,256}", webhook_secret):
+            raise RuntimeError("WEBHOOK_SECRET: только A-Z, a-z, 0-9, _ и -, до 256 символов")
+
+    try:
+        shard_workers = max(int(os.getenv("SHARD_WORKERS", "1")), 1)
+        lease_ttl_seconds = float(os.getenv("LEASE_TTL_SECONDS", "15"))
+    except ValueError:
+        raise RuntimeError("SHARD_WORKERS и LEASE_TTL_SECONDS должны быть числами")
+    try:
+        metrics_port = int(os.getenv("METRICS_PORT", "0"))
+    except ValueError:
+        raise RuntimeError("METRICS_PORT должен быть числом")
+
+    try:
+        trace_sample_rate = float(os.getenv("TRACE_SAMPLE_RATE", "1"))
+    except ValueError:
+        raise RuntimeError("TRACE_SAMPLE_RATE должен быть числом")
+
+    telegram_api_url = os.getenv("TELEGRAM_API_URL") or None
+    if telegram_api_url and not telegram_api_url.startswith(("http://", "https://")):
+        raise RuntimeError("TELEGRAM_API_URL должен начинаться с http:// или https://")
+
+    try:
+        backup_full_interval_hours = max(float(os.getenv("BACKUP_FULL_INTERVAL_HOURS", "24")), 0.0)
+        backup_diff_interval_minutes = max(float(os.getenv("BACKUP_DIFF_INTERVAL_MINUTES", "60")), 0.0)
+        backup_keep_full = max(int(os.getenv("BACKUP_KEEP_FULL", "7")), 1)
+        backup_keep_diff = max(int(os.getenv("BACKUP_KEEP_DIFF", "48")), 1)
+    except ValueError:
+        raise RuntimeError("BACKUP_* интервалы и лимиты хранения должны быть числами")
+
+    if shard_workers > 1 and registry_backend != "sqlite":
+        raise RuntimeError("SHARD_WORKERS > 1 требует REGISTRY_BACKEND=sqlite")
+
     return Config(
         bot_token=bot_token,
         project_name=project_name,
         storage_url=storage_url,
+        triggers_file=os.getenv("TRIGGERS_FILE", "triggers.json"),
         auto_delete_seconds=auto_delete_seconds,
         mute_new_users=mute_new_users,
         mute_seconds=mute_seconds,
@@ -236,33 +410,653 @@ def load_config() -> Config:
         support_url=support_url,
         bot_mode=bot_mode,
         welcome_image_url=welcome_image_url,
+        registry_flush_interval=registry_flush_interval,
+        registry_backend=registry_backend,
+        registry_db_file=registry_db_file,
+        registry_lazy_load=_env_bool("REGISTRY_LAZY_LOAD", False),
+        join_workers=join_workers,
+        rate_limit_global_per_second=rate_limit_global_per_second,
+        rate_limit_group_per_minute=rate_limit_group_per_minute,
+        autodelete_persist=_env_bool("AUTODELETE_PERSIST", True),
+        autodelete_db_file=os.getenv("AUTODELETE_DB_FILE", "autodelete_queue.db"),
+        update_mode=update_mode,
+        webhook_url=os.getenv("WEBHOOK_URL"),
+        webhook_path=webhook_path,
+        webhook_host=os.getenv("WEBHOOK_HOST", "0.0.0.0"),
+        webhook_port=webhook_port,
+        webhook_secret=webhook_secret,
+        shard_workers=shard_workers,
+        shared_state_db=os.getenv("SHARED_STATE_DB", "welcome_bot_state.db"),
+        lease_ttl_seconds=lease_ttl_seconds,
+        metrics_port=metrics_port,
+        metrics_host=os.getenv("METRICS_HOST", "127.0.0.1"),
+        trace_file=os.getenv("TRACE_FILE", "join_traces.otlp.jsonl"),
+        trace_sample_rate=trace_sample_rate,
+        telegram_api_url=telegram_api_url,
+        backup_dir=os.getenv("BACKUP_DIR", "backups"),
+        backup_full_interval_hours=backup_full_interval_hours,
+        backup_diff_interval_minutes=backup_diff_interval_minutes,
+        backup_keep_full=backup_keep_full,
+        backup_keep_diff=backup_keep_diff,
     )
 # ================================================
 
 CFG = load_config()
 
+# TELEGRAM_API_URL points the bot at another Bot API server
+# (self-hosted telegram-bot-api or fake_telegram_api.py for load tests)
 bot = Bot(
     token=CFG.bot_token,
+    session=AiohttpSession(
+        api=TelegramAPIServer.from_base(CFG.telegram_api_url)
+    ) if CFG.telegram_api_url else None,
     default=DefaultBotProperties(parse_mode=ParseMode.HTML)
 )
 dp = Dispatcher()
 
+# ================== EXPIRING CACHE (1.6.9) ==================
+# Insertion-ordered dict with a per-cache TTL and a hard size cap.
+# Re-setting a key moves it to the end, so the front is always the oldest
+# entry: expiry sweeps and overflow eviction only ever touch the head
+# instead of scanning (or clearing) the whole cache.
+class ExpiringCache:
+    def __init__(self, name: str, ttl: float, maxsize: int):
+        self.name = name
+        self.ttl = ttl
+        self.maxsize = maxsize
+        # key -> (value, stored_at monotonic)
+        self._data: OrderedDict = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "evicted": 0, "expired": 0}
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key) -> bool:
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            self.stats["misses"] += 1
+            return default
+        value, stored_at = item
+        if time.monotonic() - stored_at > self.ttl:
+            del self._data[key]
+            self.stats["expired"] += 1
+            self.stats["misses"] += 1
+            return default
+        self.stats["hits"] += 1
+        return value
+
+    def __setitem__(self, key, value):
+        self._data[key] = (value, time.monotonic())
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.stats["evicted"] += 1
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def items(self):
+        """Stored (key, value) pairs, oldest first; expired ones included."""
+        return ((key, value) for key, (value, _) in self._data.items())
+
+    def sweep(self, limit: int = 10_000) -> int:
+        """Drop expired entries from the head; stops at the first live one."""
+        deadline = time.monotonic() - self.ttl
+        removed = 0
+        while self._data and removed < limit:
+            key, (_, stored_at) = next(iter(self._data.items()))
+            if stored_at >= deadline:
+                break
+            del self._data[key]
+            removed += 1
+        self.stats["expired"] += removed
+        return removed
+
+    def describe(self) -> str:
+        return (
+            f"{self.name}: {len(self._data)}/{self.maxsize} "
+            f"(hit {self.stats['hits']}, miss {self.stats['misses']}, "
+            f"evicted {self.stats['evicted']})"
+        )
+
+
+# ================== OUTBOUND RATE LIMITER (1.6.8) ==================
+# Session middleware in front of every Bot API call: a global token bucket
+# (~30 req/s) plus per-chat buckets for message sends (~20/min in groups,
+# 1/s in private chats). Waiting calls are granted by priority
+# (mute > welcome/other > delete); RetryAfter blocks the affected bucket
+# and the call is queued again instead of being dropped.
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self, now: float) -> float:
+        """Seconds until one token is available (0 if available now)."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def resize(self, rate: float, capacity: float):
+        """Change the rate in place; spent tokens and RetryAfter blocks carry over."""
+        self.delay(time.monotonic())
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = min(self.tokens, capacity)
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class BotApiRateLimiter(BaseRequestMiddleware):
+    PRIORITY_MUTE = 0
+    PRIORITY_DEFAULT = 1
+    PRIORITY_DELETE = 2
+    METHOD_PRIORITY = {
+        "restrictChatMember": PRIORITY_MUTE,
+        "deleteMessage": PRIORITY_DELETE,
+        "deleteMessages": PRIORITY_DELETE,
+    }
+    # only message sends count against the per-chat budget
+    CHAT_LIMITED_METHODS = {
+        "sendMessage",
+        "sendPhoto",
+        "sendDocument",
+        "sendAnimation",
+        "sendVideo",
+        "copyMessage",
+        "forwardMessage",
+    }
+    PRIVATE_CHAT_PER_SECOND = 1.0
+    CHAT_BUCKET_TTL = 60
+    CHAT_BUCKETS_MAX = 100_000
+    MAX_RETRIES = 5
+
+    def __init__(self, global_per_second: float, group_per_minute: float):
+        self.global_bucket = TokenBucket(global_per_second, global_per_second)
+        self.group_per_minute = group_per_minute
+        # an idle bucket refills within seconds, so after CHAT_BUCKET_TTL it is
+        # indistinguishable from a fresh one and can be dropped
+        self.chat_buckets = ExpiringCache("chat_buckets", self.CHAT_BUCKET_TTL, self.CHAT_BUCKETS_MAX)
+        # RetryAfter on a chat-scoped call pauses only that chat (any method)
+        self.chat_blocked_until: dict[int, float] = {}
+        # per priority: one FIFO lane per (limited chat | None, scope chat | None)
+        # and a heap of (ready_at, seq, lane key) with one entry per lane, so a
+        # dispatch step only looks at lanes whose budget is due
+        self._lanes: list[dict[tuple, deque[asyncio.Future]]] = [{}, {}, {}]
+        self._heaps: list[list[tuple[float, int, tuple]]] = [[], [], []]
+        self._seq = itertools.count()
+        self._queued = 0
+        self._wakeup = asyncio.Event()
+        self._dispatcher: asyncio.Task | None = None
+        self.stats = {
+            "calls": 0,
+            "throttled": 0,
+            "retry_after": 0,
+            "retried": 0,
+            "dropped": 0,
+        }
+
+    def _group_rate(self) -> tuple[float, float]:
+        return self.group_per_minute / 60, max(self.group_per_minute / 20, 1)
+
+    def _chat_bucket(self, chat_id: int | None) -> TokenBucket | None:
+        if chat_id is None:
+            return None
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if chat_id < 0:
+                bucket = TokenBucket(*self._group_rate())
+            else:
+                bucket = TokenBucket(self.PRIVATE_CHAT_PER_SECOND, 1)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def reconfigure(self, global_per_second: float, group_per_minute: float):
+        """Apply new limits to the live buckets (/config_reload)."""
+        self.global_bucket.resize(global_per_second, global_per_second)
+        self.group_per_minute = group_per_minute
+        for chat_id, bucket in self.chat_buckets.items():
+            if chat_id < 0:
+                bucket.resize(*self._group_rate())
+        # queued lanes were scheduled at the old rates: re-check them all now
+        now = time.monotonic()
+        for heap in self._heaps:
+            heap[:] = [(now, seq, key) for _, seq, key in heap]
+            heapq.heapify(heap)
+        self._wakeup.set()
+
+    def _lane_delay(self, key: tuple, now: float) -> float:
+        """Per-chat part of the budget: chat bucket and chat RetryAfter block."""
+        chat_id, scope = key
+        delay = 0.0
+        bucket = self._chat_bucket(chat_id)
+        if bucket:
+            delay = bucket.delay(now)
+        if scope is not None:
+            delay = max(delay, self.chat_blocked_until.get(scope, 0.0) - now)
+        return delay
+
+    def _ready_delay(self, chat_id: int | None, scope: int | None, now: float) -> float:
+        return max(self.global_bucket.delay(now), self._lane_delay((chat_id, scope), now))
+
+    def _block_chat(self, scope: int, seconds: float):
+        now = time.monotonic()
+        if len(self.chat_blocked_until) > 10_000:
+            self.chat_blocked_until = {
+                chat: until for chat, until in self.chat_blocked_until.items() if until > now
+            }
+        self.chat_blocked_until[scope] = max(self.chat_blocked_until.get(scope, 0.0), now + seconds)
+
+    def _grant(self, chat_id: int | None):
+        self.global_bucket.take()
+        bucket = self._chat_bucket(chat_id)
+        if bucket:
+            bucket.take()
+            # refresh the TTL: a drained bucket must outlive its refill time
+            self.chat_buckets[chat_id] = bucket
+
+    async def acquire(self, chat_id: int | None, priority: int, scope: int | None = None):
+        # fast path: nothing queued and budget available
+        if not self._queued and self._ready_delay(chat_id, scope, time.monotonic()) <= 0:
+            self._grant(chat_id)
+            return
+
+        self.stats["throttled"] += 1
+        fut = asyncio.get_running_loop().create_future()
+        key = (chat_id, scope)
+        lanes = self._lanes[priority]
+        lane = lanes.get(key)
+        if lane is None:
+            lane = lanes[key] = deque()
+            heapq.heappush(self._heaps[priority], (time.monotonic(), next(self._seq), key))
+        lane.append(fut)
+        self._queued += 1
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        self._wakeup.set()
+        await fut
+
+    def _grant_next(self, priority: int, now: float) -> bool:
+        """Grant the first due waiter of this priority; False if none is due."""
+        lanes = self._lanes[priority]
+        heap = self._heaps[priority]
+        while heap and heap[0][0] <= now:
+            _, _, key = heapq.heappop(heap)
+            lane = lanes[key]
+            while lane and lane[0].done():
+                lane.popleft()
+                self._queued -= 1
+            if not lane:
+                del lanes[key]
+                continue
+            delay = self._lane_delay(key, now)
+            if delay > 0:
+                heapq.heappush(heap, (now + delay, next(self._seq), key))
+                continue
+            self._grant(key[0])
+            lane.popleft().set_result(None)
+            self._queued -= 1
+            if lane:
+                heapq.heappush(heap, (now + self._lane_delay(key, now), next(self._seq), key))
+            else:
+                del lanes[key]
+            return True
+        return False
+
+    async def _dispatch(self):
+        while self._queued:
+            now = time.monotonic()
+            next_wait = self.global_bucket.delay(now)
+            if next_wait <= 0:
+                if any(self._grant_next(priority, now) for priority in range(len(self._heaps))):
+                    continue
+                due = [heap[0][0] for heap in self._heaps if heap]
+                next_wait = max(min(due) - now, 0.0) if due else None
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), next_wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def _limited_chat(self, api_method: str, method) -> int | None:
+        if api_method not in self.CHAT_LIMITED_METHODS:
+            return None
+        return self._scope_chat(method)
+
+    @staticmethod
+    def _scope_chat(method) -> int | None:
+        chat_id = getattr(method, "chat_id", None)
+        return chat_id if isinstance(chat_id, int) else None
+
+    async def __call__(self, make_request, bot, method):
+        api_method = method.__api_method__
+        priority = self.METHOD_PRIORITY.get(api_method, self.PRIORITY_DEFAULT)
+        chat_id = self._limited_chat(api_method, method)
+        scope = self._scope_chat(method)
+
+        for attempt in range(self.MAX_RETRIES + 1):
+            await self.acquire(chat_id, priority, scope)
+            self.stats["calls"] += 1
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.stats["retry_after"] += 1
+                if scope is not None:
+                    # one flood-waited chat must not stall the other chats
+                    self._block_chat(scope, e.retry_after)
+                else:
+                    self.global_bucket.block(e.retry_after)
+                if attempt == self.MAX_RETRIES:
+                    self.stats["dropped"] += 1
+                    raise
+                self.stats["retried"] += 1
+                logging.warning(
+                    f"RATE_LIMIT | retry_after={e.retry_after}s | method={api_method} | "
+                    f"chat={chat_id} | attempt={attempt + 1}"
+                )
+
+
+BOT_API_LIMITER = BotApiRateLimiter(
+    global_per_second=CFG.rate_limit_global_per_second,
+    group_per_minute=CFG.rate_limit_group_per_minute,
+)
+bot.session.middleware(BOT_API_LIMITER)
+
+
+def configure_rate_limiter():
+    """Push CFG rate limits into BOT_API_LIMITER (shard start, /config_reload)."""
+    rate = CFG.rate_limit_global_per_second
+    if SHARD_INDEX is not None:
+        # the global API budget is shared by all workers
+        rate /= CFG.shard_workers
+    BOT_API_LIMITER.reconfigure(rate, CFG.rate_limit_group_per_minute)
+
+# ================== METRICS (1.6.15) ==================
+# Minimal Prometheus text exposition without extra dependencies.
+# Counters/histograms are updated inline; gauges (queue depth, cache
+# sizes, registry size) are read from live state at scrape time.
+METRICS_DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _metric_labels(names: tuple[str, ...], values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_metric_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = METRICS_DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # labels -> [per-bucket counts (+Inf last), sum, count]
+        self._series: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        names = self.labelnames + ("le",)
+        for labels, (counts, total, count) in self._series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_metric_labels(names, labels + (le,))} {cumulative}")
+            suffix = _metric_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{suffix} {total}")
+            lines.append(f"{self.name}_count{suffix} {count}")
+        return lines
+
+
+def _samples(
+    name: str,
+    help_text: str,
+    samples: list[tuple[tuple[str, ...], tuple, float]],
+    kind: str = "gauge",
+) -> list[str]:
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+    for labelnames, labels, value in samples:
+        lines.append(f"{name}{_metric_labels(labelnames, labels)} {value}")
+    return lines
+
+
+HANDLER_LATENCY = Histogram(
+    "welcome_bot_handler_seconds", "Handler execution time", ("handler",)
+)
+HANDLER_ERRORS = Counter(
+    "welcome_bot_handler_errors_total", "Handler exceptions", ("handler", "error")
+)
+API_CALLS = Counter(
+    "welcome_bot_api_calls_total", "Bot API requests", ("method", "status")
+)
+API_LATENCY = Histogram(
+    "welcome_bot_api_request_seconds", "Bot API request latency", ("method",)
+)
+API_ERRORS = Counter(
+    "welcome_bot_api_errors_total", "Bot API errors", ("method", "error")
+)
+REGISTRY_SAVE_SECONDS = Histogram(
+    "welcome_bot_registry_save_seconds", "Registry flush/compaction duration", ("op",)
+)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Inner middleware: times the handler that actually matched."""
+
+    async def __call__(self, handler, event, data):
+        handler_obj = data.get("handler")
+        name = getattr(getattr(handler_obj, "callback", None), "__name__", "unknown")
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            HANDLER_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started, name)
+
+
+class FirstUpdateMiddleware(BaseMiddleware):
+    """Outer update middleware: logs time-to-first-update once per process."""
+
+    def __init__(self):
+        self.seen = False
+
+    async def __call__(self, handler, event, data):
+        if not self.seen:
+            self.seen = True
+            log_event(
+                "FIRST_UPDATE",
+                ms_since_start=int((time.time() - START_TIME) * 1000),
+                registry_loading=REGISTRY_LAZY is not None,
+                registry_users=len(USER_REGISTRY),
+            )
+        return await handler(event, data)
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Registered after the rate limiter, so it times each real HTTP attempt."""
+
+    async def __call__(self, make_request, bot, method):
+        api_method = method.__api_method__
+        started = time.perf_counter()
+        try:
+            result = await make_request(bot, method)
+        except Exception as e:
+            API_CALLS.inc(api_method, "error")
+            API_ERRORS.inc(api_method, type(e).__name__)
+            raise
+        finally:
+            API_LATENCY.observe(time.perf_counter() - started, api_method)
+        API_CALLS.inc(api_method, "ok")
+        return result
+
+
+bot.session.middleware(ApiMetricsMiddleware())
+dp.update.outer_middleware(FirstUpdateMiddleware())
+for _observer in (dp.message, dp.callback_query, dp.chat_member, dp.my_chat_member):
+    _observer.middleware(HandlerMetricsMiddleware())
+
+
+def render_metrics(registry_users: int | None = None) -> str:
+    lines: list[str] = []
+    for metric in (HANDLER_LATENCY, HANDLER_ERRORS, API_CALLS, API_LATENCY, API_ERRORS, REGISTRY_SAVE_SECONDS):
+        lines += metric.render()
+
+    lines += _samples(
+        "welcome_bot_autodelete_pending", "Messages waiting for auto-delete",
+        [(("type",), (msg_type,), count) for msg_type, count in BOT_MESSAGES_TYPES.items()],
+    )
+    lines += _samples(
+        "welcome_bot_autodelete_total", "Auto-delete outcomes and API usage",
+        [(("result",), (key,), value) for key, value in AUTODELETE_STATS.items()],
+        "counter",
+    )
+    lines += _samples(
+        "welcome_bot_rate_limiter_total", "Outbound rate limiter counters",
+        [(("event",), (key,), value) for key, value in BOT_API_LIMITER.stats.items()],
+        "counter",
+    )
+
+    caches = (WELCOME_CACHE, RULES_CACHE, KEYWORD_TRIGGER_CACHE, GLOBAL_RATE_LIMIT, BOT_API_LIMITER.chat_buckets)
+    lines += _samples(
+        "welcome_bot_cache_entries", "Cache size",
+        [(("cache",), (c.name,), len(c)) for c in caches],
+    )
+    lines += _samples(
+        "welcome_bot_cache_events_total", "Cache hits/misses/evictions",
+        [(("cache", "event"), (c.name, key), value) for c in caches for key, value in c.stats.items()],
+        "counter",
+    )
+    lines += _samples(
+        "welcome_bot_cache_hit_ratio", "Cache hit ratio",
+        [
+            (("cache",), (c.name,), c.stats["hits"] / max(c.stats["hits"] + c.stats["misses"], 1))
+            for c in caches
+        ],
+    )
+
+    if registry_users is not None:
+        lines += _samples("welcome_bot_registry_users", "Users in the registry", [((), (), registry_users)])
+    lines += _samples(
+        "welcome_bot_registry_pending_writes", "Registry writes not yet flushed",
+        [((), (), REGISTRY_STORE.pending())],
+    )
+    lines += _samples(
+        "welcome_bot_join_queue_depth", "Queued welcomes",
+        [((), (), sum(len(q) for q in JOIN_QUEUES.values()))],
+    )
+    if LOG_SAMPLED_OUT:
+        lines += _samples(
+            "welcome_bot_log_sampled_out_total", "Log events dropped by sampling",
+            [(("event",), (event,), count) for event, count in LOG_SAMPLED_OUT.items()],
+            "counter",
+        )
+    if SHARD_ROUTED:
+        lines += _samples(
+            "welcome_bot_shard_routed_total", "Updates routed to each shard",
+            [(("shard",), (shard,), count) for shard, count in SHARD_ROUTED.items()],
+            "counter",
+        )
+    return "\n".join(lines) + "\n"
+
+
+async def run_metrics_server(port: int):
+    from aiohttp import web
+
+    async def metrics_handler(request):
+        registry_users = None
+        if CFG.shard_workers == 1 or SHARD_INDEX is not None:
+            # COUNT(*) may touch disk with the sqlite backend — keep it off the loop
+            registry_users = await asyncio.to_thread(REGISTRY_STORE.count)
+        return web.Response(
+            text=render_metrics(registry_users),
+            content_type="text/plain",
+            charset="utf-8",
+        )
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host=CFG.metrics_host, port=port).start()
+    logging.info(f"METRICS | listening | host={CFG.metrics_host} | port={port}")
+    try:
+        await shutdown_event.wait()
+    finally:
+        await runner.cleanup()
+
 # ===== Unified UX timing for admin/test UX messages =====
 UX_TTL_SECONDS = 60
 
+CACHE_SWEEP_INTERVAL_SECONDS = 30
+
 # ================== RUNTIME STATE ==================
-# user_id -> last_welcome_timestamp
-WELCOME_CACHE: dict[int, float] = {}
 WELCOME_CACHE_MAX = 10_000
 WELCOME_TTL_SECONDS = 300  # 5 минут защита от повторного welcome
+# user_id -> last_welcome_timestamp
+WELCOME_CACHE = ExpiringCache("welcome", WELCOME_TTL_SECONDS, WELCOME_CACHE_MAX)
 
-# user_id -> last_rules_timestamp
-RULES_CACHE: dict[int, float] = {}
 RULES_CACHE_MAX = 10_000
 RULES_TTL_SECONDS = 300  # 5 минут антиспам для правил
+# user_id -> last_rules_timestamp
+RULES_CACHE = ExpiringCache("rules", RULES_TTL_SECONDS, RULES_CACHE_MAX)
 # ================================================
 
-from typing import TypedDict, Set
+from typing import TypedDict, Set, Iterator
 
 # ================== USER REGISTRY (1.5.0 foundation) ==================
 REGISTRY_READ_ONLY = True  # v1.5.4 — protect existing records from modification
@@ -288,10 +1082,151 @@ SOURCE_BADGES = {
     JoinSource.REQUEST: "📝 Join request",
 }
 
+# ================== COMPACT REGISTRY (1.6.21) ==================
+# REGISTRY_BACKEND=compact: same snapshot + journal files as json, but the
+# records live in parallel array columns instead of one dict + set per user
+# (~590 → ~130 bytes/user, bench_welcome_bot.py --scenarios registry).
+# Sources are interned to uint16 codes, labels are a 64-bit mask over a
+# label dictionary (rare extra labels spill into a dict), first_seen is
+# stored as uint32 seconds.
+from array import array
+
+
+class CompactRegistry:
+    """Mapping-like uid → UserRegistryItem. get() decodes a fresh dict: write back to mutate."""
+
+    MASK_LABELS = 64
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._rows: dict[int, int] = {}
+        self._source = array("H")
+        self._first_seen = array("I")
+        self._chat_id = array("q")
+        self._labels = array("Q")
+        self._extra_labels: dict[int, set[str]] = {}
+        self._source_names: list[str] = []
+        self._source_codes: dict[str, int] = {}
+        self._label_names: list[str] = []
+        self._label_bits: dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, uid) -> bool:
+        return uid in self._rows
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._rows)
+
+    def _source_code(self, source: str) -> int:
+        code = self._source_codes.get(source)
+        if code is None:
+            code = self._source_codes[source] = len(self._source_names)
+            self._source_names.append(source)
+        return code
+
+    def _label_bit(self, label: str) -> int | None:
+        bit = self._label_bits.get(label)
+        if bit is None and len(self._label_names) < self.MASK_LABELS:
+            bit = self._label_bits[label] = len(self._label_names)
+            self._label_names.append(label)
+        return bit
+
+    def __setitem__(self, uid: int, item: UserRegistryItem):
+        mask, extra = 0, set()
+        for label in item["labels"]:
+            bit = self._label_bit(label)
+            if bit is None:
+                extra.add(label)
+            else:
+                mask |= 1 << bit
+
+        source = self._source_code(item["source"])
+        first_seen = min(max(int(item["first_seen"]), 0), 0xFFFFFFFF)
+        row = self._rows.get(uid)
+        if row is None:
+            row = len(self._source)
+            self._source.append(source)
+            self._first_seen.append(first_seen)
+            self._chat_id.append(item["chat_id"])
+            self._labels.append(mask)
+            self._rows[uid] = row
+        else:
+            self._source[row] = source
+            self._first_seen[row] = first_seen
+            self._chat_id[row] = item["chat_id"]
+            self._labels[row] = mask
+        if extra:
+            self._extra_labels[row] = extra
+        else:
+            self._extra_labels.pop(row, None)
+
+    def _decode(self, row: int) -> UserRegistryItem:
+        mask = self._labels[row]
+        labels = {name for bit, name in enumerate(self._label_names) if mask >> bit & 1}
+        extra = self._extra_labels.get(row)
+        if extra:
+            labels |= extra
+        return {
+            "source": self._source_names[self._source[row]],
+            "labels": labels,
+            "first_seen": float(self._first_seen[row]),
+            "chat_id": self._chat_id[row],
+        }
+
+    def get(self, uid: int, default=None) -> UserRegistryItem | None:
+        row = self._rows.get(uid)
+        return default if row is None else self._decode(row)
+
+    def has_label(self, uid: int, label: str) -> bool:
+        row = self._rows.get(uid)
+        if row is None:
+            return False
+        bit = self._label_bits.get(label)
+        if bit is not None:
+            return bool(self._labels[row] >> bit & 1)
+        return label in self._extra_labels.get(row, ())
+
+    def copy(self) -> "CompactRegistry":
+        """Detached copy: the columns are memcpy'd, cheap enough for the event loop."""
+        other = CompactRegistry.__new__(CompactRegistry)
+        other._rows = self._rows.copy()
+        other._source = self._source[:]
+        other._first_seen = self._first_seen[:]
+        other._chat_id = self._chat_id[:]
+        other._labels = self._labels[:]
+        # extra label sets are replaced on write, never mutated in place
+        other._extra_labels = self._extra_labels.copy()
+        other._source_names = self._source_names[:]
+        other._source_codes = self._source_codes.copy()
+        other._label_names = self._label_names[:]
+        other._label_bits = self._label_bits.copy()
+        return other
+
+    def items(self) -> Iterator[tuple[int, UserRegistryItem]]:
+        for uid, row in self._rows.items():
+            yield uid, self._decode(row)
+
+    def values(self) -> Iterator[UserRegistryItem]:
+        for row in self._rows.values():
+            yield self._decode(row)
+
+
 # ================== USER REGISTRY STORAGE (1.5.3) ==================
-USER_REGISTRY: dict[int, UserRegistryItem] = {}
-USER_REGISTRY_FILE = "user_registry.json"
+USER_REGISTRY: dict[int, UserRegistryItem] | CompactRegistry = (
+    CompactRegistry() if CFG.registry_backend == "compact" else {}
+)
+# v1.6.22 — JSONL snapshot: header line + one user per line (streamed load)
+USER_REGISTRY_FILE = "user_registry.jsonl"
+USER_REGISTRY_LEGACY_FILE = "user_registry.json"  # pre-1.6.22 single document, migrated once
 import threading
+import bisect
+import sqlite3
+import mmap
+import struct
 REGISTRY_FILE_LOCK = threading.Lock()
 # Async registry lock for protecting registry mutations
 REGISTRY_ASYNC_LOCK = asyncio.Lock()
@@ -305,129 +1240,1390 @@ def log_registry_mutation(admin_id: int, user_id: int, action: str, details: str
         f"REGISTRY_MUTATION | admin={admin_id} | user={user_id} | action={action} | {details}"
     )
 
-def save_user_registry():
+# ================== USER REGISTRY JOURNAL (1.6.0) ==================
+# Every mutation is appended as one JSON line to the journal instead of
+# rewriting the whole snapshot. The snapshot is rebuilt in the background
+# once enough journal records have accumulated (compaction).
+#   {"seq": 1, "op": "insert", "uid": 1, "source": "...", "labels": [...], "first_seen": 0.0, "chat_id": 0}
+#   {"seq": 2, "op": "source", "uid": 1, "source": "..."}
+#   {"seq": 3, "op": "label_add" | "label_remove", "uid": 1, "label": "..."}
+REGISTRY_JOURNAL_FILE = "user_registry.journal"
+REGISTRY_JOURNAL_SEQ_KEY = "_journal_seq"
+REGISTRY_COMPACT_THRESHOLD = 10_000  # journal records before background compaction
+REGISTRY_COMPACT_INTERVAL_SECONDS = 60
+# last sequence number handed out / covered by the snapshot on disk
+REGISTRY_JOURNAL_SEQ = 0
+REGISTRY_SNAPSHOT_SEQ = 0
+# journal records appended since the last compaction started
+REGISTRY_JOURNAL_RECORDS = 0
+# serializes snapshot writers (background compaction vs shutdown save)
+REGISTRY_SNAPSHOT_LOCK = threading.Lock()
+
+# --- v1.6.1: write-behind journal flushing ---
+# Appends only buffer (seq, line) in memory; registry_flusher() writes and
+# fsyncs them from a worker thread at most once per CFG.registry_flush_interval.
+REGISTRY_JOURNAL_PENDING: list[tuple[int, str]] = []
+# last seq that reached the current journal file
+REGISTRY_JOURNAL_WRITTEN_SEQ = 0
+# serializes journal file I/O (flusher vs compaction rotation)
+REGISTRY_JOURNAL_IO_LOCK = threading.Lock()
+REGISTRY_DIRTY = asyncio.Event()
+
+
+def _registry_journal_append(record: dict):
+    global REGISTRY_JOURNAL_SEQ, REGISTRY_JOURNAL_RECORDS
+    with REGISTRY_FILE_LOCK:
+        REGISTRY_JOURNAL_SEQ += 1
+        record = {"seq": REGISTRY_JOURNAL_SEQ, **record}
+        REGISTRY_JOURNAL_PENDING.append(
+            (REGISTRY_JOURNAL_SEQ, json.dumps(record, ensure_ascii=False, separators=(",", ":")))
+        )
+        REGISTRY_JOURNAL_RECORDS += 1
+    REGISTRY_DIRTY.set()
+
+
+def _flush_registry_journal_locked() -> int:
+    """Write pending journal records. Caller must hold REGISTRY_JOURNAL_IO_LOCK."""
+    global REGISTRY_JOURNAL_PENDING, REGISTRY_JOURNAL_WRITTEN_SEQ
+    with REGISTRY_FILE_LOCK:
+        batch = REGISTRY_JOURNAL_PENDING
+        REGISTRY_JOURNAL_PENDING = []
+    if not batch:
+        return 0
+
+    try:
+        with open(REGISTRY_JOURNAL_FILE, "a", encoding="utf-8") as f:
+            f.write("".join(line + "\n" for _, line in batch))
+            f.flush()
+            os.fsync(f.fileno())
+    except Exception:
+        # keep the records for the next attempt, preserving order
+        with REGISTRY_FILE_LOCK:
+            REGISTRY_JOURNAL_PENDING[:0] = batch
+        raise
+
+    REGISTRY_JOURNAL_WRITTEN_SEQ = batch[-1][0]
+    return len(batch)
+
+
+def flush_user_registry() -> int:
+    """Durably write all buffered journal records. Safe to run in a worker thread."""
+    with REGISTRY_JOURNAL_IO_LOCK:
+        try:
+            return _flush_registry_journal_locked()
+        except Exception as e:
+            logging.error(f"REGISTRY | journal flush failed | error={e}")
+            return 0
+
+
+def _apply_registry_journal_record(record: dict):
+    op = record.get("op")
+    uid = int(record["uid"])
+
+    if op == "insert":
+        USER_REGISTRY[uid] = {
+            "source": record.get("source", JoinSource.TELEGRAM),
+            "labels": set(record.get("labels", [])),
+            "first_seen": float(record.get("first_seen", time.time())),
+            "chat_id": int(record.get("chat_id", 0)),
+        }
+        return
+
+    item = USER_REGISTRY.get(uid)
+    if not item:
+        if REGISTRY_LAZY is not None and REGISTRY_LAZY.index.offset(uid) is not None:
+            # snapshot row not loaded yet — apply when it is
+            REGISTRY_LAZY.deferred.setdefault(uid, []).append(record)
+        return
+    _apply_registry_update(item, record)
+    # no-op for dicts; CompactRegistry.get() returns a decoded copy
+    USER_REGISTRY[uid] = item
+
+
+def _apply_registry_update(item: UserRegistryItem, record: dict):
+    op = record.get("op")
+    if op == "source":
+        item["source"] = record["source"]
+    elif op == "label_add":
+        item["labels"].add(record["label"])
+    elif op == "label_remove":
+        item["labels"].discard(record["label"])
+
+
+def _journal_segments() -> list[tuple[int, str]]:
+    """Rotated journal segments as (last_seq, path), oldest first."""
+    dir_name = os.path.dirname(os.path.abspath(REGISTRY_JOURNAL_FILE)) or "."
+    prefix = os.path.basename(REGISTRY_JOURNAL_FILE) + "."
+    segments = []
+    for name in os.listdir(dir_name):
+        if not name.startswith(prefix):
+            continue
+        try:
+            segments.append((int(name[len(prefix):]), os.path.join(dir_name, name)))
+        except ValueError:
+            continue
+    return sorted(segments)
+
+
+def _capture_registry_rows(registry=None) -> list[tuple]:
+    """(uid, source, labels, first_seen, chat_id) rows of USER_REGISTRY (event loop side)."""
+    registry = USER_REGISTRY if registry is None else registry
+    return [
+        (uid, info["source"], list(info["labels"]), info["first_seen"], info["chat_id"])
+        for uid, info in registry.items()
+    ]
+
+
+def _begin_registry_compaction() -> tuple[list, int]:
+    """
+    Capture a consistent snapshot of the registry (event loop side).
+    Everything up to the returned seq is contained in the snapshot data.
+    """
+    global REGISTRY_JOURNAL_RECORDS
     with REGISTRY_FILE_LOCK:
+        seq = REGISTRY_JOURNAL_SEQ
+        REGISTRY_JOURNAL_RECORDS = 0
+        users = _capture_registry_rows()
+    return users, seq
+
+
+def _finish_registry_compaction(users: dict, seq: int) -> bool:
+    """
+    Rotate the journal, write the snapshot atomically and drop journal
+    segments fully covered by it. Safe to run in a worker thread.
+    Returns False when the snapshot could not be written.
+    """
+    global REGISTRY_SNAPSHOT_SEQ
+    import tempfile
+
+    with REGISTRY_SNAPSHOT_LOCK:
+        if seq < REGISTRY_SNAPSHOT_SEQ:
+            # a newer snapshot was already written (e.g. by shutdown save)
+            return True
+
         try:
-            import json
-            import tempfile
-            import os
+            with REGISTRY_JOURNAL_IO_LOCK:
+                _flush_registry_journal_locked()
+                if os.path.exists(REGISTRY_JOURNAL_FILE):
+                    os.replace(
+                        REGISTRY_JOURNAL_FILE,
+                        f"{REGISTRY_JOURNAL_FILE}.{REGISTRY_JOURNAL_WRITTEN_SEQ}"
+                    )
 
-            data = {
+            # rows sorted by uid, so the index is written in the same pass
+            users.sort(key=lambda row: row[0])
+            header = json.dumps({
                 REGISTRY_META_KEY: REGISTRY_SCHEMA_VERSION,
-                "users": {
-                    str(uid): {
-                        "source": info["source"],
-                        "labels": list(info["labels"]),
-                        "first_seen": info["first_seen"],
-                        "chat_id": info["chat_id"],
-                    }
-                    for uid, info in USER_REGISTRY.items()
-                }
-            }
+                REGISTRY_JOURNAL_SEQ_KEY: seq,
+                "users": len(users),
+            }).encode() + b"\n"
 
             dir_name = os.path.dirname(os.path.abspath(USER_REGISTRY_FILE)) or "."
-            with tempfile.NamedTemporaryFile(
-                "w",
-                encoding="utf-8",
-                dir=dir_name,
-                delete=False
-            ) as tmp:
-                json.dump(data, tmp, ensure_ascii=False, indent=2)
-                tmp.flush()
-                os.fsync(tmp.fileno())
-                temp_name = tmp.name
+            with tempfile.NamedTemporaryFile("wb", dir=dir_name, delete=False) as tmp, \
+                    tempfile.NamedTemporaryFile("wb", dir=dir_name, delete=False) as tmp_index:
+                tmp.write(header)
+                tmp_index.write(REGISTRY_INDEX_HEADER.pack(REGISTRY_INDEX_MAGIC, seq, len(users)))
+                offset = len(header)
+                for uid, source, labels, first_seen, chat_id in users:
+                    line = json.dumps(
+                        {"uid": uid, "source": source, "labels": labels, "first_seen": first_seen, "chat_id": chat_id},
+                        ensure_ascii=False,
+                        separators=(",", ":"),
+                    ).encode() + b"\n"
+                    tmp.write(line)
+                    tmp_index.write(REGISTRY_INDEX_ENTRY.pack(uid, offset))
+                    offset += len(line)
+                for f in (tmp, tmp_index):
+                    f.flush()
+                    os.fsync(f.fileno())
+                temp_name, temp_index = tmp.name, tmp_index.name
 
             os.replace(temp_name, USER_REGISTRY_FILE)
+            # a crash between the two leaves an index with an older seq,
+            # which RegistryIndex callers treat as missing
+            os.replace(temp_index, REGISTRY_INDEX_FILE)
+            REGISTRY_SNAPSHOT_SEQ = seq
+
+            for last_seq, path in _journal_segments():
+                if last_seq <= seq:
+                    os.remove(path)
 
         except Exception as e:
             logging.error(f"REGISTRY | atomic save failed | error={e}")
+            return False
+    return True
 
-def load_user_registry():
-    if not os.path.exists(USER_REGISTRY_FILE):
-        return
-    try:
-        import json
-        with open(USER_REGISTRY_FILE, "r", encoding="utf-8") as f:
-            raw = json.load(f)
 
-        schema_version = raw.get(REGISTRY_META_KEY, 0)
-        if schema_version != REGISTRY_SCHEMA_VERSION:
-            logging.warning(
-                f"REGISTRY | schema mismatch detected | file=v{schema_version} code=v{REGISTRY_SCHEMA_VERSION}"
+def save_user_registry():
+    """Synchronous full snapshot (shutdown path)."""
+    users, seq = _begin_registry_compaction()
+    _finish_registry_compaction(users, seq)
+
+
+async def compact_user_registry() -> bool:
+    users, seq = _begin_registry_compaction()
+    started = time.monotonic()
+    if not await asyncio.to_thread(_finish_registry_compaction, users, seq):
+        return False
+    logging.info(
+        f"REGISTRY | compacted | users={len(users)} | seq={seq} | "
+        f"ms={int((time.monotonic() - started) * 1000)}"
+    )
+    return True
+
+
+def _replay_registry_journal(snapshot_seq: int) -> int:
+    global REGISTRY_JOURNAL_SEQ
+    paths = [path for _, path in _journal_segments()]
+    if os.path.exists(REGISTRY_JOURNAL_FILE):
+        paths.append(REGISTRY_JOURNAL_FILE)
+
+    replayed = 0
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                    seq = int(record["seq"])
+                except Exception:
+                    # torn tail after a crash — everything before it is intact
+                    logging.warning(f"REGISTRY | journal record skipped | file={path}")
+                    continue
+                if seq <= snapshot_seq:
+                    continue
+                _apply_registry_journal_record(record)
+                REGISTRY_JOURNAL_SEQ = max(REGISTRY_JOURNAL_SEQ, seq)
+                replayed += 1
+    return replayed
+
+
+# ================== STREAMING / LAZY REGISTRY LOAD (1.6.22) ==================
+# The snapshot is read line by line, so peak memory is the registry itself
+# (no second copy from json.load). With REGISTRY_LAZY_LOAD=true polling
+# starts right after the journal replay; registry_background_load() fills
+# USER_REGISTRY in chunks and lookups for rows not read yet go through the
+# on-disk uid → offset index (sorted fixed-size entries, binary search).
+REGISTRY_INDEX_FILE = USER_REGISTRY_FILE + ".idx"
+REGISTRY_INDEX_MAGIC = b"WBRIDX01"
+REGISTRY_INDEX_HEADER = struct.Struct("<8sQQ")  # magic, snapshot seq, entries
+REGISTRY_INDEX_ENTRY = struct.Struct("<qQ")     # uid, byte offset in the snapshot
+REGISTRY_LOAD_CHUNK = 5_000
+
+
+def _decode_registry_row(data: dict) -> UserRegistryItem:
+    return {
+        "source": data.get("source", JoinSource.TELEGRAM),
+        "labels": set(data.get("labels", [])),
+        "first_seen": float(data.get("first_seen", time.time())),
+        "chat_id": int(data.get("chat_id", 0)),
+    }
+
+
+def _read_registry_header(f) -> dict:
+    header = json.loads(f.readline() or b"{}")
+    if not isinstance(header, dict) or REGISTRY_META_KEY not in header:
+        raise ValueError("missing snapshot header")
+    return header
+
+
+class RegistryIndex:
+    """uid → snapshot byte offset, binary-searched in an mmap of the .idx file."""
+
+    def __init__(self, path: str):
+        self._file = open(path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, self.seq, self.entries = REGISTRY_INDEX_HEADER.unpack_from(self._map, 0)
+            expected = REGISTRY_INDEX_HEADER.size + self.entries * REGISTRY_INDEX_ENTRY.size
+            if magic != REGISTRY_INDEX_MAGIC or len(self._map) != expected:
+                raise ValueError("corrupt registry index")
+        except Exception:
+            self._file.close()
+            raise
+
+    def offset(self, uid: int) -> int | None:
+        lo, hi = 0, self.entries
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key, offset = REGISTRY_INDEX_ENTRY.unpack_from(
+                self._map, REGISTRY_INDEX_HEADER.size + mid * REGISTRY_INDEX_ENTRY.size
             )
-            # safe auto-upgrade: only update meta version without altering user data
-            raw[REGISTRY_META_KEY] = REGISTRY_SCHEMA_VERSION
+            if key < uid:
+                lo = mid + 1
+            elif key > uid:
+                hi = mid
+            else:
+                return offset
+        return None
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+class LazyRegistryLoad:
+    """Snapshot rows not yet in USER_REGISTRY (REGISTRY_LAZY_LOAD=true)."""
+
+    def __init__(self, index: RegistryIndex):
+        self.index = index
+        self.started = time.monotonic()
+        # journal ops for rows still on disk, applied when the row is read
+        self.deferred: dict[int, list[dict]] = {}
+        self.rows_read = 0
+        self.last_uid: int | None = None
+        # promoted through the index before the sequential reader got there
+        self.ahead: set[int] = set()
+        self._stream = open(USER_REGISTRY_FILE, "rb")   # background reader (worker thread)
+        self._random = open(USER_REGISTRY_FILE, "rb")   # point lookups (event loop)
+        _read_registry_header(self._stream)
+
+    def pending(self) -> int:
+        return self.index.entries - self.rows_read - len(self.ahead)
+
+    def read_chunk(self, limit: int) -> list[tuple[int, dict]]:
+        """Next raw rows in uid order. Runs in a worker thread."""
+        rows = []
+        for line in itertools.islice(self._stream, limit):
             try:
-                with open(USER_REGISTRY_FILE, "w", encoding="utf-8") as wf:
-                    json.dump(raw, wf, ensure_ascii=False, indent=2)
-                logging.info("REGISTRY | schema version auto-upgraded safely")
-            except Exception as e:
-                logging.error(f"REGISTRY | auto-upgrade failed | error={e}")
-        users = raw.get("users", {})
-
-        for uid, data in users.items():
-            USER_REGISTRY[int(uid)] = {
-                "source": data.get("source", JoinSource.TELEGRAM),
-                "labels": set(data.get("labels", [])),
-                "first_seen": float(data.get("first_seen", time.time())),
-                "chat_id": int(data.get("chat_id", 0)),
-            }
+                data = json.loads(line)
+                rows.append((int(data["uid"]), data))
+            except Exception:
+                logging.warning("REGISTRY | snapshot row skipped")
+        return rows
+
+    def resolve(self, uid: int, data: dict) -> UserRegistryItem:
+        item = _decode_registry_row(data)
+        for record in self.deferred.pop(uid, ()):
+            _apply_registry_update(item, record)
+        return item
+
+    def promote(self, uid: int) -> UserRegistryItem | None:
+        """Read one row through the index (event loop side, startup only)."""
+        offset = self.index.offset(uid)
+        if offset is None:
+            return None
+        self._random.seek(offset)
+        try:
+            data = json.loads(self._random.readline())
+        except ValueError:
+            logging.warning(f"REGISTRY | snapshot row skipped | uid={uid}")
+            return None
+        item = self.resolve(uid, data)
+        USER_REGISTRY[uid] = item
+        if self.last_uid is None or uid > self.last_uid:
+            self.ahead.add(uid)
+        return item
 
-        logging.info(
-            f"REGISTRY | loaded {len(USER_REGISTRY)} users | schema=v{schema_version}"
-        )
-    except Exception as e:
-        logging.error(f"REGISTRY | load failed | error={e}")
+    def close(self):
+        self._stream.close()
+        self._random.close()
+        self.index.close()
 
-# --- Registry schema validator ---
-def validate_registry_schema() -> tuple[bool, str]:
-    if not os.path.exists(USER_REGISTRY_FILE):
-        return True, "Registry file not found"
 
-    try:
-        import json
-        with open(USER_REGISTRY_FILE, "r", encoding="utf-8") as f:
-            raw = json.load(f)
+REGISTRY_LAZY: LazyRegistryLoad | None = None
+REGISTRY_LOADED = asyncio.Event()
 
-        if REGISTRY_META_KEY not in raw:
-            return False, "Missing schema version"
 
-        if raw[REGISTRY_META_KEY] != REGISTRY_SCHEMA_VERSION:
-            return False, f"Schema mismatch: {raw[REGISTRY_META_KEY]} != {REGISTRY_SCHEMA_VERSION}"
+def _open_registry_index(snapshot_seq: int) -> RegistryIndex | None:
+    try:
+        index = RegistryIndex(REGISTRY_INDEX_FILE)
+    except Exception as e:
+        logging.warning(f"REGISTRY | index unavailable | error={e}")
+        return None
+    if index.seq != snapshot_seq:
+        logging.warning(f"REGISTRY | index stale | index_seq={index.seq} snapshot_seq={snapshot_seq}")
+        index.close()
+        return None
+    return index
+
+
+def _load_legacy_registry() -> int:
+    """One-time read of the pre-1.6.22 JSON document. Returns its journal seq."""
+    with open(USER_REGISTRY_LEGACY_FILE, "r", encoding="utf-8") as f:
+        raw = json.load(f)
+    for uid, data in raw.get("users", {}).items():
+        USER_REGISTRY[int(uid)] = _decode_registry_row(data)
+    return int(raw.get(REGISTRY_JOURNAL_SEQ_KEY, 0))
+
+
+def load_user_registry(lazy: bool = False):
+    global REGISTRY_JOURNAL_SEQ, REGISTRY_SNAPSHOT_SEQ, REGISTRY_JOURNAL_RECORDS, REGISTRY_JOURNAL_WRITTEN_SEQ
+    global REGISTRY_LAZY
+    started = time.monotonic()
+    schema_version = REGISTRY_SCHEMA_VERSION
+    snapshot_seq = 0
+    skipped = 0
+    migrate_legacy = False
+
+    if os.path.exists(USER_REGISTRY_FILE):
+        try:
+            with open(USER_REGISTRY_FILE, "rb") as f:
+                header = _read_registry_header(f)
+                schema_version = header[REGISTRY_META_KEY]
+                snapshot_seq = int(header.get(REGISTRY_JOURNAL_SEQ_KEY, 0))
+                if schema_version != REGISTRY_SCHEMA_VERSION:
+                    # the next snapshot is written with the current version
+                    logging.warning(
+                        f"REGISTRY | schema mismatch detected | file=v{schema_version} code=v{REGISTRY_SCHEMA_VERSION}"
+                    )
 
-        if "users" not in raw or not isinstance(raw["users"], dict):
-            return False, "Invalid users section"
+                index = _open_registry_index(snapshot_seq) if lazy else None
+                if index is not None:
+                    REGISTRY_LAZY = LazyRegistryLoad(index)
+                else:
+                    if lazy:
+                        logging.warning("REGISTRY | lazy load unavailable — loading eagerly")
+                    for line in f:
+                        try:
+                            data = json.loads(line)
+                            USER_REGISTRY[int(data["uid"])] = _decode_registry_row(data)
+                        except Exception:
+                            # same as the lazy path: one bad row must not drop the rest
+                            skipped += 1
+            if skipped:
+                # the next compaction rewrites the snapshot without those rows
+                import shutil
+                shutil.copy(USER_REGISTRY_FILE, USER_REGISTRY_FILE + ".corrupt")
+                logging.error(
+                    f"REGISTRY | snapshot rows skipped | rows={skipped} | "
+                    f"copy={USER_REGISTRY_FILE}.corrupt"
+                )
+        except Exception as e:
+            # without the snapshot seq, new journal records would reuse
+            # numbers already on disk and be dropped by the next replay
+            logging.error(f"REGISTRY | load failed | error={e}")
+            raise RuntimeError(f"Реестр {USER_REGISTRY_FILE} не читается: {e}") from e
+    elif os.path.exists(USER_REGISTRY_LEGACY_FILE):
+        try:
+            snapshot_seq = _load_legacy_registry()
+            migrate_legacy = True
+        except Exception as e:
+            logging.error(f"REGISTRY | legacy load failed | error={e}")
+            raise RuntimeError(f"Реестр {USER_REGISTRY_LEGACY_FILE} не читается: {e}") from e
 
-        return True, "Schema valid"
+    REGISTRY_JOURNAL_SEQ = snapshot_seq
+    REGISTRY_SNAPSHOT_SEQ = snapshot_seq
+    try:
+        replayed = _replay_registry_journal(snapshot_seq)
     except Exception as e:
-        return False, f"Validation error: {e}"
+        logging.error(f"REGISTRY | journal replay failed | error={e}")
+        raise RuntimeError(f"Журнал реестра не читается: {e}") from e
+    REGISTRY_JOURNAL_RECORDS = replayed
+    REGISTRY_JOURNAL_WRITTEN_SEQ = REGISTRY_JOURNAL_SEQ
 
-# --- Dry-run migration stub ---
-def dry_run_migration(target_version: int) -> str:
-    affected = len(USER_REGISTRY)
-    return (
-        f"🧪 Dry-run migration\n\n"
-        f"From: v{REGISTRY_SCHEMA_VERSION}\n"
-        f"To: v{target_version}\n"
-        f"Users affected: {affected}\n\n"
-        f"❗ No data was modified"
-    )
+    if migrate_legacy:
+        # write the JSONL snapshot + index right away; the old file is kept aside
+        save_user_registry()
+        if REGISTRY_SNAPSHOT_SEQ == REGISTRY_JOURNAL_SEQ and os.path.exists(USER_REGISTRY_FILE):
+            os.replace(USER_REGISTRY_LEGACY_FILE, USER_REGISTRY_LEGACY_FILE + ".migrated")
+            logging.info(f"REGISTRY | migrated {USER_REGISTRY_LEGACY_FILE} → {USER_REGISTRY_FILE}")
 
-# --- Apply migration stub (blocked) ---
-def apply_migration(target_version: int) -> str:
-    return (
-        f"⛔ Migration blocked\n\n"
-        f"Target version: v{target_version}\n"
-        f"Reason: apply_migration is disabled in v1.5.9\n"
-        f"Use --dry-run only"
+    if REGISTRY_LAZY is None:
+        REGISTRY_LOADED.set()
+    logging.info(
+        f"REGISTRY | loaded {len(USER_REGISTRY)} users | schema=v{schema_version} | "
+        f"journal_replayed={replayed} | "
+        f"deferred={REGISTRY_LAZY.pending() if REGISTRY_LAZY else 0} | "
+        f"ms={int((time.monotonic() - started) * 1000)}"
     )
 
-# --- v1.5.9: controlled migration apply (preview, blocked by flag) ---
-MIGRATION_APPLY_ENABLED = False  # hard safety switch
 
-def apply_migration_controlled(target_version: int, admin_id: int) -> str:
-    if REGISTRY_READ_ONLY:
-        return (
+async def registry_background_load():
+    """Stream the remaining snapshot rows into USER_REGISTRY (lazy startup)."""
+    global REGISTRY_LAZY
+    lazy = REGISTRY_LAZY
+    if lazy is None:
+        return
+    try:
+        while True:
+            rows = await asyncio.to_thread(lazy.read_chunk, REGISTRY_LOAD_CHUNK)
+            if not rows:
+                break
+            for uid, data in rows:
+                lazy.rows_read += 1
+                lazy.last_uid = uid
+                if uid in USER_REGISTRY:
+                    # promoted through the index or re-inserted meanwhile
+                    lazy.ahead.discard(uid)
+                    continue
+                item = lazy.resolve(uid, data)
+                USER_REGISTRY[uid] = item
+                REGISTRY_STORE.aggregates.add(item)
+            await asyncio.sleep(0)
+    finally:
+        REGISTRY_LAZY = None
+        lazy.close()
+
+    REGISTRY_LOADED.set()
+    log_event(
+        "REGISTRY_LOADED",
+        users=len(USER_REGISTRY),
+        rows=lazy.rows_read,
+        ms=int((time.monotonic() - lazy.started) * 1000),
+    )
+
+
+# ================== REGISTRY STORE ABSTRACTION (1.6.2) ==================
+@dataclass(frozen=True)
+class RegistryFilter:
+    """Row filter for exports. Every set field must match; until is exclusive."""
+    source: str | None = None
+    label: str | None = None
+    chat_id: int | None = None
+    since: float | None = None
+    until: float | None = None
+
+    def matches(self, info: UserRegistryItem) -> bool:
+        if self.source is not None and info["source"] != self.source:
+            return False
+        if self.label is not None and self.label not in info["labels"]:
+            return False
+        if self.chat_id is not None and info["chat_id"] != self.chat_id:
+            return False
+        if self.since is not None and info["first_seen"] < self.since:
+            return False
+        if self.until is not None and info["first_seen"] >= self.until:
+            return False
+        return True
+
+    def describe(self) -> str:
+        parts = [
+            f"{name}={value}"
+            for name, value in (
+                ("source", self.source),
+                ("label", self.label),
+                ("chat", self.chat_id),
+                ("since", int(self.since) if self.since is not None else None),
+                ("until", int(self.until) if self.until is not None else None),
+            )
+            if value is not None
+        ]
+        return " ".join(parts) or "none"
+
+
+# ================== REGISTRY AGGREGATES (1.6.20) ==================
+# Counters per source / label / join day, globally and per chat, updated by
+# the store at mutation time so /registry_stats never walks the registry.
+def registry_join_day(first_seen: float) -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime(first_seen))
+
+
+def _bump(counter: dict, key, delta: int):
+    n = counter.get(key, 0) + delta
+    if n:
+        counter[key] = n
+    else:
+        counter.pop(key, None)
+
+
+class RegistryCounts:
+    __slots__ = ("total", "sources", "labels", "days")
+
+    def __init__(self):
+        self.total = 0
+        self.sources: dict[str, int] = {}
+        self.labels: dict[str, int] = {}
+        self.days: dict[str, int] = {}
+
+    def as_dict(self) -> dict:
+        return {"total": self.total, "sources": self.sources, "labels": self.labels, "days": self.days}
+
+
+class RegistryAggregates:
+    def __init__(self):
+        self.all = RegistryCounts()
+        self.chats: dict[int, RegistryCounts] = {}
+
+    def _scopes(self, chat_id: int) -> tuple[RegistryCounts, RegistryCounts]:
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            chat = self.chats[chat_id] = RegistryCounts()
+        return self.all, chat
+
+    def _drop_empty(self, chat_id: int):
+        chat = self.chats.get(chat_id)
+        if chat is not None and not chat.total:
+            del self.chats[chat_id]
+
+    def add(self, item: UserRegistryItem, delta: int = 1):
+        day = registry_join_day(item["first_seen"])
+        for scope in self._scopes(item["chat_id"]):
+            scope.total += delta
+            _bump(scope.sources, item["source"], delta)
+            _bump(scope.days, day, delta)
+            for label in item["labels"]:
+                _bump(scope.labels, label, delta)
+        self._drop_empty(item["chat_id"])
+
+    def remove(self, item: UserRegistryItem):
+        self.add(item, -1)
+
+    def change_source(self, chat_id: int, old: str, new: str):
+        for scope in self._scopes(chat_id):
+            _bump(scope.sources, old, -1)
+            _bump(scope.sources, new, 1)
+
+    def change_label(self, chat_id: int, label: str, delta: int):
+        for scope in self._scopes(chat_id):
+            _bump(scope.labels, label, delta)
+
+    def chat_totals(self) -> dict[int, int]:
+        return {chat_id: counts.total for chat_id, counts in self.chats.items()}
+
+    def diff(self, other: "RegistryAggregates") -> list[str]:
+        """Counters that differ from other (e.g. a fresh recount)."""
+        lines = []
+        scopes = [("all", self.all, other.all)] + [
+            (f"chat {chat_id}", self.chats.get(chat_id, RegistryCounts()), other.chats.get(chat_id, RegistryCounts()))
+            for chat_id in sorted(set(self.chats) | set(other.chats))
+        ]
+        for name, mine, theirs in scopes:
+            if mine.total != theirs.total:
+                lines.append(f"{name} total: {mine.total} → {theirs.total}")
+            for kind in ("sources", "labels", "days"):
+                a, b = getattr(mine, kind), getattr(theirs, kind)
+                for key in sorted(set(a) | set(b)):
+                    if a.get(key, 0) != b.get(key, 0):
+                        lines.append(f"{name} {kind[:-1]} {key}: {a.get(key, 0)} → {b.get(key, 0)}")
+        return lines
+
+
+# Same pattern as FeatureStore: handlers go through the registry_* helpers
+# below and never touch the backend directly. Backend: REGISTRY_BACKEND.
+class RegistryStore:
+    aggregates: RegistryAggregates
+    # mutations may wait on another process — registry_* helpers run them in a thread
+    offload_writes = False
+
+    def load(self):
+        raise NotImplementedError
+
+    def get(self, user_id: int) -> UserRegistryItem | None:
+        """Read-only view of a record. Mutate only via the store methods."""
+        raise NotImplementedError
+
+    def has_label(self, user_id: int, label: str) -> bool:
+        item = self.get(user_id)
+        return bool(item) and label in item["labels"]
+
+    def insert(self, user_id: int, item: UserRegistryItem):
+        raise NotImplementedError
+
+    def set_source(self, user_id: int, source: str):
+        raise NotImplementedError
+
+    def add_label(self, user_id: int, label: str) -> bool:
+        raise NotImplementedError
+
+    def remove_label(self, user_id: int, label: str) -> bool:
+        raise NotImplementedError
+
+    def count(self) -> int:
+        raise NotImplementedError
+
+    def source_counts(self) -> dict[str, int]:
+        return dict(self.stats().all.sources)
+
+    def stats(self) -> RegistryAggregates:
+        """Live counters (O(1)); read-only for callers."""
+        return self.aggregates
+
+    def recount(self) -> RegistryAggregates:
+        """Recompute the counters from scratch. Safe in a worker thread."""
+        fresh = RegistryAggregates()
+        for _, info in self.iter_filtered(RegistryFilter()):
+            fresh.add(info)
+        return fresh
+
+    def iter_items(self) -> Iterator[tuple[int, UserRegistryItem]]:
+        raise NotImplementedError
+
+    def iter_filtered(self, flt: RegistryFilter) -> Iterator[tuple[int, UserRegistryItem]]:
+        """Rows matching flt, streamed. Must be safe in a worker thread."""
+        for uid, info in self.iter_items():
+            if flt.matches(info):
+                yield uid, info
+
+    def pending(self) -> int:
+        return 0
+
+    def flush(self) -> int:
+        """Durably persist buffered mutations. Must be safe in a worker thread."""
+        return 0
+
+    def needs_compaction(self) -> bool:
+        return False
+
+    async def compact(self):
+        pass
+
+    def validate_schema(self) -> tuple[bool, str]:
+        raise NotImplementedError
+
+    def close(self):
+        self.flush()
+
+
+class JournalRegistryStore(RegistryStore):
+    """USER_REGISTRY in memory, persisted as JSON snapshot + append-only journal."""
+
+    def __init__(self):
+        self.aggregates = RegistryAggregates()
+
+    def load(self):
+        load_user_registry(lazy=CFG.registry_lazy_load)
+        aggregates = RegistryAggregates()
+        for info in USER_REGISTRY.values():
+            aggregates.add(info)
+        self.aggregates = aggregates
+
+    def _lookup(self, user_id: int) -> UserRegistryItem | None:
+        item = USER_REGISTRY.get(user_id)
+        if item is None and REGISTRY_LAZY is not None:
+            # lazy startup: row may still be on disk only
+            item = REGISTRY_LAZY.promote(user_id)
+            if item is not None:
+                self.aggregates.add(item)
+        return item
+
+    def get(self, user_id: int) -> UserRegistryItem | None:
+        return self._lookup(user_id)
+
+    def insert(self, user_id: int, item: UserRegistryItem):
+        previous = self._lookup(user_id)
+        if previous:
+            self.aggregates.remove(previous)
+        USER_REGISTRY[user_id] = item
+        self.aggregates.add(item)
+        _registry_journal_append({
+            "op": "insert",
+            "uid": user_id,
+            "source": item["source"],
+            "labels": sorted(item["labels"]),
+            "first_seen": item["first_seen"],
+            "chat_id": item["chat_id"],
+        })
+
+    def set_source(self, user_id: int, source: str):
+        item = self._lookup(user_id)
+        if not item or item["source"] == source:
+            return
+        self.aggregates.change_source(item["chat_id"], item["source"], source)
+        item["source"] = source
+        USER_REGISTRY[user_id] = item
+        _registry_journal_append({"op": "source", "uid": user_id, "source": source})
+
+    def add_label(self, user_id: int, label: str) -> bool:
+        item = self._lookup(user_id)
+        if not item or label in item["labels"]:
+            return False
+        item["labels"].add(label)
+        USER_REGISTRY[user_id] = item
+        self.aggregates.change_label(item["chat_id"], label, 1)
+        _registry_journal_append({"op": "label_add", "uid": user_id, "label": label})
+        return True
+
+    def remove_label(self, user_id: int, label: str) -> bool:
+        item = self._lookup(user_id)
+        if not item or label not in item["labels"]:
+            return False
+        item["labels"].remove(label)
+        USER_REGISTRY[user_id] = item
+        self.aggregates.change_label(item["chat_id"], label, -1)
+        _registry_journal_append({"op": "label_remove", "uid": user_id, "label": label})
+        return True
+
+    def count(self) -> int:
+        if REGISTRY_LAZY is not None:
+            # approximate until the background load finishes
+            return len(USER_REGISTRY) + REGISTRY_LAZY.pending()
+        return len(USER_REGISTRY)
+
+    def iter_items(self) -> Iterator[tuple[int, UserRegistryItem]]:
+        return iter(USER_REGISTRY.items())
+
+    def iter_filtered(self, flt: RegistryFilter) -> Iterator[tuple[int, UserRegistryItem]]:
+        # The loop keeps mutating USER_REGISTRY while an export thread reads:
+        # snapshot only the keys (one pointer per user), read records live
+        for uid in list(USER_REGISTRY):
+            info = USER_REGISTRY.get(uid)
+            if info is None or not flt.matches(info):
+                continue
+            yield uid, {**info, "labels": info["labels"].copy()}
+
+    def pending(self) -> int:
+        return len(REGISTRY_JOURNAL_PENDING)
+
+    def flush(self) -> int:
+        return flush_user_registry()
+
+    def needs_compaction(self) -> bool:
+        # a snapshot taken mid-load would drop the rows still on disk
+        return REGISTRY_LOADED.is_set() and REGISTRY_JOURNAL_RECORDS >= REGISTRY_COMPACT_THRESHOLD
+
+    async def compact(self):
+        await compact_user_registry()
+
+    def validate_schema(self) -> tuple[bool, str]:
+        if not os.path.exists(USER_REGISTRY_FILE):
+            return True, "Registry file not found"
+
+        try:
+            with open(USER_REGISTRY_FILE, "rb") as f:
+                header = json.loads(f.readline() or b"{}")
+
+            if REGISTRY_META_KEY not in header:
+                return False, "Missing schema version"
+
+            if header[REGISTRY_META_KEY] != REGISTRY_SCHEMA_VERSION:
+                return False, f"Schema mismatch: {header[REGISTRY_META_KEY]} != {REGISTRY_SCHEMA_VERSION}"
+
+            if not isinstance(header.get("users"), int):
+                return False, "Invalid users count"
+
+            return True, "Schema valid"
+        except Exception as e:
+            return False, f"Validation error: {e}"
+
+    def close(self):
+        flush_user_registry()
+        if not REGISTRY_LOADED.is_set():
+            # stopped mid-load: the old snapshot + journal are still complete
+            logging.warning("REGISTRY | snapshot skipped | background load unfinished")
+            return
+        save_user_registry()
+
+
+class CompactRegistryStore(JournalRegistryStore):
+    """JournalRegistryStore over a CompactRegistry (REGISTRY_BACKEND=compact)."""
+
+    def has_label(self, user_id: int, label: str) -> bool:
+        if REGISTRY_LAZY is not None and user_id not in USER_REGISTRY:
+            return super().has_label(user_id, label)
+        # bit test, no record decode (is_paid_member hot path)
+        return USER_REGISTRY.has_label(user_id, label)
+
+
+class SqliteRegistryStore(RegistryStore):
+    """
+    SQLite registry in WAL mode with secondary indexes.
+
+    Mutations run on the event loop inside an open transaction and are
+    committed in batches by registry_flusher(). With synchronous=NORMAL a
+    WAL commit does not fsync, and auto-checkpoint is off on this connection
+    (the flusher checkpoints on its own one), so the loop never waits on the disk.
+    Sharded (batch_commits=False), each mutation commits on its own in a
+    worker thread, since it may wait on another shard's write lock; the
+    loop reads through a separate connection.
+    All SQL is constant, so sqlite3's statement cache keeps it prepared.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id    INTEGER PRIMARY KEY,
+            source     TEXT    NOT NULL,
+            first_seen REAL    NOT NULL,
+            chat_id    INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS user_labels (
+            user_id INTEGER NOT NULL,
+            label   TEXT    NOT NULL,
+            PRIMARY KEY (user_id, label)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_users_chat_id ON users (chat_id);
+        CREATE INDEX IF NOT EXISTS idx_users_source ON users (source);
+        CREATE INDEX IF NOT EXISTS idx_users_first_seen ON users (first_seen);
+        CREATE INDEX IF NOT EXISTS idx_user_labels_label ON user_labels (label, user_id);
+    """
+    SQL_GET_USER = "SELECT source, first_seen, chat_id FROM users WHERE user_id = ?"
+    SQL_GET_LABELS = "SELECT label FROM user_labels WHERE user_id = ?"
+    SQL_HAS_LABEL = "SELECT 1 FROM user_labels WHERE user_id = ? AND label = ?"
+    SQL_UPSERT_USER = (
+        "INSERT OR REPLACE INTO users (user_id, source, first_seen, chat_id) VALUES (?, ?, ?, ?)"
+    )
+    SQL_CLEAR_LABELS = "DELETE FROM user_labels WHERE user_id = ?"
+    SQL_SET_SOURCE = "UPDATE users SET source = ? WHERE user_id = ? AND source != ?"
+    SQL_ADD_LABEL = (
+        "INSERT OR IGNORE INTO user_labels (user_id, label) "
+        "SELECT ?, ? WHERE EXISTS (SELECT 1 FROM users WHERE user_id = ?)"
+    )
+    SQL_REMOVE_LABEL = "DELETE FROM user_labels WHERE user_id = ? AND label = ?"
+    SQL_COUNT = "SELECT COUNT(*) FROM users"
+    SQL_RECOUNT_USERS = (
+        "SELECT chat_id, source, date(first_seen, 'unixepoch'), COUNT(*) "
+        "FROM users GROUP BY 1, 2, 3"
+    )
+    SQL_RECOUNT_LABELS = (
+        "SELECT u.chat_id, l.label, COUNT(*) "
+        "FROM user_labels l JOIN users u ON u.user_id = l.user_id GROUP BY 1, 2"
+    )
+    SQL_ITER = (
+        "SELECT u.user_id, u.source, u.first_seen, u.chat_id, "
+        "(SELECT GROUP_CONCAT(label, char(31)) FROM user_labels l WHERE l.user_id = u.user_id) "
+        "FROM users u ORDER BY u.user_id"
+    )
+    SQL_ITER_FILTERED = (
+        "SELECT u.user_id, u.source, u.first_seen, u.chat_id, "
+        "(SELECT GROUP_CONCAT(label, char(31)) FROM user_labels l WHERE l.user_id = u.user_id) "
+        "FROM users u WHERE {where} ORDER BY u.user_id"
+    )
+
+    def __init__(self, path: str, batch_commits: bool = True):
+        self.path = path
+        # False when several processes share the file: a long-open write
+        # transaction would lock out the other shards, so commit per statement
+        self.batch_commits = batch_commits
+        self.offload_writes = not batch_commits
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+        # sharded: loop-side reads use their own connection, so a write
+        # waiting on another shard's lock (in a thread) never holds them up
+        self._read_conn: sqlite3.Connection | None = None
+        self._read_lock = threading.Lock()
+        self._checkpoint_conn: sqlite3.Connection | None = None
+        self._checkpoint_lock = threading.Lock()
+        self._in_tx = False
+        self._pending = 0
+        self.aggregates = RegistryAggregates()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=5)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _open(self):
+        self._conn = self._connect()
+        if self.batch_commits:
+            # a checkpoint fsyncs — never inside a COMMIT holding self._lock
+            self._conn.execute("PRAGMA wal_autocheckpoint=0")
+        self._conn.executescript(self.SCHEMA)
+        if self._conn.execute("PRAGMA user_version").fetchone()[0] == 0:
+            self._conn.execute(f"PRAGMA user_version = {REGISTRY_SCHEMA_VERSION}")
+
+    def load(self):
+        self._open()
+        if SHARD_INDEX is None and self.count() == 0:
+            # shard workers skip this: the leader ran prepare() before spawning them
+            self._import_json_registry()
+        if not self.batch_commits:
+            self._read_conn = self._connect()
+        self.aggregates = self.recount()
+
+        logging.info(f"REGISTRY | sqlite loaded | users={self.count()} | file={self.path}")
+
+    def prepare(self):
+        """Schema + one-time JSON import, then close (sharded leader, before the workers start)."""
+        self._open()
+        try:
+            if self.count() == 0:
+                self._import_json_registry()
+        finally:
+            self._conn.close()
+            self._conn = None
+
+    def _import_json_registry(self):
+        # one-time migration from the JSON snapshot + journal
+        if not any(
+            os.path.exists(path)
+            for path in (USER_REGISTRY_FILE, USER_REGISTRY_LEGACY_FILE, REGISTRY_JOURNAL_FILE)
+        ):
+            return
+
+        load_user_registry()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                self.SQL_UPSERT_USER,
+                (
+                    (uid, info["source"], info["first_seen"], info["chat_id"])
+                    for uid, info in USER_REGISTRY.items()
+                )
+            )
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO user_labels (user_id, label) VALUES (?, ?)",
+                (
+                    (uid, label)
+                    for uid, info in USER_REGISTRY.items()
+                    for label in info["labels"]
+                )
+            )
+            self._conn.execute("COMMIT")
+
+        logging.info(f"REGISTRY | imported {len(USER_REGISTRY)} users from {USER_REGISTRY_FILE}")
+        USER_REGISTRY.clear()
+
+    def _write(self, sql: str, params: tuple) -> int:
+        with self._lock:
+            if not self.batch_commits:
+                return self._conn.execute(sql, params).rowcount
+            if not self._in_tx:
+                self._conn.execute("BEGIN")
+                self._in_tx = True
+            rowcount = self._conn.execute(sql, params).rowcount
+            if rowcount:
+                self._pending += 1
+        if rowcount:
+            REGISTRY_DIRTY.set()
+        return rowcount
+
+    def _write_many(self, statements: list[tuple[str, tuple]]) -> int:
+        """Several statements as one unit: other shards never see a partial write."""
+        if self.batch_commits:
+            # the batch transaction is only committed between mutations
+            return sum(self._write(sql, params) for sql, params in statements)
+        rowcount = 0
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for sql, params in statements:
+                    rowcount += self._conn.execute(sql, params).rowcount
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return rowcount
+
+    def _read(self, sql: str, params: tuple = ()) -> list[tuple]:
+        if self._read_conn is None:
+            # batching: reads must see the open transaction
+            with self._lock:
+                return self._conn.execute(sql, params).fetchall()
+        with self._read_lock:
+            return self._read_conn.execute(sql, params).fetchall()
+
+    def get(self, user_id: int) -> UserRegistryItem | None:
+        rows = self._read(self.SQL_GET_USER, (user_id,))
+        if not rows:
+            return None
+        source, first_seen, chat_id = rows[0]
+        return {
+            "source": source,
+            "labels": {r[0] for r in self._read(self.SQL_GET_LABELS, (user_id,))},
+            "first_seen": first_seen,
+            "chat_id": chat_id,
+        }
+
+    def has_label(self, user_id: int, label: str) -> bool:
+        return bool(self._read(self.SQL_HAS_LABEL, (user_id, label)))
+
+    def insert(self, user_id: int, item: UserRegistryItem):
+        previous = self.get(user_id)
+        if previous:
+            self.aggregates.remove(previous)
+        self.aggregates.add(item)
+        self._write_many([
+            (self.SQL_UPSERT_USER, (user_id, item["source"], item["first_seen"], item["chat_id"])),
+            (self.SQL_CLEAR_LABELS, (user_id,)),
+            *((self.SQL_ADD_LABEL, (user_id, label, user_id)) for label in item["labels"]),
+        ])
+
+    def _user_row(self, user_id: int) -> tuple[str, float, int] | None:
+        rows = self._read(self.SQL_GET_USER, (user_id,))
+        return rows[0] if rows else None
+
+    def set_source(self, user_id: int, source: str):
+        row = self._user_row(user_id)
+        if row and self._write(self.SQL_SET_SOURCE, (source, user_id, source)):
+            self.aggregates.change_source(row[2], row[0], source)
+
+    def add_label(self, user_id: int, label: str) -> bool:
+        row = self._user_row(user_id)
+        if row and self._write(self.SQL_ADD_LABEL, (user_id, label, user_id)):
+            self.aggregates.change_label(row[2], label, 1)
+            return True
+        return False
+
+    def remove_label(self, user_id: int, label: str) -> bool:
+        row = self._user_row(user_id)
+        if row and self._write(self.SQL_REMOVE_LABEL, (user_id, label)):
+            self.aggregates.change_label(row[2], label, -1)
+            return True
+        return False
+
+    def count(self) -> int:
+        return self._read(self.SQL_COUNT)[0][0]
+
+    def stats(self) -> RegistryAggregates:
+        if not self.batch_commits:
+            # other shards write the same file — local counters miss their
+            # joins, so answer from the indexes instead (worker thread only)
+            return self.recount()
+        return self.aggregates
+
+    def recount(self) -> RegistryAggregates:
+        fresh = RegistryAggregates()
+        conn = self._connect()
+        try:
+            for chat_id, source, day, n in conn.execute(self.SQL_RECOUNT_USERS):
+                for scope in fresh._scopes(chat_id):
+                    scope.total += n
+                    _bump(scope.sources, source, n)
+                    _bump(scope.days, day, n)
+            for chat_id, label, n in conn.execute(self.SQL_RECOUNT_LABELS):
+                for scope in fresh._scopes(chat_id):
+                    _bump(scope.labels, label, n)
+        finally:
+            conn.close()
+        return fresh
+
+    def iter_items(self) -> Iterator[tuple[int, UserRegistryItem]]:
+        cursor = self._conn.cursor()
+        with self._lock:
+            cursor.execute(self.SQL_ITER)
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(1000)
+            if not rows:
+                return
+            for uid, source, first_seen, chat_id, labels in rows:
+                yield uid, {
+                    "source": source,
+                    "labels": set(labels.split("\x1f")) if labels else set(),
+                    "first_seen": first_seen,
+                    "chat_id": chat_id,
+                }
+
+    def iter_filtered(self, flt: RegistryFilter) -> Iterator[tuple[int, UserRegistryItem]]:
+        # own connection: a long export must not hold self._lock, and WAL
+        # gives it a consistent snapshot while the loop keeps writing
+        clauses, params = ["1"], []
+        if flt.source is not None:
+            clauses.append("u.source = ?")
+            params.append(flt.source)
+        if flt.chat_id is not None:
+            clauses.append("u.chat_id = ?")
+            params.append(flt.chat_id)
+        if flt.since is not None:
+            clauses.append("u.first_seen >= ?")
+            params.append(flt.since)
+        if flt.until is not None:
+            clauses.append("u.first_seen < ?")
+            params.append(flt.until)
+        if flt.label is not None:
+            clauses.append("EXISTS (SELECT 1 FROM user_labels l WHERE l.user_id = u.user_id AND l.label = ?)")
+            params.append(flt.label)
+
+        conn = self._connect()
+        try:
+            cursor = conn.execute(self.SQL_ITER_FILTERED.format(where=" AND ".join(clauses)), params)
+            for uid, source, first_seen, chat_id, labels in cursor:
+                yield uid, {
+                    "source": source,
+                    "labels": set(labels.split("\x1f")) if labels else set(),
+                    "first_seen": first_seen,
+                    "chat_id": chat_id,
+                }
+        finally:
+            conn.close()
+
+    def pending(self) -> int:
+        return self._pending
+
+    def flush(self) -> int:
+        with self._lock:
+            if not self._in_tx:
+                return 0
+            self._conn.execute("COMMIT")
+            self._in_tx = False
+            flushed, self._pending = self._pending, 0
+        self._checkpoint()
+        return flushed
+
+    def _checkpoint(self):
+        # own connection, outside self._lock: loop-side reads and writes
+        # keep going while the WAL is copied back and fsynced
+        with self._checkpoint_lock:
+            if self._checkpoint_conn is None:
+                self._checkpoint_conn = self._connect()
+            self._checkpoint_conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def validate_schema(self) -> tuple[bool, str]:
+        try:
+            with self._lock:
+                version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+                tables = {
+                    r[0] for r in self._conn.execute(
+                        "SELECT name FROM sqlite_master WHERE type = 'table'"
+                    )
+                }
+            if version != REGISTRY_SCHEMA_VERSION:
+                return False, f"Schema mismatch: {version} != {REGISTRY_SCHEMA_VERSION}"
+            if not {"users", "user_labels"} <= tables:
+                return False, "Missing registry tables"
+            return True, "Schema valid"
+        except Exception as e:
+            return False, f"Validation error: {e}"
+
+    def backup_to(self, path: str):
+        """
+        Online copy through the sqlite backup API. Reads a WAL snapshot on
+        its own connection, so writers are not blocked. Safe in a worker thread.
+        """
+        src = self._connect()
+        dest = sqlite3.connect(path)
+        try:
+            src.backup(dest)
+        finally:
+            dest.close()
+            src.close()
+
+    def restore_from(self, path: str):
+        """Replace the whole database with the copy at path. Safe in a worker thread."""
+        src = sqlite3.connect(path)
+        try:
+            check = src.execute("PRAGMA integrity_check").fetchone()[0]
+            if check != "ok":
+                raise ValueError(f"integrity_check: {check}")
+            with self._lock:
+                if self._in_tx:
+                    self._conn.execute("COMMIT")
+                    self._in_tx = False
+                    self._pending = 0
+                src.backup(self._conn)
+        finally:
+            src.close()
+        self.aggregates = self.recount()
+
+    def close(self):
+        if not self._conn:
+            return
+        self.flush()
+        with self._lock:
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self._conn.close()
+            self._conn = None
+        if self._read_conn is not None:
+            with self._read_lock:
+                self._read_conn.close()
+                self._read_conn = None
+        with self._checkpoint_lock:
+            if self._checkpoint_conn is not None:
+                self._checkpoint_conn.close()
+                self._checkpoint_conn = None
+
+
+REGISTRY_STORE: RegistryStore = (
+    SqliteRegistryStore(CFG.registry_db_file, batch_commits=CFG.shard_workers == 1)
+    if CFG.registry_backend == "sqlite"
+    else CompactRegistryStore()
+    if CFG.registry_backend == "compact"
+    else JournalRegistryStore()
+)
+
+
+# v1.6.23 — uids changed since the last full backup (differential backups)
+REGISTRY_BACKUP_DIRTY: set[int] = set()
+# anything changed since the last backup of either kind (scheduler trigger)
+REGISTRY_BACKUP_CHANGED = False
+
+
+def _mark_backup_dirty(user_id: int):
+    global REGISTRY_BACKUP_CHANGED
+    REGISTRY_BACKUP_DIRTY.add(user_id)
+    REGISTRY_BACKUP_CHANGED = True
+
+
+# --- Registry access helpers (used by handlers) ---
+def registry_get(user_id: int) -> UserRegistryItem | None:
+    return REGISTRY_STORE.get(user_id)
+
+
+async def _registry_write(fn, *args):
+    if REGISTRY_STORE.offload_writes:
+        # sharded sqlite: a commit may wait up to the busy timeout on another shard
+        return await asyncio.to_thread(fn, *args)
+    return fn(*args)
+
+
+async def registry_insert(user_id: int, item: UserRegistryItem):
+    await _registry_write(REGISTRY_STORE.insert, user_id, item)
+    _mark_backup_dirty(user_id)
+
+
+async def registry_set_source(user_id: int, source: str):
+    await _registry_write(REGISTRY_STORE.set_source, user_id, source)
+    _mark_backup_dirty(user_id)
+
+
+async def registry_add_label(user_id: int, label: str) -> bool:
+    if not await _registry_write(REGISTRY_STORE.add_label, user_id, label):
+        return False
+    _mark_backup_dirty(user_id)
+    return True
+
+
+async def registry_remove_label(user_id: int, label: str) -> bool:
+    if not await _registry_write(REGISTRY_STORE.remove_label, user_id, label):
+        return False
+    _mark_backup_dirty(user_id)
+    return True
+
+
+async def registry_flusher():
+    while not shutdown_event.is_set():
+        await REGISTRY_DIRTY.wait()
+        REGISTRY_DIRTY.clear()
+
+        started = time.monotonic()
+        flushed = await asyncio.to_thread(REGISTRY_STORE.flush)
+        REGISTRY_SAVE_SECONDS.observe(time.monotonic() - started, "flush")
+        if flushed:
+            logging.info(
+                f"REGISTRY | flushed | records={flushed} | "
+                f"ms={int((time.monotonic() - started) * 1000)}"
+            )
+
+        # coalesce everything dirtied meanwhile into the next write
+        await asyncio.sleep(CFG.registry_flush_interval)
+
+
+async def registry_compactor():
+    while not shutdown_event.is_set():
+        await asyncio.sleep(REGISTRY_COMPACT_INTERVAL_SECONDS)
+        if not REGISTRY_STORE.needs_compaction():
+            continue
+        started = time.monotonic()
+        try:
+            await REGISTRY_STORE.compact()
+            REGISTRY_SAVE_SECONDS.observe(time.monotonic() - started, "compact")
+        except Exception as e:
+            logging.error(f"REGISTRY | compaction failed | error={e}")
+
+# --- Registry schema validator ---
+def validate_registry_schema() -> tuple[bool, str]:
+    return REGISTRY_STORE.validate_schema()
+
+
+# --- Dry-run migration stub ---
+def dry_run_migration(target_version: int) -> str:
+    affected = REGISTRY_STORE.count()
+    return (
+        f"🧪 Dry-run migration\n\n"
+        f"From: v{REGISTRY_SCHEMA_VERSION}\n"
+        f"To: v{target_version}\n"
+        f"Users affected: {affected}\n\n"
+        f"❗ No data was modified"
+    )
+
+# --- Apply migration stub (blocked) ---
+def apply_migration(target_version: int) -> str:
+    return (
+        f"⛔ Migration blocked\n\n"
+        f"Target version: v{target_version}\n"
+        f"Reason: apply_migration is disabled in v1.5.9\n"
+        f"Use --dry-run only"
+    )
+
+# --- v1.5.9: controlled migration apply (preview, blocked by flag) ---
+MIGRATION_APPLY_ENABLED = False  # hard safety switch
+
+def apply_migration_controlled(target_version: int, admin_id: int) -> str:
+    if REGISTRY_READ_ONLY:
+        return (
             "⛔ Migration blocked\n\n"
             "Reason: REGISTRY_READ_ONLY = True"
         )
@@ -481,7 +2677,7 @@ async def registry_plan_cmd(message: Message):
 
     plan = (
         "🧭 <b>Registry migration plan</b>\n\n"
-        "1️⃣ Backup user_registry.json\n"
+        "1️⃣ Backup the registry (/registry_backup)\n"
         "2️⃣ Run /registry_schema\n"
         "3️⃣ Run /registry_migrate <version> --dry-run\n"
         "4️⃣ Set REGISTRY_READ_ONLY = False\n"
@@ -557,12 +2753,194 @@ async def registry_apply_cmd(message: Message):
 # ===========================================================
 # ===========================================================
 
-# bot_message_id -> (timestamp, message_type)
-BOT_MESSAGES: dict[int, tuple[float, str]] = {}
+# ================== AUTO-DELETE SCHEDULER (1.6.4) ==================
+# Deadline-ordered min-heap keyed by (chat_id, message_id): the cleanup task
+# sleeps exactly until the next deadline and only touches entries that are due.
+# (chat_id, message_id) -> (deadline, message_type)
+BOT_MESSAGES: dict[tuple[int, int], tuple[float, str]] = {}
+# (deadline, chat_id, message_id); rescheduled/cancelled entries are skipped lazily
+BOT_MESSAGES_HEAP: list[tuple[float, int, int]] = []
+# message_type -> pending count, so /health does not scan BOT_MESSAGES
+BOT_MESSAGES_TYPES: dict[str, int] = {}
+BOT_MESSAGES_WAKEUP = asyncio.Event()
+# admin replies in groups disappear quickly
+ADMIN_REPLY_TTL_SECONDS = 10
+
+# --- v1.6.5: bulk deletion via deleteMessages ---
+DELETE_MESSAGES_BATCH_MAX = 100  # Bot API limit for deleteMessages
+# entries due within this window are deleted together with the current batch
+AUTODELETE_LOOKAHEAD_SECONDS = 0.5
+# join service messages are held briefly so a join burst is deleted in one call
+SERVICE_MESSAGE_TTL_SECONDS = 1.0
+AUTODELETE_STATS = {
+    "deleted": 0,
+    # IDs sent in a successful deleteMessages: Telegram silently skips the
+    # ones it could not delete, so these are not confirmed deletions
+    "requested": 0,
+    "failed": 0,
+    # IDs of batches rejected for the whole chat (kicked, no rights, ...)
+    "dropped": 0,
+    "api_calls": 0,
+}
+
+# --- v1.6.6: durable auto-delete queue ---
+# Pending deletions survive restarts/deploys. Mutations are buffered on the
+# event loop and committed in one transaction per AUTODELETE_FLUSH_INTERVAL_SECONDS.
+AUTODELETE_FLUSH_INTERVAL_SECONDS = 1
+
 
-BOT_MESSAGES_CHAT_ID: dict[int, int] = {}
+class AutoDeleteStore:
+    def load(self) -> list[tuple[int, int, float, str]]:
+        raise NotImplementedError
+
+    def add(self, chat_id: int, message_id: int, deadline: float, msg_type: str):
+        raise NotImplementedError
+
+    def remove(self, chat_id: int, message_id: int):
+        raise NotImplementedError
+
+    def pending(self) -> int:
+        return 0
+
+    def flush(self) -> int:
+        return 0
+
+    def close(self):
+        self.flush()
+
+
+class InMemoryAutoDeleteStore(AutoDeleteStore):
+    def load(self) -> list[tuple[int, int, float, str]]:
+        return []
+
+    def add(self, chat_id: int, message_id: int, deadline: float, msg_type: str):
+        pass
+
+    def remove(self, chat_id: int, message_id: int):
+        pass
+
+
+class SqliteAutoDeleteStore(AutoDeleteStore):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS pending_deletions (
+            chat_id    INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            deadline   REAL    NOT NULL,
+            msg_type   TEXT    NOT NULL,
+            PRIMARY KEY (chat_id, message_id)
+        ) WITHOUT ROWID;
+    """
+    SQL_ADD = (
+        "INSERT OR REPLACE INTO pending_deletions (chat_id, message_id, deadline, msg_type) "
+        "VALUES (?, ?, ?, ?)"
+    )
+    SQL_REMOVE = "DELETE FROM pending_deletions WHERE chat_id = ? AND message_id = ?"
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+        # serializes transactions (periodic flusher vs boot purge/shutdown)
+        self._io_lock = threading.Lock()
+        # ordered (sql, params) operations not yet committed
+        self._ops: list[tuple[str, tuple]] = []
+
+    def load(self) -> list[tuple[int, int, float, str]]:
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+        return self._conn.execute(
+            "SELECT chat_id, message_id, deadline, msg_type FROM pending_deletions"
+        ).fetchall()
+
+    def add(self, chat_id: int, message_id: int, deadline: float, msg_type: str):
+        with self._lock:
+            self._ops.append((self.SQL_ADD, (chat_id, message_id, deadline, msg_type)))
+
+    def remove(self, chat_id: int, message_id: int):
+        with self._lock:
+            self._ops.append((self.SQL_REMOVE, (chat_id, message_id)))
+
+    def pending(self) -> int:
+        return len(self._ops)
+
+    def flush(self) -> int:
+        with self._io_lock:
+            if not self._conn:
+                return 0
+            with self._lock:
+                ops, self._ops = self._ops, []
+            if not ops:
+                return 0
+            try:
+                self._conn.execute("BEGIN")
+                for sql, params in ops:
+                    self._conn.execute(sql, params)
+                self._conn.execute("COMMIT")
+            except Exception as e:
+                if self._conn.in_transaction:
+                    self._conn.execute("ROLLBACK")
+                with self._lock:
+                    self._ops[:0] = ops
+                logging.error(f"AUTODELETE | queue flush failed | error={e}")
+                return 0
+            return len(ops)
+
+    def close(self):
+        self.flush()
+        with self._io_lock:
+            if self._conn:
+                self._conn.close()
+                self._conn = None
+
+
+AUTODELETE_STORE: AutoDeleteStore = (
+    SqliteAutoDeleteStore(CFG.autodelete_db_file)
+    if CFG.autodelete_persist
+    else InMemoryAutoDeleteStore()
+)
+
+
+def _schedule_deadline(chat_id: int, message_id: int, msg_type: str, deadline: float):
+    key = (chat_id, message_id)
+    previous = BOT_MESSAGES.get(key)
+    if previous:
+        BOT_MESSAGES_TYPES[previous[1]] -= 1
+    BOT_MESSAGES[key] = (deadline, msg_type)
+    BOT_MESSAGES_TYPES[msg_type] = BOT_MESSAGES_TYPES.get(msg_type, 0) + 1
+
+    heapq.heappush(BOT_MESSAGES_HEAP, (deadline, chat_id, message_id))
+    if BOT_MESSAGES_HEAP[0][0] == deadline:
+        # new earliest deadline — re-arm the cleanup sleep
+        BOT_MESSAGES_WAKEUP.set()
 
-BOT_MESSAGES_LOCK = asyncio.Lock()
+
+def schedule_message_deletion(chat_id: int, message_id: int, msg_type: str, ttl: float | None = None):
+    deadline = time.time() + (get_message_ttl(msg_type) if ttl is None else ttl)
+    _schedule_deadline(chat_id, message_id, msg_type, deadline)
+    AUTODELETE_STORE.add(chat_id, message_id, deadline, msg_type)
+
+
+def cancel_message_deletion(chat_id: int, message_id: int):
+    entry = BOT_MESSAGES.pop((chat_id, message_id), None)
+    if entry:
+        BOT_MESSAGES_TYPES[entry[1]] -= 1
+        AUTODELETE_STORE.remove(chat_id, message_id)
+
+
+def _pop_due_messages(now: float) -> list[tuple[int, int, str]]:
+    due = []
+    while BOT_MESSAGES_HEAP and BOT_MESSAGES_HEAP[0][0] <= now:
+        deadline, chat_id, message_id = heapq.heappop(BOT_MESSAGES_HEAP)
+        key = (chat_id, message_id)
+        entry = BOT_MESSAGES.get(key)
+        if not entry or entry[0] != deadline:
+            continue
+        del BOT_MESSAGES[key]
+        BOT_MESSAGES_TYPES[entry[1]] -= 1
+        due.append((chat_id, message_id, entry[1]))
+    return due
 
 # ================== LOCALIZATION ==================
 SUPPORTED_LANGS = {"ru", "en"}
@@ -692,18 +3070,57 @@ TEXTS = {
 
 
 
-async def bot_has_permissions(chat_id: int) -> dict[str, bool]:
-    try:
-        me = await bot.get_me()
-        member = await bot.get_chat_member(chat_id, me.id)
+# ================== BOT IDENTITY & PERMISSIONS CACHE (1.6.3) ==================
+# get_me is resolved once at startup; per-chat permissions are cached with a
+# TTL and refreshed from my_chat_member updates instead of two round-trips
+# (get_me + get_chat_member) per join event.
+BOT_ME: User | None = None
+PERMISSIONS_CACHE_TTL_SECONDS = 300
+# chat_id -> (fetched_at, {"delete": bool, "restrict": bool, "present": bool})
+PERMISSIONS_CACHE: dict[int, tuple[float, dict[str, bool]]] = {}
+# chat_id -> in-flight fetch, so a join burst triggers a single request
+PERMISSIONS_INFLIGHT: dict[int, asyncio.Task] = {}
 
-        can_delete = getattr(member, "can_delete_messages", False)
-        can_restrict = getattr(member, "can_restrict_members", False)
 
-        return {
-            "delete": bool(can_delete),
-            "restrict": bool(can_restrict),
-        }
+async def get_bot_id() -> int:
+    global BOT_ME
+    if BOT_ME is None:
+        BOT_ME = await bot.get_me()
+    return BOT_ME.id
+
+
+def _permissions_from_member(member) -> dict[str, bool]:
+    return {
+        "delete": bool(getattr(member, "can_delete_messages", False)),
+        "restrict": bool(getattr(member, "can_restrict_members", False)),
+        "present": getattr(member, "status", "left") not in {"left", "kicked"},
+    }
+
+
+async def _fetch_bot_permissions(chat_id: int) -> dict[str, bool]:
+    member = await bot.get_chat_member(chat_id, await get_bot_id())
+    perms = _permissions_from_member(member)
+    PERMISSIONS_CACHE[chat_id] = (time.time(), perms)
+    return perms
+
+
+async def bot_has_permissions(chat_id: int, refresh: bool = False) -> dict[str, bool]:
+    cached = PERMISSIONS_CACHE.get(chat_id)
+    if (
+        cached
+        and not refresh
+        and (time.time() - cached[0]) < PERMISSIONS_CACHE_TTL_SECONDS
+    ):
+        return cached[1]
+
+    task = PERMISSIONS_INFLIGHT.get(chat_id)
+    if task is None:
+        task = asyncio.create_task(_fetch_bot_permissions(chat_id))
+        PERMISSIONS_INFLIGHT[chat_id] = task
+        task.add_done_callback(lambda _: PERMISSIONS_INFLIGHT.pop(chat_id, None))
+
+    try:
+        return await asyncio.shield(task)
     except Exception as e:
         logging.warning(
             f"PERMISSIONS | failed to fetch | chat={chat_id} | error={e}"
@@ -714,6 +3131,61 @@ async def bot_has_permissions(chat_id: int) -> dict[str, bool]:
         }
 
 
+async def prefetch_bot_permissions():
+    if not CFG.allowed_chat_ids:
+        return
+    chat_ids = [chat_id for chat_id in CFG.allowed_chat_ids if owns_chat(chat_id)]
+    await asyncio.gather(
+        *(bot_has_permissions(chat_id, refresh=True) for chat_id in chat_ids)
+    )
+    logging.info(f"PERMISSIONS | prefetched | chats={len(chat_ids)}")
+
+
+def can_autodelete_in_chat(chat_id: int, own_message: bool = True) -> bool:
+    """
+    Cache-only check used before queuing a deletion.
+    Bots may always delete their own messages while they are in the chat;
+    user messages additionally need can_delete_messages.
+    Unknown chats are allowed — the API call will decide.
+    """
+    cached = PERMISSIONS_CACHE.get(chat_id)
+    if not cached:
+        return True
+    perms = cached[1]
+    if not perms.get("present", True):
+        return False
+    return own_message or perms["delete"]
+
+
+@dp.my_chat_member()
+async def bot_membership_changed(event: ChatMemberUpdated):
+    perms = _permissions_from_member(event.new_chat_member)
+    PERMISSIONS_CACHE[cast(int, event.chat.id)] = (time.time(), perms)
+    log_event(
+        "BOT_PERMISSIONS_UPDATED",
+        chat=event.chat.id,
+        status=event.new_chat_member.status,
+        delete=perms["delete"],
+        restrict=perms["restrict"]
+    )
+
+
+def track_bot_message(
+    chat_id: int,
+    message_id: int,
+    msg_type: str,
+    own_message: bool = True,
+    ttl: float | None = None
+):
+    if not can_autodelete_in_chat(chat_id, own_message):
+        logging.info(
+            f"AUTODELETE | skipped, no permission | chat={chat_id} | type={msg_type}"
+        )
+        return
+
+    schedule_message_deletion(chat_id, message_id, msg_type, ttl)
+
+
 def is_admin(user_id: int) -> bool:
     return user_id in CFG.admin_ids if CFG.admin_ids else False
 
@@ -759,32 +3231,40 @@ async def admin_reply(message: Message, text: str):
     except Exception:
         return
 
-    # В группе — автоудаление через 10 секунд
+    # В группе — автоудаление через 10 секунд (через общий планировщик)
     if message.chat.type != "private":
-        try:
-            await asyncio.sleep(10)
-            await msg.delete()
-            await message.delete()
-        except Exception:
-            pass
+        track_bot_message(message.chat.id, msg.message_id, "admin", ttl=ADMIN_REPLY_TTL_SECONDS)
+        track_bot_message(
+            message.chat.id,
+            message.message_id,
+            "admin_command",
+            own_message=False,
+            ttl=ADMIN_REPLY_TTL_SECONDS
+        )
         return
 
     # В личке — стандартная TTL-логика
-    async with BOT_MESSAGES_LOCK:
-        BOT_MESSAGES[msg.message_id] = (time.time(), "admin")
-        BOT_MESSAGES_CHAT_ID[msg.message_id] = message.chat.id
+    track_bot_message(message.chat.id, msg.message_id, "admin")
 
 
-def admin_control_keyboard(lang: str) -> InlineKeyboardMarkup:
+def _build_admin_control_keyboard(lang: str, welcome: bool, mute: bool, autodelete: bool) -> InlineKeyboardMarkup:
     def state(flag: bool) -> str:
         return t(lang, "state_on") if flag else t(lang, "state_off")
 
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=f"Welcome: {state(FEATURE_WELCOME_ENABLED)}", callback_data="admin:welcome")],
-        [InlineKeyboardButton(text=f"Mute: {state(FEATURE_MUTE_ENABLED)}", callback_data="admin:mute")],
-        [InlineKeyboardButton(text=f"Auto-delete: {state(FEATURE_AUTODELETE_ENABLED)}", callback_data="admin:autodelete")],
+        [InlineKeyboardButton(text=f"Welcome: {state(welcome)}", callback_data="admin:welcome")],
+        [InlineKeyboardButton(text=f"Mute: {state(mute)}", callback_data="admin:mute")],
+        [InlineKeyboardButton(text=f"Auto-delete: {state(autodelete)}", callback_data="admin:autodelete")],
         [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin:refresh")]
     ])
+
+
+def admin_control_keyboard(lang: str) -> InlineKeyboardMarkup:
+    key = (lang, FEATURE_WELCOME_ENABLED, FEATURE_MUTE_ENABLED, FEATURE_AUTODELETE_ENABLED)
+    keyboard = ADMIN_CONTROL_KEYBOARDS.get(key)
+    if keyboard is None:
+        keyboard = ADMIN_CONTROL_KEYBOARDS[key] = _build_admin_control_keyboard(lang, *key[1:])
+    return keyboard
 @dp.message(F.text == "/control")
 async def admin_control_panel(message: Message):
     if not message.from_user:
@@ -813,7 +3293,7 @@ def t(lang: str, key: str) -> str:
     return TEXTS.get(lang, TEXTS[DEFAULT_LANG])[key]
 
 
-def welcome_keyboard(lang: str) -> InlineKeyboardMarkup:
+def _build_welcome_keyboard(lang: str) -> InlineKeyboardMarkup:
     buttons = [
         [
             InlineKeyboardButton(
@@ -844,6 +3324,13 @@ def welcome_keyboard(lang: str) -> InlineKeyboardMarkup:
 
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
+
+def welcome_keyboard(lang: str) -> InlineKeyboardMarkup:
+    keyboard = WELCOME_KEYBOARDS.get(lang)
+    if keyboard is None:
+        keyboard = WELCOME_KEYBOARDS[lang] = _build_welcome_keyboard(lang)
+    return keyboard
+
 # v1.3.4 — show_about callback
 @dp.callback_query(F.data.startswith("about:"))
 async def show_about(callback: CallbackQuery):
@@ -865,9 +3352,7 @@ async def show_about(callback: CallbackQuery):
 
     msg = await callback.message.answer(text)
 
-    async with BOT_MESSAGES_LOCK:
-        BOT_MESSAGES[msg.message_id] = (time.time(), "about")
-        BOT_MESSAGES_CHAT_ID[cast(int, msg.message_id)] = cast(int, callback.message.chat.id)
+    track_bot_message(cast(int, callback.message.chat.id), msg.message_id, "about")
 
 
 def is_paid_like_chat(chat) -> bool:
@@ -887,43 +3372,91 @@ def is_paid_member(user_id: int, source: str | None = None) -> bool:
     if source == JoinSource.PAID:
         return True
 
-    record = USER_REGISTRY.get(user_id)
-    if not record:
-        return False
+    return REGISTRY_STORE.has_label(user_id, "paid_member")
 
-    labels = record.get("labels", set())
-    return isinstance(labels, set) and "paid_member" in labels
 
+# ================== PRE-RENDERED TEMPLATES (1.6.11) ==================
+# Welcome texts and keyboards only depend on (lang, source, bot_mode) and
+# config, so they are rendered once at startup / on /config_reload.
+# Per join we only escape the name (and invite link) and join strings.
+@dataclass(frozen=True)
+class WelcomeTemplate:
+    parts: tuple[str, ...]  # template split around {name}
+    before_invite: str
+    after_invite: str
+    show_invite: bool
+
+    def render(self, name: str, invite_url: str | None = None) -> str:
+        text = name.join(self.parts) + self.before_invite
+        if invite_url and self.show_invite:
+            text += f"\n\n🔗 <b>Invite link:</b>\n<code>{html.escape(invite_url)}</code>"
+        return text + self.after_invite
+
+
+WELCOME_TEMPLATES: dict[tuple[str, str, str], WelcomeTemplate] = {}
+WELCOME_KEYBOARDS: dict[str, InlineKeyboardMarkup] = {}
+# (lang, welcome, mute, autodelete) -> keyboard
+ADMIN_CONTROL_KEYBOARDS: dict[tuple[str, bool, bool, bool], InlineKeyboardMarkup] = {}
+_NAME_MARKER = "\x00"
+
+
+def _build_welcome_template(lang: str, source: str, mode: str) -> WelcomeTemplate:
+    test = mode == "test"
+    body = t(lang, "welcome").format(name=_NAME_MARKER, project=CFG.project_name)
+    if test:
+        body = (
+            "🧪 <i>Test mode</i>\n"
+            f"🧪 <i>Source: {source}</i>\n\n"
+            + body
+        )
 
-# --- v1.5.9.840: Centralized welcome builder ---
-def build_welcome_text(user, source: str, lang: str, invite_url: str | None = None) -> str:
-    raw_name = user.full_name or "User"
-    safe_name = html.escape(raw_name)
-
-    text = t(lang, "welcome").format(
-        name=safe_name,
-        project=CFG.project_name
+    before_invite = ""
+    badge = SOURCE_BADGES.get(source)
+    if badge and not test:
+        before_invite += f"\n\n<b>{badge}</b>"
+
+    after_invite = ""
+    if not test and source == JoinSource.DISCORD:
+        after_invite += "\n\n<i>Вы получили доступ как участник Discord‑сообщества проекта.</i>"
+
+    return WelcomeTemplate(
+        parts=tuple(body.split(_NAME_MARKER)),
+        before_invite=before_invite,
+        after_invite=after_invite,
+        show_invite=not test,
     )
 
-    badge = SOURCE_BADGES.get(source)
-    if badge and not is_test_mode():
-        text += f"\n\n<b>{badge}</b>"
 
-    if invite_url and not is_test_mode():
-        safe_invite = html.escape(invite_url)
-        text += f"\n\n🔗 <b>Invite link:</b>\n<code>{safe_invite}</code>"
+def prerender_templates():
+    sources = [v for k, v in vars(JoinSource).items() if not k.startswith("_")]
+    templates = {
+        (lang, source, mode): _build_welcome_template(lang, source, mode)
+        for lang in SUPPORTED_LANGS
+        for source in sources
+        for mode in ("prod", "test")
+    }
+    keyboards = {lang: _build_welcome_keyboard(lang) for lang in SUPPORTED_LANGS}
 
-    if (not is_test_mode()) and source == JoinSource.DISCORD:
-        text += "\n\n<i>Вы получили доступ как участник Discord‑сообщества проекта.</i>"
+    WELCOME_TEMPLATES.clear()
+    WELCOME_TEMPLATES.update(templates)
+    WELCOME_KEYBOARDS.clear()
+    WELCOME_KEYBOARDS.update(keyboards)
+    ADMIN_CONTROL_KEYBOARDS.clear()
+    logging.info(f"TEMPLATES | prerendered | welcome={len(templates)} | keyboards={len(keyboards)}")
+
+
+# --- v1.5.9.840: Centralized welcome builder ---
+def build_welcome_text(user, source: str, lang: str, invite_url: str | None = None) -> str:
+    key = (lang, source, CFG.bot_mode)
+    template = WELCOME_TEMPLATES.get(key)
+    if template is None:
+        # unknown source / lang — render once and keep it
+        template = WELCOME_TEMPLATES[key] = _build_welcome_template(*key)
+
+    return template.render(html.escape(user.full_name or "User"), invite_url)
 
-    if is_test_mode():
-        text = (
-            "🧪 <i>Test mode</i>\n"
-            f"🧪 <i>Source: {source}</i>\n\n"
-            + text
-        )
 
-    return text
+prerender_templates()
 
 
 async def apply_mute_if_needed(
@@ -988,6 +3521,388 @@ def detect_join_source_from_message(message: Message) -> str:
     return JoinSource.TELEGRAM
 
 
+# ================== JOIN TRACING (1.6.17) ==================
+# One trace per joining user, keyed by the same cid (chat:user) as log_event.
+# Spans: permissions → registry → mute → delay (queue wait) → send.
+# Finished traces are kept in memory for /trace_last and appended to
+# CFG.trace_file as OTLP/JSON ResourceSpans lines by trace_exporter().
+TRACE_LAST: deque = deque(maxlen=50)
+TRACE_PENDING: list[dict] = []
+TRACE_FLUSH_INTERVAL_SECONDS = 1
+TRACE_FILE_MAX_BYTES = 50 * 1024 * 1024
+
+
+def _otlp_attributes(attrs: dict) -> list[dict]:
+    result = []
+    for key, value in attrs.items():
+        if isinstance(value, bool):
+            wrapped = {"boolValue": value}
+        elif isinstance(value, int):
+            wrapped = {"intValue": str(value)}
+        elif isinstance(value, float):
+            wrapped = {"doubleValue": value}
+        else:
+            wrapped = {"stringValue": str(value)}
+        result.append({"key": key, "value": wrapped})
+    return result
+
+
+class _SpanTimer:
+    __slots__ = ("trace", "name", "attrs", "start_ns")
+
+    def __init__(self, trace: "JoinTrace", name: str, attrs: dict):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.start_ns = time.time_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        self.trace.add_span(self.name, self.start_ns, time.time_ns(), **self.attrs)
+        return False
+
+
+class JoinTrace:
+    __slots__ = (
+        "trace_id", "root_id", "chat_id", "user_id", "source", "start_ns",
+        "spans", "sampled", "finished", "status", "holds",
+    )
+
+    def __init__(self, chat_id: int, user_id: int, source: str, start_ns: int, sampled: bool = True):
+        self.trace_id = os.urandom(16).hex()
+        self.root_id = os.urandom(8).hex()
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.source = source
+        self.start_ns = start_ns
+        self.spans: list[tuple[str, int, int, dict]] = []
+        self.sampled = sampled
+        self.finished = False
+        self.status: str | None = None
+        # spans still running in parallel branches (e.g. mute vs. welcome send)
+        self.holds = 0
+
+    @property
+    def cid(self) -> str:
+        return f"{self.chat_id}:{self.user_id}"
+
+    def span(self, name: str, **attrs) -> _SpanTimer:
+        return _SpanTimer(self, name, attrs)
+
+    def add_span(self, name: str, start_ns: int, end_ns: int, **attrs):
+        if self.sampled and not self.finished:
+            self.spans.append((name, start_ns, end_ns, attrs))
+
+    def hold(self):
+        self.holds += 1
+
+    def release(self):
+        self.holds -= 1
+        if self.holds == 0 and self.status is not None:
+            self._emit()
+
+    def finish(self, status: str = "ok"):
+        if self.status is not None or not self.sampled:
+            return
+        self.status = status
+        if self.holds == 0:
+            self._emit()
+
+    def _emit(self):
+        self.finished = True
+        end_ns = time.time_ns()
+        TRACE_LAST.append((self, end_ns, self.status))
+        if CFG.trace_file:
+            TRACE_PENDING.extend(self._otlp_spans(end_ns, self.status))
+
+    def _otlp_spans(self, end_ns: int, status: str) -> list[dict]:
+        root = {
+            "traceId": self.trace_id,
+            "spanId": self.root_id,
+            "name": "join",
+            "kind": 2,  # SERVER
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(end_ns),
+            "attributes": _otlp_attributes({
+                "cid": self.cid,
+                "chat.id": self.chat_id,
+                "user.id": self.user_id,
+                "join.source": self.source,
+                "join.status": status,
+            }),
+            "status": {"code": 1 if status == "ok" else 2},
+        }
+        children = [
+            {
+                "traceId": self.trace_id,
+                "spanId": os.urandom(8).hex(),
+                "parentSpanId": self.root_id,
+                "name": name,
+                "kind": 1,  # INTERNAL
+                "startTimeUnixNano": str(start_ns),
+                "endTimeUnixNano": str(span_end_ns),
+                "attributes": _otlp_attributes(attrs),
+            }
+            for name, start_ns, span_end_ns, attrs in self.spans
+        ]
+        return [root] + children
+
+
+def start_join_trace(chat_id: int, user_id: int, source: str, start_ns: int) -> JoinTrace:
+    sampled = CFG.trace_sample_rate >= 1 or random.random() < CFG.trace_sample_rate
+    return JoinTrace(chat_id, user_id, source, start_ns, sampled)
+
+
+def traced(trace: JoinTrace, name: str, coro):
+    """Wrap a coroutine in a span; the trace is held open from creation until it ends."""
+    trace.hold()
+
+    async def run():
+        try:
+            with trace.span(name):
+                return await coro
+        finally:
+            trace.release()
+
+    return run()
+
+
+def _write_trace_batch(spans: list[dict]):
+    if os.path.exists(CFG.trace_file) and os.path.getsize(CFG.trace_file) > TRACE_FILE_MAX_BYTES:
+        os.replace(CFG.trace_file, CFG.trace_file + ".1")
+    payload = {
+        "resourceSpans": [{
+            "resource": {"attributes": _otlp_attributes({
+                "service.name": "welcome-bot",
+                "service.version": VERSION,
+            })},
+            "scopeSpans": [{"scope": {"name": "welcome_bot.join"}, "spans": spans}],
+        }]
+    }
+    with open(CFG.trace_file, "a", encoding="utf-8") as f:
+        f.write(json.dumps(payload, separators=(",", ":")) + "\n")
+
+
+async def trace_exporter():
+    while not shutdown_event.is_set():
+        await asyncio.sleep(TRACE_FLUSH_INTERVAL_SECONDS)
+        if not TRACE_PENDING:
+            continue
+        spans = TRACE_PENDING[:]
+        TRACE_PENDING.clear()
+        try:
+            await asyncio.to_thread(_write_trace_batch, spans)
+        except Exception as e:
+            logging.warning(f"TRACE | export failed | spans={len(spans)} | error={e}")
+
+
+def format_trace(trace: JoinTrace, end_ns: int, status: str) -> str:
+    total_ms = (end_ns - trace.start_ns) / 1e6
+    lines = [
+        f"<b>{trace.cid}</b> · {trace.source} · {status} · <b>{total_ms:.0f} ms</b>",
+    ]
+    for name, start_ns, span_end_ns, attrs in sorted(trace.spans, key=lambda span: span[1]):
+        offset_ms = (start_ns - trace.start_ns) / 1e6
+        duration_ms = (span_end_ns - start_ns) / 1e6
+        extra = "".join(f" {k}={v}" for k, v in attrs.items())
+        lines.append(
+            f"<code>+{offset_ms:7.1f} {name:<11} {duration_ms:8.1f} ms</code>{html.escape(extra)}"
+        )
+    return "\n".join(lines)
+
+
+# ================== JOIN PIPELINE (1.6.7) ==================
+# Mutes go out immediately and in parallel from the join handlers; welcomes
+# are queued per chat and drained by a bounded worker pool. Each chat has at
+# most one drainer, so per-chat order is preserved while chats progress
+# independently. The welcome delay is a due time, not a per-user sleep.
+@dataclass
+class WelcomeJob:
+    chat_id: int
+    user: User
+    source: str
+    invite_url: str | None
+    due_at: float  # time.monotonic()
+    autodelete: bool
+    use_image: bool
+    thread_id: int | None = None
+    trace: JoinTrace | None = None
+    enqueued_ns: int = field(default_factory=time.time_ns)
+
+
+JOIN_QUEUES: dict[int, deque[WelcomeJob]] = {}
+JOIN_DRAINERS: dict[int, asyncio.Task] = {}
+JOIN_WORKER_SEMAPHORE = asyncio.Semaphore(CFG.join_workers)
+
+
+def enqueue_welcome(job: WelcomeJob):
+    JOIN_QUEUES.setdefault(job.chat_id, deque()).append(job)
+    if job.chat_id not in JOIN_DRAINERS:
+        JOIN_DRAINERS[job.chat_id] = asyncio.create_task(_drain_join_queue(job.chat_id))
+
+
+async def _drain_join_queue(chat_id: int):
+    queue = JOIN_QUEUES[chat_id]
+    job = None
+    try:
+        while queue:
+            delay = queue[0].due_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            job = queue.popleft()
+            async with JOIN_WORKER_SEMAPHORE:
+                if job.trace:
+                    job.trace.add_span("delay", job.enqueued_ns, time.time_ns(), queued=len(queue))
+                await send_welcome(job)
+            job = None
+    except asyncio.CancelledError:
+        # shutdown: the job in hand is accounted for with the rest of the queue
+        if job is not None:
+            queue.appendleft(job)
+        raise
+    finally:
+        JOIN_DRAINERS.pop(chat_id, None)
+        if not queue:
+            JOIN_QUEUES.pop(chat_id, None)
+
+
+# ================== WELCOME IMAGE FILE_ID CACHE (1.6.12) ==================
+# WELCOME_IMAGE_URL may be a URL, a local file path or a ready file_id.
+# The first welcome uploads it; the file_id Telegram returns is persisted
+# (keyed by the configured source) and reused for every later welcome.
+# If Telegram rejects the cached file_id it is dropped and re-uploaded.
+WELCOME_IMAGE_CACHE_FILE = "welcome_image.json"
+WELCOME_IMAGE_FILE_ID: str | None = None
+WELCOME_IMAGE_LOCK = asyncio.Lock()
+
+
+def load_welcome_image_cache():
+    global WELCOME_IMAGE_FILE_ID
+    WELCOME_IMAGE_FILE_ID = None
+    if not CFG.welcome_image_url or not os.path.exists(WELCOME_IMAGE_CACHE_FILE):
+        return
+    try:
+        with open(WELCOME_IMAGE_CACHE_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except Exception as e:
+        logging.warning(f"WELCOME_IMAGE | cache load failed | error={e}")
+        return
+    if data.get("source") == CFG.welcome_image_url and data.get("file_id"):
+        WELCOME_IMAGE_FILE_ID = data["file_id"]
+        logging.info("WELCOME_IMAGE | cached file_id loaded")
+
+
+def _save_welcome_image_cache(source: str, file_id: str | None):
+    import tempfile
+
+    try:
+        dir_name = os.path.dirname(os.path.abspath(WELCOME_IMAGE_CACHE_FILE)) or "."
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=dir_name, delete=False) as tmp:
+            json.dump({"source": source, "file_id": file_id}, tmp)
+            temp_name = tmp.name
+        os.replace(temp_name, WELCOME_IMAGE_CACHE_FILE)
+    except Exception as e:
+        logging.warning(f"WELCOME_IMAGE | cache save failed | error={e}")
+
+
+def _welcome_image_input(source: str):
+    if os.path.isfile(source):
+        return FSInputFile(source)
+    # URL or an already known file_id — Telegram accepts both as a string
+    return source
+
+
+def _is_bad_file_id(error: TelegramBadRequest) -> bool:
+    text = str(error.message).lower()
+    return "file" in text and ("identifier" in text or "reference" in text or "file_id" in text)
+
+
+async def send_welcome_photo(chat_id: int, caption: str, reply_markup, thread_id: int | None):
+    global WELCOME_IMAGE_FILE_ID
+    source = cast(str, CFG.welcome_image_url)
+
+    file_id = WELCOME_IMAGE_FILE_ID
+    if file_id:
+        try:
+            return await bot.send_photo(
+                chat_id=chat_id,
+                photo=file_id,
+                caption=caption,
+                reply_markup=reply_markup,
+                message_thread_id=thread_id
+            )
+        except TelegramBadRequest as e:
+            if not _is_bad_file_id(e):
+                raise
+            logging.warning(f"WELCOME_IMAGE | cached file_id rejected, re-uploading | error={e.message}")
+            if WELCOME_IMAGE_FILE_ID == file_id:
+                WELCOME_IMAGE_FILE_ID = None
+
+    # one upload at a time; joins queued behind it reuse the new file_id
+    async with WELCOME_IMAGE_LOCK:
+        photo = WELCOME_IMAGE_FILE_ID or _welcome_image_input(source)
+        msg = await bot.send_photo(
+            chat_id=chat_id,
+            photo=photo,
+            caption=caption,
+            reply_markup=reply_markup,
+            message_thread_id=thread_id
+        )
+        if WELCOME_IMAGE_FILE_ID is None and msg.photo:
+            WELCOME_IMAGE_FILE_ID = msg.photo[-1].file_id
+            await asyncio.to_thread(_save_welcome_image_cache, source, WELCOME_IMAGE_FILE_ID)
+            logging.info(f"WELCOME_IMAGE | uploaded | file_id cached | chat={chat_id}")
+        return msg
+
+
+async def send_welcome(job: WelcomeJob):
+    if not FEATURE_WELCOME_ENABLED:
+        if job.trace:
+            job.trace.finish("welcome_disabled")
+        return
+
+    lang = detect_lang(job.user.language_code)
+    text = build_welcome_text(job.user, job.source, lang, job.invite_url)
+    send_start_ns = time.time_ns()
+
+    try:
+        if job.use_image and CFG.welcome_image_url:
+            msg = await send_welcome_photo(job.chat_id, text, welcome_keyboard(lang), job.thread_id)
+        else:
+            msg = await bot.send_message(
+                chat_id=job.chat_id,
+                text=text,
+                reply_markup=welcome_keyboard(lang),
+                message_thread_id=job.thread_id
+            )
+    except Exception as e:
+        logging.warning(
+            f"WELCOME FAILED | user={job.user.id} | chat={job.chat_id} | error={e}"
+        )
+        if job.trace:
+            job.trace.add_span("send", send_start_ns, time.time_ns(), error=type(e).__name__)
+            job.trace.finish("send_failed")
+        return
+
+    if job.trace:
+        job.trace.add_span("send", send_start_ns, time.time_ns(), image=job.use_image and bool(CFG.welcome_image_url))
+        job.trace.finish()
+
+    log_event(
+        "WELCOME_SENT",
+        user=job.user.id,
+        source=job.source,
+        chat=job.chat_id
+    )
+
+    if FEATURE_AUTODELETE_ENABLED and job.autodelete:
+        track_bot_message(job.chat_id, msg.message_id, "welcome")
+
+
 @dp.message(F.new_chat_members)
 async def welcome_new_user(message: Message):
     # Проверка разрешённого чата
@@ -997,7 +3912,9 @@ async def welcome_new_user(message: Message):
         )
         return
 
+    received_ns = time.time_ns()
     perms = await bot_has_permissions(cast(int, message.chat.id))
+    perms_done_ns = time.time_ns()
 
     paid_like = is_paid_like_chat(message.chat)
 
@@ -1012,12 +3929,15 @@ async def welcome_new_user(message: Message):
             f"delete={perms['delete']} restrict={perms['restrict']}"
         )
 
-    # Удаляем service-сообщение "пользователь вошёл"
+    # Удаляем service-сообщение "пользователь вошёл" (пакетно, через планировщик)
     if perms["delete"]:
-        try:
-            await message.delete()
-        except Exception:
-            pass
+        track_bot_message(
+            cast(int, message.chat.id),
+            message.message_id,
+            "service",
+            own_message=False,
+            ttl=SERVICE_MESSAGE_TTL_SECONDS
+        )
 
     if not message.new_chat_members:
         return
@@ -1029,100 +3949,90 @@ async def welcome_new_user(message: Message):
     if invite_obj and getattr(invite_obj, "invite_link", None):
         invite_url = invite_obj.invite_link
 
+    chat_id = cast(int, message.chat.id)
+    thread_id = message.message_thread_id if message.is_topic_message else None
+    mutes = []
+    unsent_traces = []
+    welcome_due_at = time.monotonic() + max(CFG.welcome_delay_seconds, 0)
+
     for user in message.new_chat_members:
         if user.is_bot:
             continue
-        logging.info(
-            f"JOIN_SOURCE | user={user.id} | source={source}"
-        )
+        log_event("JOIN_SOURCE", user=user.id, chat=message.chat.id, source=source)
+        trace = start_join_trace(chat_id, user.id, source, received_ns)
+        trace.add_span("permissions", received_ns, perms_done_ns)
 
         now = time.time()
-        last_time = WELCOME_CACHE.get(user.id)
-
-        if last_time and (now - last_time) < WELCOME_TTL_SECONDS:
+        if not await dedup_claim(WELCOME_CACHE, user.id, WELCOME_TTL_SECONDS, now):
             logging.info(
                 f"SKIP welcome | user={user.id} | duplicate join"
             )
+            trace.finish("duplicate")
             continue
 
-        WELCOME_CACHE[user.id] = now
-        if len(WELCOME_CACHE) > WELCOME_CACHE_MAX:
-            WELCOME_CACHE.clear()
-            logging.warning("CACHE | WELCOME_CACHE cleared (limit exceeded)")
-
         # --- 1.4.2: user registry with chat_id (protected with async lock)
-        async with REGISTRY_ASYNC_LOCK:
-            if user.id not in USER_REGISTRY:
-                labels: Set[str] = set()
-                if source == JoinSource.DISCORD:
-                    labels.add("discord_member")
-                if source == JoinSource.PAID:
-                    labels.add("paid_member")
+        with trace.span("registry"):
+            async with REGISTRY_ASYNC_LOCK:
+                record = registry_get(user.id)
+                if not record:
+                    labels: Set[str] = set()
+                    if source == JoinSource.DISCORD:
+                        labels.add("discord_member")
+                    if source == JoinSource.PAID:
+                        labels.add("paid_member")
 
-                USER_REGISTRY[user.id] = {
-                    "source": source,
-                    "labels": labels,
-                    "first_seen": now,
-                    "chat_id": cast(int, message.chat.id)
-                }
-                save_user_registry()
-                logging.info(
-                    f"USER_JOIN | user={user.id} | source={source}"
-                )
-            else:
-                record = USER_REGISTRY[user.id]
-                if source != record.get("source") and not REGISTRY_READ_ONLY:
+                    await registry_insert(user.id, {
+                        "source": source,
+                        "labels": labels,
+                        "first_seen": now,
+                        "chat_id": cast(int, message.chat.id)
+                    })
                     logging.info(
-                        f"REGISTRY | source updated | user={user.id} | {record.get('source')} → {source}"
+                        f"USER_JOIN | user={user.id} | source={source}"
                     )
-                    record["source"] = source
-                    if source == JoinSource.DISCORD:
-                        record["labels"].add("discord_member")
-                    if source == JoinSource.PAID:
-                        record["labels"].add("paid_member")
-                    save_user_registry()
                 else:
-                    logging.info(f"REGISTRY | read-only skip | user={user.id}")
-
-        await apply_mute_if_needed(
-            cast(int, message.chat.id),
-            cast(int, user.id),
-            source,
-            perms,
-            paid_like
+                    if source != record.get("source") and not REGISTRY_READ_ONLY:
+                        logging.info(
+                            f"REGISTRY | source updated | user={user.id} | {record.get('source')} → {source}"
+                        )
+                        await registry_set_source(user.id, source)
+                        if source == JoinSource.DISCORD:
+                            await registry_add_label(user.id, "discord_member")
+                        if source == JoinSource.PAID:
+                            await registry_add_label(user.id, "paid_member")
+                    else:
+                        logging.info(f"REGISTRY | read-only skip | user={user.id}")
+
+        mutes.append(
+            traced(trace, "mute", apply_mute_if_needed(
+                chat_id,
+                cast(int, user.id),
+                source,
+                perms,
+                paid_like
+            ))
         )
 
         if FEATURE_WELCOME_ENABLED:
-            log_event(
-                "WELCOME_SENT",
-                user=user.id,
+            enqueue_welcome(WelcomeJob(
+                chat_id=chat_id,
+                user=user,
                 source=source,
-                chat=message.chat.id
-            )
-
-            lang = detect_lang(user.language_code)
-            text = build_welcome_text(user, source, lang, invite_url)
-
-            if CFG.welcome_delay_seconds > 0:
-                await asyncio.sleep(float(CFG.welcome_delay_seconds))
-
-            if CFG.welcome_image_url:
-                msg = await bot.send_photo(
-                    chat_id=cast(int, message.chat.id),
-                    photo=CFG.welcome_image_url,
-                    caption=text,
-                    reply_markup=welcome_keyboard(lang)
-                )
-            else:
-                msg = await message.answer(
-                    text,
-                    reply_markup=welcome_keyboard(lang)
-                )
+                invite_url=invite_url,
+                due_at=welcome_due_at,
+                autodelete=not paid_like,
+                use_image=True,
+                thread_id=thread_id,
+                trace=trace
+            ))
+        else:
+            unsent_traces.append(trace)
 
-            async with BOT_MESSAGES_LOCK:
-                if FEATURE_AUTODELETE_ENABLED and not paid_like:
-                    BOT_MESSAGES[msg.message_id] = (time.time(), "welcome")
-                    BOT_MESSAGES_CHAT_ID[msg.message_id] = cast(int, message.chat.id)
+    # --- 1.6.7: all mutes of the join message go out in parallel
+    if mutes:
+        await asyncio.gather(*mutes)
+    for trace in unsent_traces:
+        trace.finish("welcome_disabled")
 
 
 # --- v1.3.9.18: Welcome for invite link & paid join approval ---
@@ -1149,21 +4059,19 @@ async def welcome_on_approved_join(event: ChatMemberUpdated):
             logging.info(f"SKIP approved join | chat_id={chat.id} | not allowed")
             return
 
+        trace = start_join_trace(cast(int, chat.id), user.id, source, time.time_ns())
+
         # Антидубль (используем тот же cache)
         now = time.time()
-        last_time = WELCOME_CACHE.get(user.id)
-        if last_time and (now - last_time) < WELCOME_TTL_SECONDS:
+        if not await dedup_claim(WELCOME_CACHE, user.id, WELCOME_TTL_SECONDS, now):
             logging.info(f"SKIP approved welcome | user={user.id} | duplicate")
+            trace.finish("duplicate")
             return
 
-        WELCOME_CACHE[user.id] = now
-        if len(WELCOME_CACHE) > WELCOME_CACHE_MAX:
-            WELCOME_CACHE.clear()
-            logging.warning("CACHE | WELCOME_CACHE cleared (limit exceeded)")
-
         # --- 1.5.9.830: Absolute Tribute protection + auto label sync (protected with async lock) ---
+        registry_start_ns = time.time_ns()
         async with REGISTRY_ASYNC_LOCK:
-            record = USER_REGISTRY.get(user.id)
+            record = registry_get(user.id)
 
             if not record:
                 labels: Set[str] = set()
@@ -1172,69 +4080,54 @@ async def welcome_on_approved_join(event: ChatMemberUpdated):
                 if source == JoinSource.PAID:
                     labels.add("paid_member")
 
-                USER_REGISTRY[user.id] = {
+                await registry_insert(user.id, {
                     "source": source,
                     "labels": labels,
                     "first_seen": now,
                     "chat_id": cast(int, chat.id)
-                }
-                save_user_registry()
+                })
                 logging.info(
                     f"USER_JOIN | user={user.id} | source={source}"
                 )
             else:
                 if source == JoinSource.PAID:
-                    labels = record.get("labels", set())
-                    if isinstance(labels, set) and "paid_member" not in labels:
-                        labels.add("paid_member")
-                        record["source"] = JoinSource.PAID
-                        save_user_registry()
+                    if await registry_add_label(user.id, "paid_member"):
+                        await registry_set_source(user.id, JoinSource.PAID)
                         logging.info(
                             f"PAID_AUTO_SYNC | user={user.id} | chat={chat.id}"
                         )
                 else:
                     logging.info(f"REGISTRY | existing user | user={user.id}")
+        trace.add_span("registry", registry_start_ns, time.time_ns())
 
         # --- sync mute logic for approved joins ---
-        perms = await bot_has_permissions(cast(int, chat.id))
+        with trace.span("permissions"):
+            perms = await bot_has_permissions(cast(int, chat.id))
         # paid-like detection must use chat context, not ChatMember object
         paid_like = is_paid_like_chat(chat)
 
-        await apply_mute_if_needed(
+        await traced(trace, "mute", apply_mute_if_needed(
             cast(int, chat.id),
             cast(int, user.id),
             source,
             perms,
             paid_like
-        )
+        ))
 
         if not FEATURE_WELCOME_ENABLED:
+            trace.finish("welcome_disabled")
             return
 
-        lang = detect_lang(user.language_code)
-        text = build_welcome_text(user, source, lang, invite_url)
-
-        try:
-            msg = await bot.send_message(
-                chat_id=cast(int, chat.id),
-                text=text,
-                reply_markup=welcome_keyboard(lang)
-            )
-
-            log_event(
-                "WELCOME_SENT",
-                user=user.id,
-                source=source,
-                chat=chat.id
-            )
-
-            async with BOT_MESSAGES_LOCK:
-                if FEATURE_AUTODELETE_ENABLED:
-                    BOT_MESSAGES[msg.message_id] = (time.time(), "welcome")
-                    BOT_MESSAGES_CHAT_ID[msg.message_id] = cast(int, chat.id)
-
-        except Exception as e:
-            logging.warning(f"WELCOME APPROVED FAILED | user={user.id} | error={e}")
+        enqueue_welcome(WelcomeJob(
+            chat_id=cast(int, chat.id),
+            user=user,
+            source=source,
+            invite_url=invite_url,
+            due_at=time.monotonic(),
+            autodelete=True,
+            use_image=False,
+            trace=trace
+        ))
 
 # --- 1.5.1: Helper for join source from member event ---
 def detect_join_source_from_member_event(event: ChatMemberUpdated) -> str:
@@ -1282,24 +4175,16 @@ async def show_rules(callback: CallbackQuery):
     now = time.time()
 
     # Silent anti-spam protection
-    last_time = RULES_CACHE.get(user_id)
-    if last_time and (now - last_time) < RULES_TTL_SECONDS:
+    if not await dedup_claim(RULES_CACHE, user_id, RULES_TTL_SECONDS, now):
         return
 
-    RULES_CACHE[user_id] = now
-    if len(RULES_CACHE) > RULES_CACHE_MAX:
-        RULES_CACHE.clear()
-        logging.warning("CACHE | RULES_CACHE cleared")
-
     rules_text = t(lang, "rules")
     if is_test_mode():
         rules_text = "🧪 <i>Test mode</i>\n\n" + rules_text
 
     msg = await callback.message.answer(rules_text)
 
-    async with BOT_MESSAGES_LOCK:
-        BOT_MESSAGES[msg.message_id] = (time.time(), "rules")
-        BOT_MESSAGES_CHAT_ID[cast(int, msg.message_id)] = cast(int, callback.message.chat.id)
+    track_bot_message(cast(int, callback.message.chat.id), msg.message_id, "rules")
 
 
 @dp.callback_query(F.data.startswith("admin:"))
@@ -1369,7 +4254,7 @@ async def version_cmd(message: Message):
     await message.answer(
         "ℹ️ <b>Welcome Bot</b>\n"
         f"Version: {VERSION}\n"
-        "Channel: Stable (1.5.x)"
+        "Channel: Stable (1.6.x)"
     )
 
 @dp.message(F.text == "/health")
@@ -1394,19 +4279,40 @@ async def health_check(message: Message):
         warnings.append("ALLOWED_CHAT_IDS is empty (all chats allowed)")
 
     status = "OK" if not warnings else "WARN"
+    # one call per message would have been needed without deleteMessages
+    delete_calls_saved = max(
+        sum(AUTODELETE_STATS[k] for k in ("deleted", "requested", "failed", "dropped"))
+        - AUTODELETE_STATS["api_calls"],
+        0,
+    )
 
     text = (
         f"🩺 <b>Welcome Bot — Health</b>\n\n"
         f"Status: {'✅ OK' if status == 'OK' else '⚠️ WARN'}\n"
         f"Version: {VERSION}\n"
         f"Mode: {CFG.bot_mode}\n"
-        f"Uptime: {uptime}s\n\n"
+        + (f"Shard: {SHARD_INDEX + 1}/{CFG.shard_workers}\n" if SHARD_INDEX is not None else "")
+        + f"Uptime: {uptime}s\n\n"
         "Permissions:\n"
         f"• Delete messages: {perms['delete']}\n"
         f"• Restrict members: {perms['restrict']}\n\n"
         "Runtime:\n"
-        f"• Active welcome messages: {sum(1 for m in BOT_MESSAGES.values() if m[1] == 'welcome')}\n"
-        f"• Active rules messages: {sum(1 for m in BOT_MESSAGES.values() if m[1] == 'rules')}\n"
+        f"• Active welcome messages: {BOT_MESSAGES_TYPES.get('welcome', 0)}\n"
+        f"• Active rules messages: {BOT_MESSAGES_TYPES.get('rules', 0)}\n"
+        f"• Pending auto-delete: {len(BOT_MESSAGES)}\n"
+        f"• Auto-deleted: {AUTODELETE_STATS['deleted']} "
+        f"+ {AUTODELETE_STATS['requested']} requested in batches "
+        f"(failed: {AUTODELETE_STATS['failed']}, dropped: {AUTODELETE_STATS['dropped']})\n"
+        f"• Delete API calls: {AUTODELETE_STATS['api_calls']} "
+        f"(saved by batching: {delete_calls_saved})\n"
+        f"• API calls throttled: {BOT_API_LIMITER.stats['throttled']} "
+        f"(RetryAfter: {BOT_API_LIMITER.stats['retry_after']}, "
+        f"dropped: {BOT_API_LIMITER.stats['dropped']})\n\n"
+        "Caches:\n"
+        f"• {WELCOME_CACHE.describe()}\n"
+        f"• {RULES_CACHE.describe()}\n"
+        f"• {KEYWORD_TRIGGER_CACHE.describe()}\n"
+        f"• {GLOBAL_RATE_LIMIT.describe()}\n"
     )
 
     if warnings:
@@ -1538,16 +4444,27 @@ async def registry_set_cmd(message: Message):
     action = parts[2]
     value = parts[3]
 
-    if target_user not in USER_REGISTRY:
+    # same lock as the join handlers (and /registry_stats check)
+    async with REGISTRY_ASYNC_LOCK:
+        record = registry_get(target_user)
+        if not record:
+            changed = None
+        elif action == "source":
+            changed = record["source"]
+            await registry_set_source(target_user, value)
+        elif action == "add_label":
+            changed = await registry_add_label(target_user, value)
+        elif action == "remove_label":
+            changed = await registry_remove_label(target_user, value)
+        else:
+            changed = None
+
+    if not record:
         await admin_reply(message, "❌ User not found in registry")
         return
 
-    record = USER_REGISTRY[target_user]
-
     if action == "source":
-        old = record["source"]
-        record["source"] = value
-        save_user_registry()
+        old = changed
         log_registry_mutation(
             message.from_user.id,
             target_user,
@@ -1558,12 +4475,9 @@ async def registry_set_cmd(message: Message):
         return
 
     if action == "add_label":
-        labels = record["labels"]
-        if value in labels:
+        if not changed:
             await admin_reply(message, "ℹ️ Label already exists")
             return
-        labels.add(value)
-        save_user_registry()
         log_registry_mutation(
             message.from_user.id,
             target_user,
@@ -1574,12 +4488,9 @@ async def registry_set_cmd(message: Message):
         return
 
     if action == "remove_label":
-        labels = record["labels"]
-        if value not in labels:
+        if not changed:
             await admin_reply(message, "ℹ️ Label not present")
             return
-        labels.remove(value)
-        save_user_registry()
         log_registry_mutation(
             message.from_user.id,
             target_user,
@@ -1610,7 +4521,7 @@ async def whois_cmd(message: Message):
     except ValueError:
         await admin_reply(message, "ℹ️ Usage: /whois <user_id>")
         return
-    user_info = USER_REGISTRY.get(user_id)
+    user_info = registry_get(user_id)
     if not user_info:
         await admin_reply(message, "ℹ️ User not found in registry")
         return
@@ -1632,185 +4543,1040 @@ async def whois_cmd(message: Message):
     )
     await admin_reply(message, reply_text)
 
-# ===== /export_registry admin command =====
-# ===== /export_registry admin command =====
-@dp.message(F.text == "/export_registry")
-async def export_registry_cmd(message: Message):
-    if not message.from_user or not is_admin(message.from_user.id):
-        return
-    if message.chat.type != "private":
-        await admin_reply(message, "🔒 Admin command available only in private chat")
-        return
+# ===== /export_registry admin command (1.6.19) =====
+# Rows are streamed by a worker thread into a temp file (CSV or JSONL,
+# optionally gzip) and sent as a document: memory stays flat and the
+# 4096-char message limit no longer applies.
+EXPORT_LOCK = asyncio.Lock()
+EXPORT_DOCUMENT_LIMIT_BYTES = 50 * 1024 * 1024  # cloud Bot API upload limit
+EXPORT_USAGE = (
+    "ℹ️ Usage: /export_registry [csv|jsonl] [gz] "
+    "[source=…] [label=…] [chat=…] [since=…] [until=…]\n"
+    "since/until: unix time or YYYY-MM-DD (UTC, until inclusive)"
+)
 
-    if not USER_REGISTRY:
-        await admin_reply(message, "ℹ️ Registry is empty")
-        return
 
-    lines = []
-    for uid, info in USER_REGISTRY.items():
-        source = info.get("source", "—")
-        labels = info.get("labels", set())
-        if isinstance(labels, set):
-            labels_str = ",".join(sorted(labels)) if labels else "—"
+def _parse_export_time(value: str, end_of_day: bool) -> float:
+    if value.isdigit():
+        return float(value)
+    from datetime import datetime, timezone
+    day = datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp()
+    return day + 86400 if end_of_day else day
+
+
+def parse_export_args(args: list[str]) -> tuple[str, bool, RegistryFilter]:
+    """`csv gz source=ads chat=-100…` → (fmt, gzip, filter). Raises ValueError."""
+    fmt, compress, fields = "csv", False, {}
+    for arg in args:
+        lowered = arg.lower()
+        if lowered in ("csv", "jsonl"):
+            fmt = lowered
+        elif lowered in ("gz", "gzip"):
+            compress = True
+        elif "=" in arg:
+            key, value = arg.split("=", 1)
+            key = key.lower()
+            if not value:
+                raise ValueError(arg)
+            if key == "source":
+                fields["source"] = value
+            elif key == "label":
+                fields["label"] = value
+            elif key == "chat":
+                fields["chat_id"] = int(value)
+            elif key == "since":
+                fields["since"] = _parse_export_time(value, end_of_day=False)
+            elif key == "until":
+                fields["until"] = _parse_export_time(value, end_of_day=True)
+            else:
+                raise ValueError(arg)
         else:
-            labels_str = str(labels)
-        first_seen = int(info["first_seen"])
-        chat_id = info["chat_id"]
-        lines.append(
-            f"{uid} | {source} | {labels_str} | {first_seen} | {chat_id}"
-        )
+            raise ValueError(arg)
+    return fmt, compress, RegistryFilter(**fields)
 
-    text = "<b>User Registry Export</b>\n\n" + "\n".join(lines)
-    await admin_reply(message, text)
 
-# ===== /registry_backup admin command =====
-@dp.message(F.text == "/registry_backup")
-async def registry_backup_cmd(message: Message):
-    if not message.from_user or not is_admin(message.from_user.id):
-        return
-    if message.chat.type != "private":
-        await admin_reply(message, "🔒 Admin command available only in private chat")
-        return
+def write_registry_export(path: str, fmt: str, compress: bool, flt: RegistryFilter) -> int:
+    """Stream matching rows to path. Runs in a worker thread; returns the row count."""
+    import csv
+    import gzip
 
-    if not os.path.exists(USER_REGISTRY_FILE):
-        await admin_reply(message, "ℹ️ Registry file not found")
-        return
+    rows = 0
+    if compress:
+        f = gzip.open(path, "wt", encoding="utf-8", newline="", compresslevel=6)
+    else:
+        f = open(path, "w", encoding="utf-8", newline="")
+    with f:
+        writer = csv.writer(f) if fmt == "csv" else None
+        if writer:
+            writer.writerow(("user_id", "source", "labels", "first_seen", "chat_id"))
+        for uid, info in REGISTRY_STORE.iter_filtered(flt):
+            labels = sorted(info["labels"])
+            if writer:
+                writer.writerow((uid, info["source"], ",".join(labels), int(info["first_seen"]), info["chat_id"]))
+            else:
+                f.write(json.dumps({
+                    "user_id": uid,
+                    "source": info["source"],
+                    "labels": labels,
+                    "first_seen": info["first_seen"],
+                    "chat_id": info["chat_id"],
+                }, ensure_ascii=False) + "\n")
+            rows += 1
+    return rows
 
-    backup_name = f"user_registry_backup_{int(time.time())}.json"
-    try:
-        import shutil
-        shutil.copy(USER_REGISTRY_FILE, backup_name)
-        await admin_reply(message, f"✅ Backup created:\n<code>{backup_name}</code>")
-    except Exception as e:
-        await admin_reply(message, f"❌ Backup failed: {e}")
 
-# ===== /registry_stats admin command =====
-@dp.message(F.text == "/registry_stats")
-async def registry_stats_cmd(message: Message):
+@dp.message(F.text.regexp(r"^/export_registry(\s+.*)?$"))
+async def export_registry_cmd(message: Message):
     if not message.from_user or not is_admin(message.from_user.id):
         return
     if message.chat.type != "private":
         await admin_reply(message, "🔒 Admin command available only in private chat")
         return
 
-    total = len(USER_REGISTRY)
-    sources = {}
-    for info in USER_REGISTRY.values():
-        src = info.get("source", "unknown")
-        sources[src] = sources.get(src, 0) + 1
-
-    lines = [f"👥 Total users: {total}\n"]
-    for src, count in sources.items():
-        lines.append(f"• {src}: {count}")
-
-    await admin_reply(message, "<b>Registry stats</b>\n\n" + "\n".join(lines))
+    try:
+        fmt, compress, flt = parse_export_args((message.text or "").split()[1:])
+    except ValueError:
+        await admin_reply(message, EXPORT_USAGE)
+        return
 
-# ===== Admin helper: get photo file_id (test-mode only) =====
-@dp.message(F.photo)
-async def get_photo_file_id(message: Message):
-    if not message.from_user or not is_admin(message.from_user.id):
+    if REGISTRY_LAZY is not None:
+        await admin_reply(message, "⏳ Registry is still loading, try again shortly")
         return
-    if not is_test_mode():
+    if not REGISTRY_STORE.count():
+        await admin_reply(message, "ℹ️ Registry is empty")
         return
-
-    photos = message.photo
-    if not photos:
+    if EXPORT_LOCK.locked():
+        await admin_reply(message, "⏳ Export already running")
         return
 
-    photo = photos[-1]  # highest resolution
-    file_id = photo.file_id
+    import tempfile
 
-    await message.answer(
-        "🆔 <b>Telegram file_id</b>\n\n"
-        f"<code>{file_id}</code>\n\n"
-        "ℹ️ Используйте этот file_id в WELCOME_IMAGE_URL"
-    )
+    ext = fmt + (".gz" if compress else "")
+    async with EXPORT_LOCK:
+        # the sqlite export reads through its own connection — commit first
+        await asyncio.to_thread(REGISTRY_STORE.flush)
+        fd, path = tempfile.mkstemp(prefix="registry_export_", suffix="." + ext)
+        os.close(fd)
+        try:
+            started = time.monotonic()
+            rows = await asyncio.to_thread(write_registry_export, path, fmt, compress, flt)
+            size = os.path.getsize(path)
+            log_event(
+                "REGISTRY_EXPORT",
+                rows=rows,
+                bytes=size,
+                format=ext,
+                filter=flt.describe(),
+                seconds=round(time.monotonic() - started, 3),
+            )
 
-# ===== v1.5.9.500 — Keyword trigger: "Хранилище" =====
+            if not rows:
+                await admin_reply(message, "ℹ️ No users match the filter")
+                return
+            if size > EXPORT_DOCUMENT_LIMIT_BYTES and not CFG.telegram_api_url:
+                await admin_reply(
+                    message,
+                    f"❌ Export is {size // (1024 * 1024)} MB — over the 50 MB upload limit. "
+                    "Use gz or a narrower filter."
+                )
+                return
 
-# --- Storage trigger anti-spam cache (v1.5.9.510) ---
-STORAGE_TRIGGER_CACHE: dict[int, float] = {}  # chat_id -> last trigger timestamp
-GLOBAL_RATE_LIMIT: dict[str, float] = {}
-GLOBAL_RATE_LIMIT_TTL = 2
+            filename = f"user_registry_{time.strftime('%Y%m%d-%H%M%S')}.{ext}"
+            await message.answer_document(
+                FSInputFile(path, filename=filename),
+                caption=f"📤 Registry export: {rows} users\nfilter: <code>{html.escape(flt.describe())}</code>",
+            )
+        except Exception as e:
+            logging.error(f"REGISTRY_EXPORT | failed | error={e}")
+            await admin_reply(message, f"❌ Export failed: {html.escape(str(e))}")
+        finally:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
 
-# --- Global rate limiter helper ---
-def global_rate_limit(key: str, ttl: int = GLOBAL_RATE_LIMIT_TTL) -> bool:
-    now = time.time()
-    last = GLOBAL_RATE_LIMIT.get(key)
-    if last and (now - last) < ttl:
-        return False
-    GLOBAL_RATE_LIMIT[key] = now
-    return True
-# TTL зависит от режима (test/prod)
-def get_storage_trigger_ttl() -> int:
-    return 60 if is_test_mode() else 300  # 1 минута в test, 5 минут в prod
-@dp.message(F.text)
-async def storage_keyword_trigger(message: Message):
-    if not message.text:
+# ================== REGISTRY BACKUPS (1.6.23) ==================
+# Online backups into BACKUP_DIR, gzip-compressed in a worker thread:
+#   full — every row: json captures the rows on the loop in chunks, compact
+#          copies its columns; sqlite copies a WAL snapshot via the backup API
+#   diff — current rows of the uids changed since the last full backup
+#          (REGISTRY_BACKUP_DIRTY), restored on top of that full backup
+# manifest.json lists every backup with its sha256. Retention keeps the
+# newest BACKUP_KEEP_FULL full backups and BACKUP_KEEP_DIFF diffs of each.
+BACKUP_MANIFEST_FILE = "manifest.json"
+BACKUP_LOCK = asyncio.Lock()
+# base of the next diff; the dirty set lives in memory, so only a full
+# backup taken by this process qualifies
+BACKUP_LAST_FULL: str | None = None
+BACKUP_SCHEDULER_TICK_SECONDS = 60
+BACKUP_LIST_LIMIT = 15
+# rows captured per event loop step for a full json backup
+BACKUP_CAPTURE_CHUNK = 5_000
+
+
+def _backup_path(name: str) -> str:
+    return os.path.join(CFG.backup_dir, name)
+
+
+def load_backup_manifest() -> list[dict]:
+    """Manifest entries, oldest first."""
+    try:
+        with open(_backup_path(BACKUP_MANIFEST_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)["backups"]
+    except FileNotFoundError:
+        return []
+
+
+def _save_backup_manifest(entries: list[dict]):
+    import tempfile
+
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=CFG.backup_dir, delete=False) as tmp:
+        json.dump({"backups": entries}, tmp, ensure_ascii=False, indent=1)
+        tmp.flush()
+        os.fsync(tmp.fileno())
+    os.replace(tmp.name, _backup_path(BACKUP_MANIFEST_FILE))
+
+
+def _prune_backups(entries: list[dict]) -> list[dict]:
+    """Apply retention: delete dropped files, return the kept entries."""
+    fulls = [entry["name"] for entry in entries if entry["kind"] == "full"]
+    keep_full = set(fulls[-CFG.backup_keep_full:])
+    diffs: dict[str, int] = {}
+    kept = []
+    for entry in reversed(entries):
+        if entry["kind"] == "full":
+            keep = entry["name"] in keep_full
+        else:
+            diffs[entry["base"]] = diffs.get(entry["base"], 0) + 1
+            keep = entry["base"] in keep_full and diffs[entry["base"]] <= CFG.backup_keep_diff
+        if keep:
+            kept.append(entry)
+            continue
+        try:
+            os.remove(_backup_path(entry["name"]))
+        except FileNotFoundError:
+            pass
+        logging.info(f"BACKUP | pruned | name={entry['name']}")
+    kept.reverse()
+    return kept
+
+
+def _record_backup(entry: dict):
+    _save_backup_manifest(_prune_backups(load_backup_manifest() + [entry]))
+
+
+def _sha256_file(path: str) -> str:
+    import hashlib
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _new_backup_name(kind: str, ext: str) -> str:
+    stamp = time.strftime("%Y%m%d-%H%M%S", time.gmtime())
+    name = f"registry-{kind}-{stamp}.{ext}"
+    n = 1
+    while os.path.exists(_backup_path(name)):
+        n += 1
+        name = f"registry-{kind}-{stamp}-{n}.{ext}"
+    return name
+
+
+def _write_backup_rows(path: str, header: dict, rows: list[tuple]) -> int:
+    """Header line + snapshot-format rows, gzip JSONL. Runs in a worker thread."""
+    import gzip
+
+    with gzip.open(path, "wb", compresslevel=6) as f:
+        f.write(json.dumps(header).encode() + b"\n")
+        for uid, source, labels, first_seen, chat_id in rows:
+            f.write(json.dumps(
+                {"uid": uid, "source": source, "labels": labels, "first_seen": first_seen, "chat_id": chat_id},
+                ensure_ascii=False,
+                separators=(",", ":"),
+            ).encode() + b"\n")
+    return len(rows)
+
+
+def _read_backup_rows(path: str) -> list[tuple[int, UserRegistryItem]]:
+    import gzip
+
+    with gzip.open(path, "rb") as f:
+        _read_registry_header(f)
+        return [
+            (int(data["uid"]), _decode_registry_row(data))
+            for data in (json.loads(line) for line in f if line.strip())
+        ]
+
+
+def _write_sqlite_backup(path: str) -> int:
+    """Backup API copy into a temp file, gzipped into path. Runs in a worker thread."""
+    import gzip
+    import shutil
+    import tempfile
+
+    fd, raw = tempfile.mkstemp(prefix="registry_backup_", suffix=".sqlite", dir=CFG.backup_dir)
+    os.close(fd)
+    try:
+        REGISTRY_STORE.backup_to(raw)
+        conn = sqlite3.connect(raw)
+        try:
+            users = conn.execute(SqliteRegistryStore.SQL_COUNT).fetchone()[0]
+        finally:
+            conn.close()
+        with open(raw, "rb") as src, gzip.open(path, "wb", compresslevel=6) as dest:
+            shutil.copyfileobj(src, dest, 1 << 20)
+    finally:
+        os.unlink(raw)
+    return users
+
+
+def _gunzip_backup(path: str) -> str:
+    import gzip
+    import shutil
+    import tempfile
+
+    fd, raw = tempfile.mkstemp(prefix="registry_restore_", suffix=".sqlite", dir=CFG.backup_dir)
+    with os.fdopen(fd, "wb") as dest, gzip.open(path, "rb") as src:
+        shutil.copyfileobj(src, dest, 1 << 20)
+    return raw
+
+
+def _verify_backup(entry: dict):
+    path = _backup_path(entry["name"])
+    if not os.path.exists(path):
+        raise ValueError(f"{entry['name']}: file missing")
+    if _sha256_file(path) != entry["sha256"]:
+        raise ValueError(f"{entry['name']}: checksum mismatch")
+
+
+async def _capture_backup_rows() -> list[tuple]:
+    """
+    Rows for a full json/compact backup without stalling the event loop.
+    A CompactRegistry is copied in one cheap step and decoded in a worker
+    thread. A dict registry is captured in chunks; uids changed while the
+    loop ran in between are in REGISTRY_BACKUP_DIRTY (cleared by the caller)
+    and are re-read at the end, so the rows match the registry at that step.
+    """
+    if isinstance(USER_REGISTRY, CompactRegistry):
+        return await asyncio.to_thread(_capture_registry_rows, USER_REGISTRY.copy())
+
+    uids = list(USER_REGISTRY)
+    rows: dict[int, tuple] = {}
+    for i in range(0, len(uids), BACKUP_CAPTURE_CHUNK):
+        for uid in uids[i:i + BACKUP_CAPTURE_CHUNK]:
+            info = USER_REGISTRY.get(uid)
+            if info is not None:
+                rows[uid] = (uid, info["source"], list(info["labels"]), info["first_seen"], info["chat_id"])
+        await asyncio.sleep(0)
+    for uid in REGISTRY_BACKUP_DIRTY:
+        info = USER_REGISTRY.get(uid)
+        if info is not None:
+            rows[uid] = (uid, info["source"], list(info["labels"]), info["first_seen"], info["chat_id"])
+    return list(rows.values())
+
+
+async def create_registry_backup(kind: str = "full") -> dict:
+    """
+    Take a backup and return its manifest entry. A diff is taken as a full
+    backup when this process has no full one yet, and always on a sharded
+    registry (changes made by the other shards are not tracked here).
+    """
+    global BACKUP_LAST_FULL, REGISTRY_BACKUP_CHANGED
+    async with BACKUP_LOCK:
+        if kind == "diff" and (BACKUP_LAST_FULL is None or CFG.shard_workers > 1):
+            kind = "full"
+        os.makedirs(CFG.backup_dir, exist_ok=True)
+        sqlite_full = kind == "full" and CFG.registry_backend == "sqlite"
+        name = _new_backup_name(kind, "sqlite.gz" if sqlite_full else "jsonl.gz")
+        path = _backup_path(name)
+        header = {REGISTRY_META_KEY: REGISTRY_SCHEMA_VERSION, "kind": kind, "created": time.time()}
+        started = time.monotonic()
+
+        # changes made from here on belong to the next backup
+        dirty = REGISTRY_BACKUP_DIRTY.copy()
+        changed, REGISTRY_BACKUP_CHANGED = REGISTRY_BACKUP_CHANGED, False
+        try:
+            if sqlite_full:
+                REGISTRY_BACKUP_DIRTY.clear()
+                # the backup API copies committed pages only
+                await asyncio.to_thread(REGISTRY_STORE.flush)
+                users = await asyncio.to_thread(_write_sqlite_backup, path)
+            elif kind == "full":
+                REGISTRY_BACKUP_DIRTY.clear()
+                rows = await _capture_backup_rows()
+                users = await asyncio.to_thread(_write_backup_rows, path, header, rows)
+            else:
+                header["base"] = BACKUP_LAST_FULL
+                rows = []
+                for uid in dirty:
+                    info = REGISTRY_STORE.get(uid)
+                    if info:
+                        rows.append((uid, info["source"], sorted(info["labels"]), info["first_seen"], info["chat_id"]))
+                users = await asyncio.to_thread(_write_backup_rows, path, header, rows)
+
+            entry = {
+                "name": name,
+                "kind": kind,
+                "format": "sqlite" if sqlite_full else "jsonl",
+                "base": header.get("base"),
+                "created": round(header["created"], 3),
+                "users": users,
+                "bytes": os.path.getsize(path),
+                "sha256": await asyncio.to_thread(_sha256_file, path),
+            }
+            await asyncio.to_thread(_record_backup, entry)
+        except BaseException:
+            REGISTRY_BACKUP_DIRTY.update(dirty)
+            REGISTRY_BACKUP_CHANGED = REGISTRY_BACKUP_CHANGED or changed
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            raise
+
+        if kind == "full":
+            BACKUP_LAST_FULL = name
+        log_event(
+            "REGISTRY_BACKUP",
+            name=name,
+            kind=kind,
+            users=users,
+            bytes=entry["bytes"],
+            seconds=round(time.monotonic() - started, 3),
+        )
+        return entry
+
+
+async def restore_registry_backup(name: str) -> int:
+    """
+    Replace the registry with a backup (a diff is applied on top of its
+    full backup) after verifying the checksums. Returns the user count.
+    Raises ValueError when the backup is unknown, damaged or incompatible.
+    """
+    global BACKUP_LAST_FULL, REGISTRY_BACKUP_CHANGED
+    async with BACKUP_LOCK:
+        entries = {entry["name"]: entry for entry in await asyncio.to_thread(load_backup_manifest)}
+        entry = entries.get(name)
+        if entry is None:
+            raise ValueError(f"{name}: not in manifest")
+        chain = [entry]
+        if entry["kind"] == "diff":
+            if entry["base"] not in entries:
+                raise ValueError(f"{entry['base']}: base backup not in manifest")
+            chain.insert(0, entries[entry["base"]])
+        full = chain[0]
+        if (full["format"] == "sqlite") != (CFG.registry_backend == "sqlite"):
+            raise ValueError(f"{full['format']} backup does not match REGISTRY_BACKEND={CFG.registry_backend}")
+        for item in chain:
+            await asyncio.to_thread(_verify_backup, item)
+
+        started = time.monotonic()
+        diff_rows = []
+        if entry["kind"] == "diff":
+            diff_rows = await asyncio.to_thread(_read_backup_rows, _backup_path(entry["name"]))
+
+        # joins and /registry_set wait until the restored state is persisted
+        async with REGISTRY_ASYNC_LOCK:
+            if full["format"] == "sqlite":
+                raw = await asyncio.to_thread(_gunzip_backup, _backup_path(full["name"]))
+                try:
+                    await asyncio.to_thread(REGISTRY_STORE.restore_from, raw)
+                finally:
+                    os.unlink(raw)
+            else:
+                rows = await asyncio.to_thread(_read_backup_rows, _backup_path(full["name"]))
+                # swapped in one loop step: handlers never see a half-restored registry
+                USER_REGISTRY.clear()
+                aggregates = RegistryAggregates()
+                for uid, info in rows:
+                    USER_REGISTRY[uid] = info
+                    aggregates.add(info)
+                REGISTRY_STORE.aggregates = aggregates
+
+            for uid, info in diff_rows:
+                REGISTRY_STORE.insert(uid, info)
+
+            # the dirty set no longer describes changes since BACKUP_LAST_FULL
+            REGISTRY_BACKUP_DIRTY.clear()
+            BACKUP_LAST_FULL = None
+            REGISTRY_BACKUP_CHANGED = True
+
+            if CFG.registry_backend == "sqlite":
+                await asyncio.to_thread(REGISTRY_STORE.flush)
+            elif not await compact_user_registry():
+                # the swap bypassed the journal — only the snapshot persists it
+                raise RuntimeError("restored in memory, but the snapshot write failed (see log)")
+
+        users = REGISTRY_STORE.count()
+        log_event(
+            "REGISTRY_RESTORE",
+            name=name,
+            base=full["name"] if entry["kind"] == "diff" else None,
+            users=users,
+            seconds=round(time.monotonic() - started, 3),
+        )
+        return users
+
+
+async def registry_backup_scheduler():
+    full_every = CFG.backup_full_interval_hours * 3600
+    diff_every = CFG.backup_diff_interval_minutes * 60
+    if not full_every and not diff_every:
         return
-    chat_id = cast(int, message.chat.id)
-    now = time.time()
 
-    if not global_rate_limit(f"storage:{chat_id}", 1):
+    entries = await asyncio.to_thread(load_backup_manifest)
+    last_full = max((e["created"] for e in entries if e["kind"] == "full"), default=0.0)
+    last_backup = max((e["created"] for e in entries), default=0.0)
+    while not shutdown_event.is_set():
+        await asyncio.sleep(BACKUP_SCHEDULER_TICK_SECONDS)
+        if REGISTRY_LAZY is not None:
+            # a backup taken mid-load would miss the rows still on disk
+            continue
+        now = time.time()
+        if full_every and now - last_full >= full_every:
+            kind = "full"
+        elif diff_every and now - last_backup >= diff_every and REGISTRY_BACKUP_CHANGED:
+            kind = "diff"
+        else:
+            continue
+        try:
+            entry = await create_registry_backup(kind)
+        except Exception as e:
+            logging.error(f"BACKUP | scheduled {kind} failed | error={e}")
+            continue
+        if entry["kind"] == "full":
+            last_full = entry["created"]
+        last_backup = entry["created"]
+
+
+# ===== /registry_backup admin command =====
+@dp.message(F.text.regexp(r"^/registry_backup(\s+(full|diff|list))?$"))
+async def registry_backup_cmd(message: Message):
+    if not message.from_user or not is_admin(message.from_user.id):
+        return
+    if message.chat.type != "private":
+        await admin_reply(message, "🔒 Admin command available only in private chat")
         return
 
-    import re
+    parts = (message.text or "").split()
+    kind = parts[1] if len(parts) > 1 else "full"
+
+    if kind == "list":
+        entries = await asyncio.to_thread(load_backup_manifest)
+        if not entries:
+            await admin_reply(message, "ℹ️ No backups yet")
+            return
+        lines = [
+            f"• <code>{e['name']}</code> — {e['users']} users, {max(e['bytes'] // 1024, 1)} KB"
+            for e in reversed(entries[-BACKUP_LIST_LIMIT:])
+        ]
+        more = f"\n… +{len(entries) - BACKUP_LIST_LIMIT} older" if len(entries) > BACKUP_LIST_LIMIT else ""
+        await admin_reply(message, f"🗄 Backups ({len(entries)}):\n" + "\n".join(lines) + more)
+        return
 
-    text_lower = message.text.lower()
+    if REGISTRY_LAZY is not None:
+        await admin_reply(message, "⏳ Registry is still loading, try again shortly")
+        return
+    if BACKUP_LOCK.locked():
+        await admin_reply(message, "⏳ Backup already running")
+        return
 
-    # React only if the word "хранилище" (any ending) exists
-    if not re.search(r"\bхранилищ\w*\b", text_lower):
+    try:
+        entry = await create_registry_backup(kind)
+    except Exception as e:
+        await admin_reply(message, f"❌ Backup failed: {html.escape(str(e))}")
         return
 
-    ttl = get_storage_trigger_ttl()
-    last = STORAGE_TRIGGER_CACHE.get(chat_id)
-    if last and (now - last) < ttl:
+    note = "\nℹ️ No full backup from this process yet — took a full one" if entry["kind"] != kind else ""
+    await admin_reply(
+        message,
+        f"✅ Backup created ({entry['kind']}, {entry['users']} users, "
+        f"{max(entry['bytes'] // 1024, 1)} KB):\n<code>{entry['name']}</code>{note}"
+    )
+
+# ===== /registry_restore admin command =====
+@dp.message(F.text.regexp(r"^/registry_restore(\s+.*)?$"))
+async def registry_restore_cmd(message: Message):
+    if not message.from_user or not is_admin(message.from_user.id):
+        return
+    if message.chat.type != "private":
+        await admin_reply(message, "🔒 Admin command available only in private chat")
         return
 
-    STORAGE_TRIGGER_CACHE[chat_id] = now
+    parts = (message.text or "").split()
+    if len(parts) != 2:
+        await admin_reply(message, "ℹ️ Usage: /registry_restore <name> (see /registry_backup list)")
+        return
+    name = parts[1]
 
-    # Register user message for unified TTL deletion
-    async with BOT_MESSAGES_LOCK:
-        BOT_MESSAGES[message.message_id] = (time.time(), "storage_user")
-        BOT_MESSAGES_CHAT_ID[message.message_id] = chat_id
-    logging.info(f"STORAGE_TRIGGER | chat={chat_id} | ttl={ttl}")
+    if REGISTRY_READ_ONLY:
+        await admin_reply(
+            message,
+            "⛔ Registry is read-only. Mutations are disabled."
+        )
+        return
+    if REGISTRY_LAZY is not None:
+        await admin_reply(message, "⏳ Registry is still loading, try again shortly")
+        return
+    if BACKUP_LOCK.locked():
+        await admin_reply(message, "⏳ Backup already running")
+        return
 
-    # Ignore commands
-    if message.text.startswith("/"):
+    try:
+        users = await restore_registry_backup(name)
+    except ValueError as e:
+        await admin_reply(message, f"⛔ Restore refused: {html.escape(str(e))}")
+        return
+    except Exception as e:
+        logging.error(f"BACKUP | restore failed | name={name} | error={e}")
+        await admin_reply(message, f"❌ Restore failed: {html.escape(str(e))}")
         return
 
-    # Ignore if chat not allowed
-    if not is_allowed_chat(cast(int, message.chat.id)):
+    log_registry_mutation(message.from_user.id, 0, "restore", f"backup={name} users={users}")
+    await admin_reply(message, f"✅ Registry restored from <code>{html.escape(name)}</code> ({users} users)")
+
+# ===== /registry_stats admin command =====
+# v1.6.20 — answered from RegistryStore.stats() counters; `<chat_id>` scopes
+# to one chat, `check` recounts from scratch and repairs drifted counters
+REGISTRY_STATS_TOP = 10
+REGISTRY_STATS_DAYS = 7
+
+
+def _format_counts(title: str, counts: dict, limit: int = REGISTRY_STATS_TOP) -> list[str]:
+    if not counts:
+        return []
+    lines = [f"\n<b>{title}</b>"]
+    ranked = sorted(counts.items(), key=lambda kv: (-kv[1], str(kv[0])))
+    for key, count in ranked[:limit]:
+        lines.append(f"• {html.escape(str(key))}: {count}")
+    if len(ranked) > limit:
+        lines.append(f"… +{len(ranked) - limit} more")
+    return lines
+
+
+def _format_recent_days(days: dict[str, int]) -> list[str]:
+    today = time.time()
+    recent = [registry_join_day(today - i * 86400) for i in range(REGISTRY_STATS_DAYS)]
+    lines = [f"\n<b>Joins, last {REGISTRY_STATS_DAYS} days (UTC)</b>"]
+    lines.extend(f"• {day}: {days.get(day, 0)}" for day in recent)
+    return lines
+
+
+@dp.message(F.text.regexp(r"^/registry_stats(\s+(-?\d+|check))?$"))
+async def registry_stats_cmd(message: Message):
+    if not message.from_user or not is_admin(message.from_user.id):
+        return
+    if message.chat.type != "private":
+        await admin_reply(message, "🔒 Admin command available only in private chat")
         return
 
+    parts = (message.text or "").split()
+    arg = parts[1] if len(parts) > 1 else None
+
+    if arg == "check" and REGISTRY_LAZY is not None:
+        await admin_reply(message, "⏳ Registry is still loading, try again shortly")
+        return
+    if arg == "check" and isinstance(REGISTRY_STORE, SqliteRegistryStore) and not REGISTRY_STORE.batch_commits:
+        await admin_reply(message, "ℹ️ Sharded registry: counters are recounted from the database on every query")
+        return
+    if arg == "check":
+        started = time.monotonic()
+        # mutations wait behind the lock: live counters and the recount
+        # describe the same registry state, so any drift is real
+        async with REGISTRY_ASYNC_LOCK:
+            # sqlite recounts through its own connection — commit first
+            await asyncio.to_thread(REGISTRY_STORE.flush)
+            fresh = await asyncio.to_thread(REGISTRY_STORE.recount)
+            live = await asyncio.to_thread(REGISTRY_STORE.stats)
+            drift = live.diff(fresh)
+            if drift:
+                REGISTRY_STORE.aggregates = fresh
+        log_event(
+            "REGISTRY_STATS_CHECK",
+            level=logging.WARNING if drift else logging.INFO,
+            drift=len(drift),
+            seconds=round(time.monotonic() - started, 3),
+        )
+        if not drift:
+            await admin_reply(message, f"✅ Counters consistent ({fresh.all.total} users)")
+            return
+        shown = "\n".join(html.escape(line) for line in drift[:20])
+        more = f"\n… +{len(drift) - 20} more" if len(drift) > 20 else ""
+        await admin_reply(
+            message,
+            f"⚠️ {len(drift)} counters drifted — replaced by recount:\n<code>{shown}</code>{more}"
+        )
+        return
+
+    # sharded sqlite answers with a full recount — keep it off the loop
+    stats = await asyncio.to_thread(REGISTRY_STORE.stats)
+    if arg is not None:
+        chat_id = int(arg)
+        counts = stats.chats.get(chat_id)
+        if counts is None:
+            await admin_reply(message, f"ℹ️ No registry users for chat <code>{chat_id}</code>")
+            return
+        lines = [f"<b>Registry stats — chat <code>{chat_id}</code></b>\n", f"👥 Users: {counts.total}"]
+    else:
+        counts = stats.all
+        lines = ["<b>Registry stats</b>\n", f"👥 Total users: {counts.total}"]
+
+    lines += _format_counts("Sources", counts.sources)
+    lines += _format_counts("Labels", counts.labels)
+    if arg is None:
+        lines += _format_counts("Chats", stats.chat_totals())
+    lines += _format_recent_days(counts.days)
+    if REGISTRY_LAZY is not None:
+        lines.append(f"\n⏳ Loading from disk, {REGISTRY_LAZY.pending()} rows left — counts are partial")
+
+    await admin_reply(message, "\n".join(lines))
+
+# ===== v1.6.17 — /trace_last admin command =====
+@dp.message(F.text.regexp(r"^/trace_last(\s+\d+)?$"))
+async def trace_last_cmd(message: Message):
+    if not message.from_user or not is_admin(message.from_user.id):
+        return
+    if message.chat.type != "private":
+        await admin_reply(message, "🔒 Admin command available only in private chat")
+        return
+
+    parts = (message.text or "").split()
+    count = min(max(int(parts[1]), 1), 10) if len(parts) > 1 else 1
+    traces = list(TRACE_LAST)[-count:]
+    if not traces:
+        await admin_reply(message, "ℹ️ No join traces yet")
+        return
+
+    blocks = [format_trace(trace, end_ns, status) for trace, end_ns, status in reversed(traces)]
+    await admin_reply(message, "🧭 <b>Last join traces</b>\n\n" + "\n\n".join(blocks))
+
+
+# ===== v1.6.11 — /config_reload admin command =====
+# Bound at startup (Bot session, sockets, storage files, worker processes,
+# backup schedule): /config_reload rejects changes to these instead of
+# reporting success while the old values stay in effect.
+CONFIG_RESTART_ONLY_FIELDS = (
+    "bot_token",
+    "telegram_api_url",
+    "registry_backend",
+    "registry_db_file",
+    "registry_lazy_load",
+    "autodelete_persist",
+    "autodelete_db_file",
+    "update_mode",
+    "webhook_url",
+    "webhook_path",
+    "webhook_host",
+    "webhook_port",
+    "webhook_secret",
+    "shard_workers",
+    "shared_state_db",
+    "lease_ttl_seconds",
+    "metrics_port",
+    "metrics_host",
+    "backup_dir",
+    "backup_full_interval_hours",
+    "backup_diff_interval_minutes",
+)
+
+
+@dp.message(F.text == "/config_reload")
+async def config_reload_cmd(message: Message):
+    global CFG, JOIN_WORKER_SEMAPHORE
+    if not message.from_user or not is_admin(message.from_user.id):
+        return
+    if message.chat.type != "private":
+        await admin_reply(message, "🔒 Admin command available only in private chat")
+        return
+
+    try:
+        load_dotenv(override=True)
+        new_cfg = load_config()
+        restart_only = [
+            name.upper() for name in CONFIG_RESTART_ONLY_FIELDS
+            if getattr(new_cfg, name) != getattr(CFG, name)
+        ]
+        if restart_only:
+            raise RuntimeError(f"применяются только после рестарта: {', '.join(restart_only)}")
+        previous, CFG = CFG, new_cfg
+        try:
+            triggers = load_keyword_triggers()
+        except Exception:
+            CFG = previous
+            raise
+        prerender_templates()
+        load_welcome_image_cache()
+        configure_rate_limiter()
+        if CFG.join_workers != previous.join_workers:
+            # jobs already waiting finish on the old pool, new ones use the new size
+            JOIN_WORKER_SEMAPHORE = asyncio.Semaphore(CFG.join_workers)
+    except Exception as e:
+        logging.error(f"CONFIG | reload failed | error={e}")
+        await admin_reply(message, f"❌ Config reload failed: <code>{html.escape(str(e))}</code>")
+        return
+
+    log_event("CONFIG_RELOADED", admin=message.from_user.id, mode=CFG.bot_mode, triggers=triggers)
+    await admin_reply(
+        message,
+        "🔄 <b>Config reloaded</b>\n\n"
+        f"• Mode: {CFG.bot_mode}\n"
+        f"• Keyword triggers: {triggers}\n"
+        f"• Welcome templates: {len(WELCOME_TEMPLATES)}\n"
+        f"• API limits: {CFG.rate_limit_global_per_second:g}/s, "
+        f"{CFG.rate_limit_group_per_minute:g}/min per group\n"
+        f"• Join workers: {CFG.join_workers}\n"
+        + (f"\n⚠️ Applied to shard {SHARD_INDEX + 1}/{CFG.shard_workers} only\n" if SHARD_INDEX is not None else "")
+        + "\nℹ️ Restart required for: " + ", ".join(name.upper() for name in CONFIG_RESTART_ONLY_FIELDS)
+    )
+
+
+# ===== /registry_flush admin command =====
+@dp.message(F.text == "/registry_flush")
+async def registry_flush_cmd(message: Message):
+    if not message.from_user or not is_admin(message.from_user.id):
+        return
+    if message.chat.type != "private":
+        await admin_reply(message, "🔒 Admin command available only in private chat")
+        return
+
+    started = time.monotonic()
+    flushed = await asyncio.to_thread(REGISTRY_STORE.flush)
+    elapsed_ms = int((time.monotonic() - started) * 1000)
+
+    await admin_reply(
+        message,
+        "<b>Registry flush</b>\n\n"
+        f"Records written: {flushed}\n"
+        f"Pending: {REGISTRY_STORE.pending()}\n"
+        f"Duration: {elapsed_ms} ms"
+    )
+
+# ===== Admin helper: get photo file_id (test-mode only) =====
+@dp.message(F.photo)
+async def get_photo_file_id(message: Message):
+    if not message.from_user or not is_admin(message.from_user.id):
+        return
+    if not is_test_mode():
+        return
+
+    photos = message.photo
+    if not photos:
+        return
+
+    photo = photos[-1]  # highest resolution
+    file_id = photo.file_id
+
+    await message.answer(
+        "🆔 <b>Telegram file_id</b>\n\n"
+        f"<code>{file_id}</code>\n\n"
+        "ℹ️ Используйте этот file_id в WELCOME_IMAGE_URL"
+    )
+
+# ===== v1.6.10 — Keyword trigger engine (replaces the hard-coded "Хранилище" trigger) =====
+# Triggers come from CFG.triggers_file (JSON). Every keyword of every trigger
+# is compiled once into a single alternation with one named group per
+# trigger, so a message is scanned in one pass regardless of trigger count.
+# Keywords ending with "*" match as a stem ("хранилищ*" → хранилище, хранилища…),
+# all others as a whole word.
+@dataclass(frozen=True)
+class KeywordTrigger:
+    id: str
+    keywords: tuple[str, ...]
+    responses: dict[str, str]  # lang -> HTML text
+    buttons: tuple[dict, ...] = ()  # {"text": {lang: str}, "url": str}
+    keyboards: dict[str, InlineKeyboardMarkup] = field(default_factory=dict)  # prebuilt per lang
+    cooldown_seconds: int = 300
+    test_cooldown_seconds: int = 60
+    delete_user_message: bool = True
+
+    def cooldown(self) -> int:
+        return self.test_cooldown_seconds if is_test_mode() else self.cooldown_seconds
+
+    def text(self, lang: str) -> str:
+        return self.responses.get(lang) or self.responses.get(DEFAULT_LANG) or next(iter(self.responses.values()))
+
+    def keyboard(self, lang: str) -> InlineKeyboardMarkup | None:
+        return self.keyboards.get(lang) or self.keyboards.get(DEFAULT_LANG)
+
+
+def _build_trigger_keyboard(buttons: tuple[dict, ...], lang: str) -> InlineKeyboardMarkup:
+    rows = []
+    for button in buttons:
+        labels = button["text"]
+        label = labels.get(lang) or labels.get(DEFAULT_LANG) or next(iter(labels.values()))
+        rows.append([InlineKeyboardButton(text=label, url=button["url"])])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+DEFAULT_KEYWORD_TRIGGERS = [
+    {
+        "id": "storage",
+        "keywords": ["хранилищ*", "storage"],
+        "responses": {
+            "ru": "📦 <b>Хранилище проекта</b>\n\nДоступ к материалам доступен по кнопке ниже:",
+            "en": "📦 <b>Project storage</b>\n\nUse the button below to access the materials:",
+        },
+        "buttons": [
+            {"text": {"ru": "📦 Хранилище", "en": "📦 Storage"}, "url": "{storage_url}"},
+        ],
+        "cooldown_seconds": 300,
+        "test_cooldown_seconds": 60,
+    }
+]
+
+KEYWORD_TRIGGERS: dict[str, KeywordTrigger] = {}
+KEYWORD_TRIGGER_PATTERN: re.Pattern | None = None
+
+
+def _parse_keyword_trigger(raw: dict) -> KeywordTrigger:
+    trigger_id = str(raw["id"])
+    if not trigger_id.isidentifier():
+        raise ValueError(f"trigger id must be an identifier: {trigger_id!r}")
+    keywords = tuple(str(k).strip().lower() for k in raw["keywords"] if str(k).strip())
+    if not keywords or not raw.get("responses"):
+        raise ValueError(f"trigger {trigger_id!r} needs keywords and responses")
+    buttons = tuple(
+        {"text": b["text"], "url": b["url"].format(storage_url=CFG.storage_url)}
+        for b in raw.get("buttons", [])
+    )
+    return KeywordTrigger(
+        id=trigger_id,
+        keywords=keywords,
+        responses=dict(raw["responses"]),
+        buttons=buttons,
+        keyboards={lang: _build_trigger_keyboard(buttons, lang) for lang in SUPPORTED_LANGS} if buttons else {},
+        cooldown_seconds=int(raw.get("cooldown_seconds", 300)),
+        test_cooldown_seconds=int(raw.get("test_cooldown_seconds", 60)),
+        delete_user_message=bool(raw.get("delete_user_message", True)),
+    )
+
+
+def _compile_keyword_pattern(triggers: dict[str, KeywordTrigger]) -> re.Pattern | None:
+    groups = []
+    for trigger in triggers.values():
+        alternatives = []
+        # longer keywords first so a stem never shadows a longer literal
+        for keyword in sorted(trigger.keywords, key=len, reverse=True):
+            if keyword.endswith("*"):
+                alternatives.append(re.escape(keyword[:-1]) + r"\w*")
+            else:
+                alternatives.append(re.escape(keyword))
+        groups.append(f"(?P<{trigger.id}>{'|'.join(alternatives)})")
+    if not groups:
+        return None
+    return re.compile(r"\b(?:" + "|".join(groups) + r")\b", re.IGNORECASE)
+
+
+def load_keyword_triggers(path: str | None = None) -> int:
+    global KEYWORD_TRIGGERS, KEYWORD_TRIGGER_PATTERN
+    path = path or CFG.triggers_file
+    raw_triggers = DEFAULT_KEYWORD_TRIGGERS
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        raw_triggers = data.get("triggers", []) if isinstance(data, dict) else data
+
+    triggers: dict[str, KeywordTrigger] = {}
+    for raw in raw_triggers:
+        trigger = _parse_keyword_trigger(raw)
+        triggers[trigger.id] = trigger
+
+    # build fully, then swap — handlers never see a half-loaded engine
+    pattern = _compile_keyword_pattern(triggers)
+    KEYWORD_TRIGGERS, KEYWORD_TRIGGER_PATTERN = triggers, pattern
+    # entries must outlive the longest cooldown, or it is silently cut short;
+    # resized in place so running cooldowns survive /config_reload
+    KEYWORD_TRIGGER_CACHE.ttl = max(
+        (max(t.cooldown_seconds, t.test_cooldown_seconds) for t in triggers.values()),
+        default=KEYWORD_TRIGGER_DEFAULT_TTL,
+    )
+    logging.info(f"TRIGGERS | loaded={len(triggers)} | file={path if os.path.exists(path) else 'builtin'}")
+    return len(triggers)
+
+
+def match_keyword_triggers(text: str) -> list[KeywordTrigger]:
+    """Distinct triggers found in the text, in order of first appearance."""
+    if KEYWORD_TRIGGER_PATTERN is None:
+        return []
+    found: dict[str, KeywordTrigger] = {}
+    for match in KEYWORD_TRIGGER_PATTERN.finditer(text):
+        trigger_id = match.lastgroup
+        if trigger_id and trigger_id not in found:
+            found[trigger_id] = KEYWORD_TRIGGERS[trigger_id]
+    return list(found.values())
+
+
+# --- Trigger anti-spam cache (v1.5.9.510) ---
+# (trigger_id, chat_id) -> last trigger timestamp; entries live for the
+# longest configured cooldown (TTL set by load_keyword_triggers)
+KEYWORD_TRIGGER_DEFAULT_TTL = 3600
+KEYWORD_TRIGGER_CACHE = ExpiringCache("keyword_trigger", KEYWORD_TRIGGER_DEFAULT_TTL, 10_000)
+
+load_keyword_triggers()
+GLOBAL_RATE_LIMIT_TTL = 2
+GLOBAL_RATE_LIMIT = ExpiringCache("global_rate_limit", GLOBAL_RATE_LIMIT_TTL, 50_000)
+
+# --- Global rate limiter helper ---
+def global_rate_limit(key: str, ttl: int = GLOBAL_RATE_LIMIT_TTL) -> bool:
+    now = time.time()
+    last = GLOBAL_RATE_LIMIT.get(key)
+    if last and (now - last) < ttl:
+        return False
+    GLOBAL_RATE_LIMIT[key] = now
+    return True
+
+
+# Commands and disallowed chats are rejected by the filter, before any text work
+@dp.message(F.text, ~F.text.startswith("/"), F.chat.func(lambda chat: is_allowed_chat(chat.id)))
+async def keyword_trigger(message: Message):
+    text = message.text or ""
+    triggers = match_keyword_triggers(text)
+    if not triggers:
+        return
+
+    chat_id = cast(int, message.chat.id)
+    if not global_rate_limit(f"trigger:{chat_id}", 1):
+        return
+
+    now = time.time()
+    trigger = None
+    for candidate in triggers:
+        last = KEYWORD_TRIGGER_CACHE.get((candidate.id, chat_id))
+        if not last or (now - last) >= candidate.cooldown():
+            trigger = candidate
+            break
+    if trigger is None:
+        return
+
+    KEYWORD_TRIGGER_CACHE[(trigger.id, chat_id)] = now
+
+    # Register user message for unified TTL deletion
+    if trigger.delete_user_message:
+        track_bot_message(chat_id, message.message_id, f"{trigger.id}_user", own_message=False)
+    log_event("KEYWORD_TRIGGER", trigger=trigger.id, chat=chat_id, cooldown=trigger.cooldown())
+
     lang = DEFAULT_LANG
     if message.from_user:
         lang = detect_lang(message.from_user.language_code)
 
     try:
         msg = await message.answer(
-            "📦 <b>Хранилище проекта</b>\n\n"
-            "Доступ к материалам доступен по кнопке ниже:",
-            reply_markup=InlineKeyboardMarkup(
-                inline_keyboard=[
-                    [
-                        InlineKeyboardButton(
-                            text=t(lang, "btn_storage"),
-                            url=CFG.storage_url
-                        )
-                    ]
-                ]
-            )
+            trigger.text(lang),
+            reply_markup=trigger.keyboard(lang),
         )
 
         # --- unified auto-delete via BOT_MESSAGES (TTL split aware) ---
-        async with BOT_MESSAGES_LOCK:
-            BOT_MESSAGES[msg.message_id] = (time.time(), "storage")
-            BOT_MESSAGES_CHAT_ID[msg.message_id] = chat_id
+        track_bot_message(chat_id, msg.message_id, trigger.id)
 
     except Exception as e:
-        logging.warning(f"STORAGE_TRIGGER | failed | error={e}")
-@dp.message(F.text.startswith("/"))
+        logging.warning(f"KEYWORD_TRIGGER | failed | trigger={trigger.id} | error={e}")
+
+
+# private only: in groups the hint would stay behind, untracked by auto-delete
+@dp.message(F.text.startswith("/"), F.chat.type == "private")
 async def unknown_command(message: Message):
     if not message.from_user:
         return
@@ -1822,72 +5588,150 @@ async def unknown_command(message: Message):
         )
 
 
+async def _delete_messages_individually(chat_id: int, message_ids: list[int]):
+    for msg_id in message_ids:
+        AUTODELETE_STATS["api_calls"] += 1
+        try:
+            await bot.delete_message(chat_id=chat_id, message_id=msg_id)
+            AUTODELETE_STATS["deleted"] += 1
+        except Exception as e:
+            AUTODELETE_STATS["failed"] += 1
+            logging.warning(
+                f"CLEANUP | delete failed | chat={chat_id} | msg_id={msg_id} | error={e}"
+            )
+
+
+def _is_per_message_delete_error(error: Exception) -> bool:
+    """True if one undeletable ID failed the batch (too old, not found, ...)."""
+    if not isinstance(error, TelegramBadRequest):
+        return False
+    text = str(error.message).lower()
+    return "message" in text and ("can't be deleted" in text or "not found" in text or "id_invalid" in text)
+
+
+async def delete_messages_bulk(chat_id: int, message_ids: list[int]):
+    """
+    Delete messages of one chat with deleteMessages (≤100 IDs per call).
+    If one undeletable message fails the batch, its IDs are retried one by
+    one; chat-wide errors (kicked, no rights, network) would fail every
+    retry the same way, so the batch is dropped instead.
+    """
+    for i in range(0, len(message_ids), DELETE_MESSAGES_BATCH_MAX):
+        chunk = message_ids[i:i + DELETE_MESSAGES_BATCH_MAX]
+        if len(chunk) == 1:
+            await _delete_messages_individually(chat_id, chunk)
+            continue
+
+        AUTODELETE_STATS["api_calls"] += 1
+        try:
+            await bot.delete_messages(chat_id=chat_id, message_ids=chunk)
+        except Exception as e:
+            if not _is_per_message_delete_error(e):
+                AUTODELETE_STATS["dropped"] += len(chunk)
+                logging.warning(
+                    f"CLEANUP | bulk delete failed, batch dropped | chat={chat_id} | "
+                    f"count={len(chunk)} | error={e}"
+                )
+                continue
+            logging.warning(
+                f"CLEANUP | bulk delete failed, retrying per message | chat={chat_id} | "
+                f"count={len(chunk)} | error={e}"
+            )
+            await _delete_messages_individually(chat_id, chunk)
+            continue
+
+        AUTODELETE_STATS["requested"] += len(chunk)
+
+
 async def cleanup_bot_messages():
     while not shutdown_event.is_set():
-        now = time.time()
-        to_delete: list[int] = []
-
-        async with BOT_MESSAGES_LOCK:
-            for msg_id, (ts, msg_type) in BOT_MESSAGES.items():
-                # unified TTL policy for all message types (bot + user-triggered)
-                ttl = get_message_ttl(msg_type)
-                if (now - ts) > ttl:
-                    to_delete.append(msg_id)
-
-        for msg_id in to_delete:
-            chat_id = BOT_MESSAGES_CHAT_ID.get(msg_id)
-            if not chat_id:
+        by_chat: dict[int, list[int]] = {}
+        for chat_id, msg_id, _ in _pop_due_messages(time.time() + AUTODELETE_LOOKAHEAD_SECONDS):
+            by_chat.setdefault(chat_id, []).append(msg_id)
+
+        if by_chat:
+            await asyncio.gather(
+                *(delete_messages_bulk(chat_id, ids) for chat_id, ids in by_chat.items())
+            )
+            for chat_id, ids in by_chat.items():
+                for msg_id in ids:
+                    AUTODELETE_STORE.remove(chat_id, msg_id)
+
+        # sleep exactly until the next deadline (or until an earlier one is scheduled)
+        BOT_MESSAGES_WAKEUP.clear()
+        timeout = None
+        if BOT_MESSAGES_HEAP:
+            timeout = BOT_MESSAGES_HEAP[0][0] - time.time()
+            if timeout <= 0:
                 continue
-            try:
-                await bot.delete_message(
-                    chat_id=cast(int, chat_id),
-                    message_id=cast(int, msg_id)
-                )
-            except Exception as e:
-                logging.warning(f"CLEANUP | delete failed | msg_id={msg_id} | error={e}")
+        try:
+            await asyncio.wait_for(BOT_MESSAGES_WAKEUP.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
 
-            async with BOT_MESSAGES_LOCK:
-                BOT_MESSAGES.pop(msg_id, None)
-                BOT_MESSAGES_CHAT_ID.pop(msg_id, None)
+async def restore_autodelete_queue():
+    """Reload persisted deletions; purge overdue ones in bulk before polling starts."""
+    try:
+        rows = await asyncio.to_thread(AUTODELETE_STORE.load)
+    except Exception as e:
+        logging.error(f"AUTODELETE | queue load failed | error={e}")
+        return
 
-        # check more frequently for better TTL precision
-        await asyncio.sleep(5)
+    now = time.time()
+    overdue: dict[int, list[int]] = {}
+    restored = 0
+    for chat_id, msg_id, deadline, msg_type in rows:
+        if not owns_chat(chat_id):
+            # another shard's queue (shared file)
+            continue
+        if deadline <= now:
+            overdue.setdefault(chat_id, []).append(msg_id)
+        else:
+            _schedule_deadline(chat_id, msg_id, msg_type, deadline)
+            restored += 1
 
-async def cleanup_caches():
+    if overdue:
+        await asyncio.gather(
+            *(delete_messages_bulk(chat_id, ids) for chat_id, ids in overdue.items())
+        )
+        for chat_id, ids in overdue.items():
+            for msg_id in ids:
+                AUTODELETE_STORE.remove(chat_id, msg_id)
+        await asyncio.to_thread(AUTODELETE_STORE.flush)
+
+    logging.info(
+        f"AUTODELETE | queue restored | pending={restored} | "
+        f"overdue_purged={sum(len(ids) for ids in overdue.values())}"
+    )
+
+
+async def autodelete_store_flusher():
     while not shutdown_event.is_set():
-        now = time.time()
+        await asyncio.sleep(AUTODELETE_FLUSH_INTERVAL_SECONDS)
+        if AUTODELETE_STORE.pending():
+            await asyncio.to_thread(AUTODELETE_STORE.flush)
+
 
+async def cleanup_caches():
+    while not shutdown_event.is_set():
         try:
-            # welcome cache
-            expired = [uid for uid, ts in WELCOME_CACHE.items() if (now - ts) > WELCOME_TTL_SECONDS]
-            for uid in expired:
-                WELCOME_CACHE.pop(uid, None)
-
-            # rules cache
-            expired = [uid for uid, ts in RULES_CACHE.items() if (now - ts) > RULES_TTL_SECONDS]
-            for uid in expired:
-                RULES_CACHE.pop(uid, None)
-
-            # storage trigger cache (chat-based)
-            ttl = get_storage_trigger_ttl()
-            expired_chats = [
-                cid for cid, ts in STORAGE_TRIGGER_CACHE.items()
-                if (now - ts) > ttl
-            ]
-            for cid in expired_chats:
-                STORAGE_TRIGGER_CACHE.pop(cid, None)
-
-            # global rate limit cleanup
-            expired_rl = [
-                k for k, ts in GLOBAL_RATE_LIMIT.items()
-                if (now - ts) > GLOBAL_RATE_LIMIT_TTL
-            ]
-            for k in expired_rl:
-                GLOBAL_RATE_LIMIT.pop(k, None)
+            # v1.6.9: head-only sweeps, O(expired) instead of O(N)
+            for cache in (
+                WELCOME_CACHE,
+                RULES_CACHE,
+                KEYWORD_TRIGGER_CACHE,
+                GLOBAL_RATE_LIMIT,
+                BOT_API_LIMITER.chat_buckets,
+            ):
+                cache.sweep()
+            if SHARED_DEDUP is not None:
+                await asyncio.to_thread(
+                    SHARED_DEDUP.purge, time.time() - SHARED_DEDUP_RETENTION_SECONDS
+                )
         except Exception as e:
             logging.warning(f"CACHE | cleanup failed | error={e}")
 
-        await asyncio.sleep(300)  # каждые 5 минут
+        await asyncio.sleep(CACHE_SWEEP_INTERVAL_SECONDS)
 
 shutdown_event = asyncio.Event()
 
@@ -1896,55 +5740,482 @@ def _handle_shutdown():
     logging.info("SHUTDOWN | signal received")
     shutdown_event.set()
 
+# ================== SHARDING & LEADERSHIP (1.6.14) ==================
+# SHARD_WORKERS=N>1 turns this process into the ingestion leader: it owns
+# the polling/webhook connection and routes every update to worker process
+# chat_id % N through a multiprocessing queue. Each worker runs the normal
+# handlers for its shard only. Shared state lives in SQLite (WAL):
+# the registry (REGISTRY_BACKEND=sqlite), the auto-delete queue and the
+# dedup table below. A SQLite lease replaces the old PID lock file.
+SHARD_INDEX: int | None = None  # None — leader / single process
+SHARD_ROUTED: dict[int, int] = {}
+
+
+def shard_of(chat_id: int) -> int:
+    return chat_id % CFG.shard_workers
+
+
+def owns_chat(chat_id: int) -> bool:
+    return SHARD_INDEX is None or shard_of(chat_id) == SHARD_INDEX
+
+
+def _connect_shared_state(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class SharedDedupStore:
+    """Cross-process dedup (welcome / rules) on top of the local ExpiringCache."""
+
+    SQL_CLAIM = (
+        "INSERT INTO dedup (key, ts) VALUES (?, ?) "
+        "ON CONFLICT (key) DO UPDATE SET ts = excluded.ts WHERE dedup.ts <= ?"
+    )
+
+    def __init__(self, path: str):
+        self._conn = _connect_shared_state(path)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS dedup (key TEXT PRIMARY KEY, ts REAL NOT NULL)")
+        self._lock = threading.Lock()
+
+    def claim(self, key: str, ttl: float, now: float) -> bool:
+        # single statement — atomic across processes
+        with self._lock:
+            return self._conn.execute(self.SQL_CLAIM, (key, now, now - ttl)).rowcount > 0
+
+    def purge(self, older_than: float) -> int:
+        with self._lock:
+            return self._conn.execute("DELETE FROM dedup WHERE ts < ?", (older_than,)).rowcount
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+SHARED_DEDUP: SharedDedupStore | None = None
+SHARED_DEDUP_RETENTION_SECONDS = 3600
+
+
+async def dedup_claim(cache: ExpiringCache, key, ttl: float, now: float) -> bool:
+    """True if the caller may act (no recent entry locally or in other shards)."""
+    last = cache.get(key)
+    if last and (now - last) < ttl:
+        return False
+    # claimed locally before the await, so concurrent handlers here see it
+    cache[key] = now
+    if SHARED_DEDUP is not None:
+        # the shared DB write may wait on other shards — keep it off the loop
+        return await asyncio.to_thread(SHARED_DEDUP.claim, f"{cache.name}:{key}", ttl, now)
+    return True
+
+
+class LeaderLease:
+    """
+    Lease row in SQLite: whoever holds an unexpired lease is the leader.
+    The holder renews it every ttl/3; a crashed leader is replaced by a
+    standby once its lease expires, without stale PID files.
+    """
+
+    def __init__(self, path: str, ttl: float, name: str = "leader"):
+        import socket
+        import uuid
+
+        self.path = path
+        self.ttl = ttl
+        self.name = name
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._conn: sqlite3.Connection | None = None
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = _connect_shared_state(self.path)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS leases "
+                "(name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+        return self._conn
+
+    def try_acquire(self) -> tuple[bool, str]:
+        """Acquire or renew. Returns (is_leader, current_owner)."""
+        conn = self._db()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT owner, expires_at FROM leases WHERE name = ?", (self.name,)
+            ).fetchone()
+            if row and row[0] != self.owner and row[1] > now:
+                return False, row[0]
+            conn.execute(
+                "INSERT OR REPLACE INTO leases (name, owner, expires_at) VALUES (?, ?, ?)",
+                (self.name, self.owner, now + self.ttl)
+            )
+            return True, self.owner
+        finally:
+            conn.execute("COMMIT")
+
+    def release(self):
+        if self._conn is None:
+            return
+        self._conn.execute(
+            "DELETE FROM leases WHERE name = ? AND owner = ?", (self.name, self.owner)
+        )
+        self._conn.close()
+        self._conn = None
+
+
+LEADER_LEASE = LeaderLease(CFG.shared_state_db, CFG.lease_ttl_seconds)
+
+
+async def acquire_leadership() -> bool:
+    """Wait in standby until the lease is ours (or shutdown is requested)."""
+    announced = None
+    while not shutdown_event.is_set():
+        try:
+            acquired, owner = await asyncio.to_thread(LEADER_LEASE.try_acquire)
+        except Exception as e:
+            logging.error(f"LEASE | acquire failed | error={e}")
+            acquired, owner = False, None
+        if acquired:
+            logging.info(f"LEASE | leader | owner={LEADER_LEASE.owner}")
+            return True
+        if owner and owner != announced:
+            logging.warning(f"LEASE | standby | leader={owner}")
+            announced = owner
+        try:
+            await asyncio.wait_for(shutdown_event.wait(), LEADER_LEASE.ttl / 3)
+        except asyncio.TimeoutError:
+            pass
+    return False
+
+
+async def lease_heartbeat():
+    # acquire_leadership() renewed the lease right before this task started
+    last_ok = time.monotonic()
+    while not shutdown_event.is_set():
+        await asyncio.sleep(LEADER_LEASE.ttl / 3)
+        attempt = time.monotonic()
+        try:
+            acquired, owner = await asyncio.to_thread(LEADER_LEASE.try_acquire)
+        except Exception as e:
+            if time.monotonic() - last_ok >= LEADER_LEASE.ttl:
+                # a standby may already hold the lease — never run two leaders
+                logging.error(f"LEASE | expired | renew failing | error={e} | shutting down")
+                shutdown_event.set()
+                return
+            # transient DB error — retry next beat, the lease is still valid for a while
+            logging.warning(f"LEASE | renew failed | error={e}")
+            continue
+        if not acquired:
+            logging.error(f"LEASE | lost | leader={owner} | shutting down")
+            shutdown_event.set()
+            return
+        last_ok = attempt
+
+
+def _update_chat_id(update: Update) -> int | None:
+    try:
+        event = update.event
+    except Exception:
+        return None
+    chat = getattr(event, "chat", None) or getattr(getattr(event, "message", None), "chat", None)
+    if chat is not None:
+        return chat.id
+    user = getattr(event, "from_user", None)
+    return user.id if user else None
+
+
+class ShardRouter(BaseMiddleware):
+    """Leader-side outer middleware: forwards the raw update to its shard instead of handling it."""
+
+    def __init__(self, queues: list):
+        self.queues = queues
+
+    async def __call__(self, handler, event: Update, data):
+        chat_id = _update_chat_id(event)
+        shard = shard_of(chat_id) if chat_id is not None else 0
+        self.queues[shard].put_nowait(event.model_dump(mode="json", exclude_none=True))
+        SHARD_ROUTED[shard] = SHARD_ROUTED.get(shard, 0) + 1
+        return None
+
+
+def shard_worker_entry(index: int, updates):
+    """Process entry point for a shard worker (multiprocessing spawn target)."""
+    try:
+        asyncio.run(run_shard_worker(index, updates))
+    except KeyboardInterrupt:
+        pass
+
+
+async def run_shard_worker(index: int, updates):
+    global SHARD_INDEX, SHARED_DEDUP
+
+    SHARD_INDEX = index
+    # Ctrl+C goes to the whole process group — the leader coordinates shutdown
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, _handle_shutdown)
+    except Exception:
+        pass
+
+    SHARED_DEDUP = SharedDedupStore(CFG.shared_state_db)
+    configure_rate_limiter()
+
+    logging.info(f"SHARD | worker started | shard={index}/{CFG.shard_workers} | pid={os.getpid()}")
+    tasks = await start_runtime()
+    if CFG.metrics_port:
+        # leader serves METRICS_PORT, shard i serves METRICS_PORT + 1 + i
+        tasks.append(asyncio.create_task(run_metrics_server(CFG.metrics_port + 1 + index)))
+    inflight: set[asyncio.Task] = set()
+
+    try:
+        while not shutdown_event.is_set():
+            try:
+                raw = await asyncio.to_thread(updates.get, True, 1)
+            except queue.Empty:
+                continue
+            if raw is None:
+                break
+            task = asyncio.create_task(dp.feed_raw_update(bot, raw))
+            inflight.add(task)
+            task.add_done_callback(inflight.discard)
+
+        if inflight:
+            await asyncio.wait(inflight, timeout=10)
+    finally:
+        shutdown_event.set()
+        await stop_runtime(tasks)
+        SHARED_DEDUP.close()
+        await bot.session.close()
+        logging.info(f"SHARD | worker stopped | shard={index}")
+
+
+def _start_shard_worker(ctx, index: int, updates):
+    proc = ctx.Process(
+        target=shard_worker_entry,
+        args=(index, updates),
+        name=f"welcome-shard-{index}",
+        daemon=False,
+    )
+    proc.start()
+    return proc
+
+
+async def supervise_shard_workers(ctx, queues: list, procs: list):
+    while not shutdown_event.is_set():
+        await asyncio.sleep(5)
+        for index, proc in enumerate(procs):
+            if not proc.is_alive() and not shutdown_event.is_set():
+                logging.error(
+                    f"SHARD | worker died | shard={index} | exitcode={proc.exitcode} | restarting"
+                )
+                # pending updates stay in the queue for the replacement
+                procs[index] = _start_shard_worker(ctx, index, queues[index])
+
+
+async def stop_shard_workers(queues: list, procs: list):
+    for updates in queues:
+        updates.put(None)
+    for index, proc in enumerate(procs):
+        await asyncio.to_thread(proc.join, 30)
+        if proc.is_alive():
+            logging.warning(f"SHARD | worker did not stop in time | shard={index} | terminating")
+            proc.terminate()
+    logging.info(f"SHARD | workers stopped | routed={SHARD_ROUTED}")
+
+
+# ================== UPDATE INGESTION (1.6.13) ==================
+POLLING_HEALTHY_SECONDS = 60  # a run this long counts as recovered
+
+
+async def start_polling_with_backoff():
+    backoff = 1
+    while not shutdown_event.is_set():
+        started = time.monotonic()
+        try:
+            logging.info(f"POLLING | starting (backoff={backoff}s)")
+            await bot.delete_webhook(drop_pending_updates=False)
+            await dp.start_polling(bot, handle_signals=False)
+        except Exception as e:
+            logging.error(f"POLLING | crashed | error={e}")
+            if time.monotonic() - started >= POLLING_HEALTHY_SECONDS:
+                backoff = 1
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+        else:
+            break
+
+
+async def run_webhook_server():
+    """
+    Webhook mode: aiohttp server validating X-Telegram-Bot-Api-Secret-Token.
+    Updates are acknowledged immediately and processed in background tasks,
+    so Telegram never waits on handlers. Only the lease holder listens:
+    standby instances behind a load balancer fail its health checks until
+    they take over the lease. setWebhook is only called when WEBHOOK_URL is set.
+    """
+    from aiohttp import web
+    from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        handle_in_background=True,
+        secret_token=CFG.webhook_secret,
+    ).register(app, path=CFG.webhook_path)
+    setup_application(app, dp, bot=bot)
+
+    if CFG.webhook_url:
+        await bot.set_webhook(
+            url=CFG.webhook_url.rstrip("/") + CFG.webhook_path,
+            secret_token=CFG.webhook_secret,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        logging.info(f"WEBHOOK | registered | url={CFG.webhook_url.rstrip('/')}{CFG.webhook_path}")
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host=CFG.webhook_host, port=CFG.webhook_port)
+    await site.start()
+    logging.info(f"WEBHOOK | listening | host={CFG.webhook_host} | port={CFG.webhook_port} | path={CFG.webhook_path}")
+
+    try:
+        await shutdown_event.wait()
+    finally:
+        # webhook stays registered: the standby that takes over the lease
+        # starts listening on the same URL, Telegram retries meanwhile
+        await runner.cleanup()
+
+
+async def start_runtime() -> list[asyncio.Task]:
+    """Load state and start background tasks (single process or shard worker)."""
+    REGISTRY_STORE.load()
+    load_welcome_image_cache()
+    try:
+        await get_bot_id()
+        await prefetch_bot_permissions()
+    except Exception as e:
+        logging.warning(f"STARTUP | bot identity/permissions prefetch failed | error={e}")
+    logging.info(f"REGISTRY | read_only={REGISTRY_READ_ONLY} | backend={CFG.registry_backend}")
+
+    # Persisted deletions from the previous run (overdue ones purged before polling)
+    await restore_autodelete_queue()
+
+    tasks = []
+    # Cleanup tasks enabled in all modes (safe for test-mode)
+    tasks.append(asyncio.create_task(cleanup_bot_messages()))
+    tasks.append(asyncio.create_task(autodelete_store_flusher()))
+    tasks.append(asyncio.create_task(cleanup_caches()))
+    tasks.append(asyncio.create_task(registry_flusher()))
+    tasks.append(asyncio.create_task(registry_compactor()))
+    tasks.append(asyncio.create_task(trace_exporter()))
+    if SHARD_INDEX in (None, 0):
+        # shards share one sqlite file — one scheduler is enough
+        tasks.append(asyncio.create_task(registry_backup_scheduler()))
+    if REGISTRY_LAZY is not None:
+        tasks.append(asyncio.create_task(registry_background_load()))
+    return tasks
+
+
+async def stop_runtime(tasks: list[asyncio.Task]):
+    drainers = list(JOIN_DRAINERS.values())
+    for task in tasks:
+        task.cancel()
+    for task in drainers:
+        task.cancel()
+
+    # no drainer may still be sending or tracing once the stores close
+    await asyncio.gather(*drainers, return_exceptions=True)
+    for task in tasks:
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    dropped = 0
+    for queue in JOIN_QUEUES.values():
+        dropped += len(queue)
+        for job in queue:
+            if job.trace:
+                job.trace.finish("dropped")
+    JOIN_QUEUES.clear()
+    if dropped:
+        logging.warning(f"SHUTDOWN | queued joins dropped | count={dropped}")
+
+    # the exporter is gone: write what it had not picked up yet
+    if TRACE_PENDING:
+        spans = TRACE_PENDING[:]
+        TRACE_PENDING.clear()
+        try:
+            _write_trace_batch(spans)
+        except Exception as e:
+            logging.warning(f"TRACE | export failed | spans={len(spans)} | error={e}")
+
+    # durable flush of buffered journal records before the final snapshot
+    flushed = REGISTRY_STORE.flush()
+    logging.info(f"SHUTDOWN | registry flushed | records={flushed}")
+    REGISTRY_STORE.close()
+    AUTODELETE_STORE.close()
+
+
 async def main():
-    if not acquire_startup_lock():
+    # Signal handling (safe fallback for macOS local run)
+    try:
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, _handle_shutdown)
+        loop.add_signal_handler(signal.SIGINT, _handle_shutdown)
+    except Exception:
+        pass
+
+    if not await acquire_leadership():
         return
-    load_user_registry()
-    logging.info(f"REGISTRY | read_only={REGISTRY_READ_ONLY}")
+
     logging.info(
         f"STARTUP | version={VERSION} "
         f"mute={CFG.mute_new_users} "
         f"delay={CFG.welcome_delay_seconds}s "
-        f"autodelete={CFG.auto_delete_seconds}s"
+        f"autodelete={CFG.auto_delete_seconds}s "
+        f"shards={CFG.shard_workers}"
     )
-    logging.info(f"BUILD | version={VERSION} channel=stable-1.5.x")
+    logging.info(f"BUILD | version={VERSION} channel=stable-1.6.x")
     if not CFG.admin_ids:
         logging.warning("ENV | ADMIN_IDS is empty")
 
     if not CFG.allowed_chat_ids:
         logging.warning("ENV | ALLOWED_CHAT_IDS is empty (bot allowed in all chats)")
-    # Signal handling (safe fallback for macOS local run)
-    try:
-        loop = asyncio.get_running_loop()
-        loop.add_signal_handler(signal.SIGTERM, _handle_shutdown)
-        loop.add_signal_handler(signal.SIGINT, _handle_shutdown)
-    except Exception:
-        pass
     logging.info("RUNTIME | async lifecycle guards enabled")
-    tasks = []
 
-    # Cleanup tasks enabled in all modes (safe for test-mode)
-    tasks.append(asyncio.create_task(cleanup_bot_messages()))
-    tasks.append(asyncio.create_task(cleanup_caches()))
+    sharded = CFG.shard_workers > 1
+    tasks = [asyncio.create_task(lease_heartbeat())]
+    runtime_tasks: list[asyncio.Task] = []
+    queues: list = []
+    procs: list = []
+
+    if sharded:
+        import multiprocessing
+
+        # one-time JSON → sqlite import here, instead of every worker racing it
+        await asyncio.to_thread(REGISTRY_STORE.prepare)
+        ctx = multiprocessing.get_context("spawn")
+        queues = [ctx.Queue() for _ in range(CFG.shard_workers)]
+        procs = [_start_shard_worker(ctx, i, q) for i, q in enumerate(queues)]
+        dp.update.outer_middleware(ShardRouter(queues))
+        tasks.append(asyncio.create_task(supervise_shard_workers(ctx, queues, procs)))
+        logging.info(f"SHARD | leader routing | workers={CFG.shard_workers}")
+    else:
+        runtime_tasks = await start_runtime()
 
-    await asyncio.sleep(1)  # anti-flood startup delay
-    backoff = 1
+    if CFG.metrics_port:
+        tasks.append(asyncio.create_task(run_metrics_server(CFG.metrics_port)))
 
-    async def start_polling_with_backoff():
-        nonlocal backoff
-        while not shutdown_event.is_set():
-            try:
-                logging.info(f"POLLING | starting (backoff={backoff}s)")
-                await dp.start_polling(bot)
-            except Exception as e:
-                logging.error(f"POLLING | crashed | error={e}")
-                await asyncio.sleep(backoff)
-                backoff = min(backoff * 2, 30)
-            else:
-                break
+    await asyncio.sleep(1)  # anti-flood startup delay
 
-    polling = asyncio.create_task(start_polling_with_backoff())
-    tasks.append(polling)
+    if CFG.update_mode == "webhook":
+        tasks.append(asyncio.create_task(run_webhook_server()))
+    else:
+        tasks.append(asyncio.create_task(start_polling_with_backoff()))
 
     try:
         await shutdown_event.wait()
@@ -1954,19 +6225,21 @@ async def main():
     finally:
         for task in tasks:
             task.cancel()
-
         for task in tasks:
             try:
                 await task
             except asyncio.CancelledError:
                 pass
 
-    save_user_registry()
+    if sharded:
+        await stop_shard_workers(queues, procs)
+    else:
+        await stop_runtime(runtime_tasks)
+
     try:
-        if os.path.exists(LOCK_FILE):
-            os.remove(LOCK_FILE)
-    except Exception:
-        pass
+        LEADER_LEASE.release()
+    except Exception as e:
+        logging.warning(f"LEASE | release failed | error={e}")
 
     logging.info("SHUTDOWN | all tasks stopped cleanly")
 
@@ -1977,8 +6250,3 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         logging.info("SHUTDOWN | KeyboardInterrupt received (Ctrl+C)")
         shutdown_event.set()
-        try:
-            if os.path.exists(LOCK_FILE):
-                os.remove(LOCK_FILE)
-        except Exception:
-            pass
\ No newline at end of file
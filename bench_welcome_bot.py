@@ -0,0 +1,518 @@
+"""
+Welcome Bot — load benchmark (v1.6.18)
+
+Feeds synthetic updates into dp.feed_update() with a stubbed Bot API
+session and reports throughput, handler latency percentiles, memory and
+auto-delete scheduler cost. Output is JSON so runs can be compared:
+
+    python bench_welcome_bot.py --output bench.json
+    python bench_welcome_bot.py --compare bench.json
+    python bench_welcome_bot.py --quick --scenarios joins,cleanup
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# The bot reads its config at import time — isolate it before importing.
+CALLER_DIR = os.getcwd()
+WORK_DIR = tempfile.mkdtemp(prefix="welcome_bench_")
+os.environ.update({
+    "BOT_TOKEN": "123456:BENCHMARK",
+    "ADMIN_IDS": "1",
+    "ALLOWED_CHAT_IDS": "",
+    "WELCOME_DELAY_SECONDS": "0",
+    "AUTODELETE_PERSIST": "false",
+    "TRACE_FILE": "",
+    "METRICS_PORT": "0",
+    "RATE_LIMIT_GLOBAL_PER_SECOND": "1000000000",
+    "RATE_LIMIT_GROUP_PER_MINUTE": "1000000000",
+})
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(WORK_DIR)
+
+import Welcome_Bot as W  # noqa: E402
+from aiogram.client.session.base import BaseSession  # noqa: E402
+from aiogram.types import ChatMemberAdministrator, Message, Update, User  # noqa: E402
+
+SCENARIOS = ("joins", "approvals", "callbacks", "text", "cleanup", "registry")
+_ids = itertools.count(1_000_000)
+
+
+# ================== STUB BOT API ==================
+class StubSession(BaseSession):
+    """Answers every Bot API method locally, optionally after a fixed latency."""
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls: dict[str, int] = {}
+        self.deleted = 0
+        self._me = User(id=123456, is_bot=True, first_name="bench", username="bench_bot")
+        self._admin = ChatMemberAdministrator.model_construct(
+            status="administrator",
+            user=self._me,
+            can_delete_messages=True,
+            can_restrict_members=True,
+        )
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, *args, **kwargs):
+        if False:
+            yield b""
+
+    async def make_request(self, bot, method, timeout=None):
+        name = method.__api_method__
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if name == "deleteMessages":
+            self.deleted += len(method.message_ids)
+        elif name == "deleteMessage":
+            self.deleted += 1
+        if name == "getMe":
+            return self._me
+        if name == "getChatMember":
+            return self._admin
+        if name.startswith("send"):
+            return Message.model_construct(message_id=next(_ids), date=int(time.time()), chat=None)
+        return True
+
+
+# ================== UPDATE GENERATORS ==================
+def _chat(chat_id: int) -> dict:
+    return {"id": chat_id, "type": "supergroup", "title": f"bench {chat_id}"}
+
+
+def _user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "language_code": "en"}
+
+
+def join_update(chat_id: int, user_id: int) -> Update:
+    return Update.model_validate({
+        "update_id": next(_ids),
+        "message": {
+            "message_id": next(_ids),
+            "date": int(time.time()),
+            "chat": _chat(chat_id),
+            "from": _user(user_id),
+            "new_chat_members": [_user(user_id)],
+        },
+    })
+
+
+def approval_update(chat_id: int, user_id: int) -> Update:
+    return Update.model_validate({
+        "update_id": next(_ids),
+        "chat_member": {
+            "chat": _chat(chat_id),
+            "from": _user(user_id),
+            "date": int(time.time()),
+            "old_chat_member": {"status": "left", "user": _user(user_id)},
+            "new_chat_member": {"status": "member", "user": _user(user_id)},
+        },
+    })
+
+
+def callback_update(chat_id: int, user_id: int, data: str) -> Update:
+    return Update.model_validate({
+        "update_id": next(_ids),
+        "callback_query": {
+            "id": str(next(_ids)),
+            "from": _user(user_id),
+            "chat_instance": "bench",
+            "data": data,
+            "message": {
+                "message_id": next(_ids),
+                "date": int(time.time()),
+                "chat": _chat(chat_id),
+                "text": "welcome",
+            },
+        },
+    })
+
+
+TEXT_SAMPLES = (
+    "где хранилище с материалами?",
+    "подскажите, как обновить macOS до последней версии",
+    "storage link please",
+    "у меня не ставится драйвер на Windows 11, что делать",
+    "а хранилища проекта ещё доступны?",
+    "спасибо всем за помощь!",
+)
+
+
+def text_update(chat_id: int, user_id: int, text: str) -> Update:
+    return Update.model_validate({
+        "update_id": next(_ids),
+        "message": {
+            "message_id": next(_ids),
+            "date": int(time.time()),
+            "chat": _chat(chat_id),
+            "from": _user(user_id),
+            "text": text,
+        },
+    })
+
+
+# ================== MEASUREMENT ==================
+def _percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(int(round(pct / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def _latency_summary(samples: list[float]) -> dict:
+    return {
+        "p50_ms": round(_percentile(samples, 50) * 1000, 4),
+        "p99_ms": round(_percentile(samples, 99) * 1000, 4),
+        "max_ms": round(max(samples) * 1000, 4) if samples else 0.0,
+        "mean_ms": round(statistics.fmean(samples) * 1000, 4) if samples else 0.0,
+    }
+
+
+async def _drain_join_pipeline():
+    while W.JOIN_DRAINERS:
+        await asyncio.gather(*list(W.JOIN_DRAINERS.values()), return_exceptions=True)
+
+
+def _reset_autodelete():
+    W.BOT_MESSAGES.clear()
+    W.BOT_MESSAGES_HEAP.clear()
+    W.BOT_MESSAGES_TYPES.clear()
+
+
+async def _feed_all(updates: list[Update], concurrency: int) -> tuple[float, list[float]]:
+    """Feed updates with bounded concurrency; returns (wall seconds, per-update latencies)."""
+    latencies: list[float] = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def feed(update: Update):
+        async with semaphore:
+            started = time.perf_counter()
+            await W.dp.feed_update(W.bot, update)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(feed(u) for u in updates))
+    await _drain_join_pipeline()
+    return time.perf_counter() - started, latencies
+
+
+async def _run_measured(name: str, coro_factory, trace_memory: bool) -> dict:
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        result = await coro_factory()
+    finally:
+        if trace_memory:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            result["tracemalloc_peak_kb"] = round(peak / 1024, 1)
+    result["maxrss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    logging.warning(f"BENCH | {name} | done")
+    return result
+
+
+# ================== SCENARIOS ==================
+async def bench_joins(args, session: StubSession) -> dict:
+    updates = [
+        join_update(-1000 - (i % args.chats), 10_000_000 + i)
+        for i in range(args.joins)
+    ]
+    before = dict(session.calls)
+    wall, latencies = await _feed_all(updates, args.concurrency)
+    _reset_autodelete()
+    return {
+        "joins": len(updates),
+        "chats": args.chats,
+        "wall_s": round(wall, 4),
+        "joins_per_sec": round(len(updates) / wall, 1),
+        "handler_latency": _latency_summary(latencies),
+        "api_calls": {k: v - before.get(k, 0) for k, v in session.calls.items() if v != before.get(k, 0)},
+    }
+
+
+async def bench_approvals(args, session: StubSession) -> dict:
+    updates = [
+        approval_update(-2000 - (i % args.chats), 20_000_000 + i)
+        for i in range(args.joins)
+    ]
+    wall, latencies = await _feed_all(updates, args.concurrency)
+    _reset_autodelete()
+    return {
+        "approvals": len(updates),
+        "wall_s": round(wall, 4),
+        "approvals_per_sec": round(len(updates) / wall, 1),
+        "handler_latency": _latency_summary(latencies),
+    }
+
+
+async def bench_callbacks(args, session: StubSession) -> dict:
+    updates = [
+        callback_update(-3000 - (i % args.chats), 30_000_000 + i, "rules:en" if i % 2 else "about:ru")
+        for i in range(args.messages)
+    ]
+    wall, latencies = await _feed_all(updates, args.concurrency)
+    _reset_autodelete()
+    return {
+        "callbacks": len(updates),
+        "wall_s": round(wall, 4),
+        "callbacks_per_sec": round(len(updates) / wall, 1),
+        "handler_latency": _latency_summary(latencies),
+    }
+
+
+async def bench_text(args, session: StubSession) -> dict:
+    updates = [
+        text_update(-4000 - (i % args.chats), 40_000_000 + i, TEXT_SAMPLES[i % len(TEXT_SAMPLES)])
+        for i in range(args.messages)
+    ]
+    wall, latencies = await _feed_all(updates, args.concurrency)
+    _reset_autodelete()
+    return {
+        "messages": len(updates),
+        "wall_s": round(wall, 4),
+        "messages_per_sec": round(len(updates) / wall, 1),
+        "handler_latency": _latency_summary(latencies),
+    }
+
+
+async def bench_cleanup(args, session: StubSession) -> dict:
+    results = {}
+    for size in args.cleanup_sizes:
+        _reset_autodelete()
+        chats = max(args.chats, 1)
+        now = time.time()
+
+        started = time.perf_counter()
+        for i in range(size):
+            # all due within the lookahead window, spread over chats
+            W._schedule_deadline(-5000 - (i % chats), i + 1, "welcome", now - (size - i) * 1e-6)
+        schedule_s = time.perf_counter() - started
+
+        before = session.calls.get("deleteMessages", 0) + session.calls.get("deleteMessage", 0)
+        deleted_before = session.deleted
+        W.shutdown_event.clear()
+        task = asyncio.create_task(W.cleanup_bot_messages())
+        started = time.perf_counter()
+        # BOT_MESSAGES empties before the deletes go out; wait for the API side
+        while session.deleted - deleted_before < size:
+            await asyncio.sleep(0)
+        drain_s = time.perf_counter() - started
+        W.shutdown_event.set()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        after = session.calls.get("deleteMessages", 0) + session.calls.get("deleteMessage", 0)
+
+        results[str(size)] = {
+            "schedule_s": round(schedule_s, 4),
+            "schedule_us_per_msg": round(schedule_s / size * 1e6, 3),
+            "drain_s": round(drain_s, 4),
+            "drain_us_per_msg": round(drain_s / size * 1e6, 3),
+            "delete_api_calls": after - before,
+        }
+    _reset_autodelete()
+    return results
+
+
+def _registry_records(n: int):
+    sources = (W.JoinSource.TELEGRAM, W.JoinSource.INVITE_LINK, W.JoinSource.REQUEST, W.JoinSource.PAID)
+    now = time.time()
+    for i in range(n):
+        # per-record string copies, as json.load produces them
+        yield 5_000_000_000 + i * 7, {
+            "source": (sources[i % len(sources)] + " ")[:-1],
+            "labels": {"paid_member"} if i % 20 == 0 else set(),
+            "first_seen": now - i,
+            "chat_id": -1_000_000_000_000 - (i % 20),
+        }
+
+
+def _measure_registry(factory, n: int) -> tuple[object, int]:
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    registry = factory()
+    for uid, item in _registry_records(n):
+        registry[uid] = item
+    used = tracemalloc.get_traced_memory()[0] - before
+    if started_tracing:
+        tracemalloc.stop()
+    return registry, used
+
+
+def _time_lookups(registry, n: int) -> dict:
+    uids = [5_000_000_000 + (i * 7919 % n) * 7 for i in range(min(n, 100_000))]
+    if isinstance(registry, W.CompactRegistry):
+        has_label = registry.has_label
+    else:
+        def has_label(uid, label):
+            item = registry.get(uid)
+            return bool(item) and label in item["labels"]
+
+    started = time.perf_counter()
+    for uid in uids:
+        has_label(uid, "paid_member")
+    label_s = time.perf_counter() - started
+    started = time.perf_counter()
+    for uid in uids:
+        registry.get(uid)
+    get_s = time.perf_counter() - started
+    return {
+        "has_label_ns": round(label_s / len(uids) * 1e9, 1),
+        "get_ns": round(get_s / len(uids) * 1e9, 1),
+    }
+
+
+async def bench_registry(args, session: StubSession) -> dict:
+    """Heap cost of the dict registry vs CompactRegistry (REGISTRY_BACKEND=compact)."""
+    results = {}
+    for name, factory in (("dict", dict), ("compact", W.CompactRegistry)):
+        registry, used = _measure_registry(factory, args.registry_users)
+        results[name] = {
+            "bytes_per_user": round(used / args.registry_users, 1),
+            "total_mb": round(used / 1024 / 1024, 1),
+            **_time_lookups(registry, args.registry_users),
+        }
+        del registry
+    results["users"] = args.registry_users
+    results["reduction_x"] = round(results["dict"]["bytes_per_user"] / results["compact"]["bytes_per_user"], 2)
+    return results
+
+
+BENCHES = {
+    "joins": bench_joins,
+    "approvals": bench_approvals,
+    "callbacks": bench_callbacks,
+    "text": bench_text,
+    "cleanup": bench_cleanup,
+    "registry": bench_registry,
+}
+
+
+# ================== REPORTING ==================
+def _flatten(data, prefix: str = "") -> dict[str, float]:
+    flat = {}
+    for key, value in data.items():
+        path = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            flat.update(_flatten(value, path))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[path] = value
+    return flat
+
+
+def compare(current: dict, baseline: dict) -> list[str]:
+    now = _flatten(current["results"])
+    before = _flatten(baseline.get("results", {}))
+    lines = [f"baseline {baseline.get('version')} → current {current['version']}"]
+    for key in sorted(now.keys() & before.keys()):
+        if not before[key]:
+            continue
+        change = (now[key] - before[key]) / before[key] * 100
+        lines.append(f"{key:<55} {before[key]:>14} → {now[key]:>14}  ({change:+.1f}%)")
+    return lines
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Welcome Bot load benchmark")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"comma-separated subset of: {', '.join(SCENARIOS)}")
+    parser.add_argument("--joins", type=int, default=5_000, help="joins/approvals per scenario")
+    parser.add_argument("--messages", type=int, default=20_000, help="text messages / callbacks")
+    parser.add_argument("--chats", type=int, default=20, help="distinct chats to spread load over")
+    parser.add_argument("--concurrency", type=int, default=256, help="updates in flight")
+    parser.add_argument("--api-latency-ms", type=float, default=0.0, help="simulated Bot API latency")
+    parser.add_argument("--cleanup-sizes", default="10000,100000,1000000",
+                        help="pending auto-delete queue sizes")
+    parser.add_argument("--registry-users", type=int, default=1_000_000,
+                        help="registry size for the memory comparison")
+    parser.add_argument("--tracemalloc", action="store_true", help="record Python heap peak per scenario")
+    parser.add_argument("--quick", action="store_true", help="10x smaller run for smoke checks")
+    parser.add_argument("--output", help="write JSON results to this file")
+    parser.add_argument("--compare", help="baseline JSON to diff against")
+    args = parser.parse_args(argv)
+
+    args.scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    args.cleanup_sizes = [int(s) for s in args.cleanup_sizes.split(",") if s.strip()]
+    if args.quick:
+        args.joins = max(args.joins // 10, 1)
+        args.messages = max(args.messages // 10, 1)
+        args.cleanup_sizes = [max(s // 10, 1) for s in args.cleanup_sizes]
+        args.registry_users = max(args.registry_users // 10, 1)
+    return args
+
+
+async def run(args) -> dict:
+    session = StubSession(latency=args.api_latency_ms / 1000)
+    # same request middlewares as the real session (limiter, then metrics)
+    for middleware in (W.BOT_API_LIMITER, W.ApiMetricsMiddleware()):
+        session.middleware(middleware)
+    W.bot.session = session
+    W.REGISTRY_STORE.load()
+
+    results = {}
+    for name in args.scenarios:
+        results[name] = await _run_measured(name, lambda: BENCHES[name](args, session), args.tracemalloc)
+
+    W.REGISTRY_STORE.close()
+    return {
+        "version": W.VERSION,
+        "timestamp": int(time.time()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "registry_backend": W.CFG.registry_backend,
+        "params": {
+            "joins": args.joins,
+            "messages": args.messages,
+            "chats": args.chats,
+            "concurrency": args.concurrency,
+            "api_latency_ms": args.api_latency_ms,
+            "cleanup_sizes": args.cleanup_sizes,
+            "registry_users": args.registry_users,
+        },
+        "results": results,
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # handler logging would dominate the numbers
+    logging.getLogger().setLevel(logging.WARNING)
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output if os.path.isabs(args.output) else os.path.join(CALLER_DIR, args.output),
+                  "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        path = args.compare if os.path.isabs(args.compare) else os.path.join(CALLER_DIR, args.compare)
+        with open(path, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        print("\n".join(compare(report, baseline)), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,385 @@
+"""
+Welcome Bot — local fake Telegram Bot API server (v1.6.18)
+
+Stand-in for api.telegram.org for offline load and fault testing. Point the
+bot at it with TELEGRAM_API_URL:
+
+    python fake_telegram_api.py --port 8081 --join-rate 50 --chats 20
+    TELEGRAM_API_URL=http://127.0.0.1:8081 BOT_TOKEN=123456:FAKE python Welcome_Bot.py
+
+Implements getUpdates (long polling over a synthetic update feed), getMe,
+getChatMember, sendMessage, sendPhoto, deleteMessage, deleteMessages and
+restrictChatMember; other methods answer ok=true. Latency, 429 RetryAfter
+and 5xx errors are injected from a seeded RNG so runs are reproducible.
+
+Control endpoints:
+    POST /_inject   raw Update JSON (object or list) → queued for getUpdates
+    GET  /_stats    per-method calls, injected faults, feed position
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import random
+import time
+from collections import deque
+
+from aiohttp import web
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s")
+
+FEED_LIMIT = 100_000          # buffered, not yet confirmed updates
+NO_FAULT_METHODS = {"getMe", "getUpdates", "deleteWebhook", "setWebhook", "getWebhookInfo"}
+
+TEXT_SAMPLES = (
+    "где хранилище с материалами?",
+    "подскажите, как обновить macOS до последней версии",
+    "у меня не ставится драйвер на Windows 11, что делать",
+    "спасибо всем за помощь!",
+)
+
+
+# ================== STATE ==================
+class FakeTelegram:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.user_ids = itertools.count(10_000_000)
+        self.updates: deque[dict] = deque()
+        self.updates_ready = asyncio.Event()
+        self.updates_pushed = 0
+        self.messages: dict[int, set[int]] = {}
+        self.calls: dict[str, int] = {}
+        self.faults = {"retry_after": 0, "server_error": 0}
+        self.restricted = 0
+        self.deleted = 0
+        self.started = time.monotonic()
+        self.chats = [-(1_000_000_000_000 + i) for i in range(max(args.chats, 1))]
+
+    # ---------- update feed ----------
+    def push_update(self, update: dict):
+        update["update_id"] = next(self.update_ids)
+        self.updates_pushed += 1
+        self.updates.append(update)
+        if len(self.updates) > FEED_LIMIT:
+            # nobody is polling — behave like Telegram and drop the oldest
+            self.updates.popleft()
+        self.updates_ready.set()
+
+    def _user(self, user_id: int) -> dict:
+        return {
+            "id": user_id,
+            "is_bot": False,
+            "first_name": f"user{user_id}",
+            "language_code": self.rng.choice(("ru", "en")),
+        }
+
+    def _chat(self, chat_id: int) -> dict:
+        return {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private", "title": f"fake {chat_id}"}
+
+    def synthetic_join(self) -> dict:
+        user = self._user(next(self.user_ids))
+        return {"message": {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": self._chat(self.rng.choice(self.chats)),
+            "from": user,
+            "new_chat_members": [user],
+        }}
+
+    def synthetic_text(self) -> dict:
+        return {"message": {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": self._chat(self.rng.choice(self.chats)),
+            "from": self._user(self.rng.randrange(10_000_000, 10_000_000 + 1000)),
+            "text": self.rng.choice(TEXT_SAMPLES),
+        }}
+
+    async def generate(self, rate: float, factory):
+        """Push `rate` updates per second until --duration runs out."""
+        interval = 1 / rate
+        deadline = self.started + self.args.duration if self.args.duration else None
+        next_at = time.monotonic()
+        while deadline is None or time.monotonic() < deadline:
+            now = time.monotonic()
+            while next_at <= now:
+                self.push_update(factory())
+                next_at += interval
+            await asyncio.sleep(max(next_at - time.monotonic(), 0.001))
+
+    # ---------- faults ----------
+    def fault_for(self, method: str) -> web.Response | None:
+        if method in NO_FAULT_METHODS:
+            return None
+        if self.args.fault_methods and method not in self.args.fault_methods:
+            return None
+        roll = self.rng.random()
+        if roll < self.args.retry_after_rate:
+            self.faults["retry_after"] += 1
+            retry_after = self.args.retry_after
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {retry_after}",
+                "parameters": {"retry_after": retry_after},
+            }, status=429)
+        if roll < self.args.retry_after_rate + self.args.error_rate:
+            self.faults["server_error"] += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 500,
+                "description": "Internal Server Error",
+            }, status=500)
+        return None
+
+    def latency(self) -> float:
+        delay = self.args.latency_ms
+        if self.args.jitter_ms:
+            delay += self.rng.uniform(0, self.args.jitter_ms)
+        return delay / 1000
+
+    # ---------- methods ----------
+    def _sent_message(self, chat_id: int, **extra) -> dict:
+        message_id = next(self.message_ids)
+        self.messages.setdefault(chat_id, set()).add(message_id)
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": self._chat(chat_id),
+            "from": self.me,
+            **extra,
+        }
+
+    @property
+    def me(self) -> dict:
+        return {
+            "id": self.args.bot_id,
+            "is_bot": True,
+            "first_name": "Fake Welcome Bot",
+            "username": "fake_welcome_bot",
+        }
+
+    async def get_updates(self, params: dict):
+        offset = int(params.get("offset", 0) or 0)
+        limit = min(int(params.get("limit", 100) or 100), 100)
+        timeout = float(params.get("timeout", 0) or 0)
+
+        # confirmed updates are forgotten, as on Telegram
+        while self.updates and self.updates[0]["update_id"] < offset:
+            self.updates.popleft()
+        if not self.updates and timeout:
+            self.updates_ready.clear()
+            try:
+                await asyncio.wait_for(self.updates_ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return list(itertools.islice(self.updates, limit))
+
+    def get_chat_member(self, params: dict) -> dict:
+        user_id = int(params["user_id"])
+        if user_id == self.args.bot_id:
+            return {
+                "status": "administrator",
+                "user": self.me,
+                "can_be_edited": False,
+                "is_anonymous": False,
+                "can_manage_chat": True,
+                "can_delete_messages": True,
+                "can_manage_video_chats": False,
+                "can_restrict_members": True,
+                "can_promote_members": False,
+                "can_change_info": False,
+                "can_invite_users": True,
+                "can_post_stories": False,
+                "can_edit_stories": False,
+                "can_delete_stories": False,
+                "can_send_welcome_messages": False,
+            }
+        return {"status": "member", "user": self._user(user_id)}
+
+    def delete_messages(self, chat_id: int, message_ids: list[int]):
+        known = self.messages.get(chat_id, set())
+        found = [message_id for message_id in message_ids if message_id in known]
+        known.difference_update(found)
+        self.deleted += len(found)
+        return found
+
+    async def dispatch(self, method: str, params: dict):
+        if method == "getUpdates":
+            return await self.get_updates(params)
+        if method == "getMe":
+            return self.me
+        if method == "getChatMember":
+            return self.get_chat_member(params)
+        if method == "getWebhookInfo":
+            return {"url": "", "has_custom_certificate": False, "pending_update_count": len(self.updates)}
+        if method == "sendPhoto":
+            photo = params.get("photo")
+            if isinstance(photo, str) and not photo.startswith("attach://"):
+                file_id = photo
+            else:
+                file_id = f"fake-photo-{next(self.message_ids)}"
+            return self._sent_message(
+                int(params["chat_id"]),
+                caption=params.get("caption"),
+                photo=[{"file_id": file_id, "file_unique_id": file_id[-16:], "width": 1280, "height": 720}],
+            )
+        if method == "sendDocument":
+            return self._sent_message(
+                int(params["chat_id"]),
+                document={"file_id": f"fake-doc-{next(self.message_ids)}", "file_unique_id": "doc"},
+            )
+        if method.startswith(("send", "copy", "forward")) or method == "editMessageText":
+            return self._sent_message(int(params["chat_id"]), text=params.get("text", ""))
+        if method == "deleteMessage":
+            if not self.delete_messages(int(params["chat_id"]), [int(params["message_id"])]):
+                raise LookupError("Bad Request: message to delete not found")
+            return True
+        if method == "deleteMessages":
+            # like Telegram, missing ids are skipped silently
+            self.delete_messages(int(params["chat_id"]), [int(i) for i in params["message_ids"]])
+            return True
+        if method == "restrictChatMember":
+            self.restricted += 1
+            return True
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "uptime_s": round(time.monotonic() - self.started, 1),
+            "calls": dict(sorted(self.calls.items())),
+            "faults": self.faults,
+            "updates_pushed": self.updates_pushed,
+            "updates_buffered": len(self.updates),
+            "messages_alive": sum(len(ids) for ids in self.messages.values()),
+            "messages_deleted": self.deleted,
+            "restricted": self.restricted,
+        }
+
+
+# ================== HTTP ==================
+async def _read_params(request: web.Request) -> dict:
+    if request.content_type == "application/json":
+        return await request.json()
+    raw = dict(request.query)
+    if request.can_read_body:
+        # aiogram sends form-data; nested values are JSON-encoded strings
+        for key, value in (await request.post()).items():
+            raw[key] = value if isinstance(value, web.FileField) else str(value)
+    params = {}
+    for key, value in raw.items():
+        if isinstance(value, str) and value[:1] in ("[", "{"):
+            try:
+                value = json.loads(value)
+            except ValueError:
+                pass
+        params[key] = value
+    return params
+
+
+def build_app(state: FakeTelegram) -> web.Application:
+    async def api_handler(request: web.Request):
+        method = request.match_info["method"]
+        state.calls[method] = state.calls.get(method, 0) + 1
+        params = await _read_params(request)
+
+        delay = state.latency()
+        if delay and method != "getUpdates":
+            await asyncio.sleep(delay)
+        fault = state.fault_for(method)
+        if fault is not None:
+            return fault
+
+        try:
+            result = await state.dispatch(method, params)
+        except LookupError as e:
+            return web.json_response({"ok": False, "error_code": 400, "description": str(e.args[0])}, status=400)
+        except (KeyError, ValueError) as e:
+            return web.json_response(
+                {"ok": False, "error_code": 400, "description": f"Bad Request: {e}"}, status=400
+            )
+        return web.json_response({"ok": True, "result": result})
+
+    async def inject_handler(request: web.Request):
+        payload = await request.json()
+        updates = payload if isinstance(payload, list) else [payload]
+        for update in updates:
+            state.push_update(update)
+        return web.json_response({"ok": True, "queued": len(updates)})
+
+    async def stats_handler(request: web.Request):
+        return web.json_response(state.stats())
+
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_route("*", "/bot{token}/{method}", api_handler)
+    app.router.add_post("/_inject", inject_handler)
+    app.router.add_get("/_stats", stats_handler)
+    return app
+
+
+async def serve(args):
+    state = FakeTelegram(args)
+    runner = web.AppRunner(build_app(state), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host=args.host, port=args.port).start()
+    logging.info(
+        f"FAKE_API | listening | url=http://{args.host}:{args.port} | seed={args.seed} | "
+        f"latency_ms={args.latency_ms}+{args.jitter_ms} | retry_after_rate={args.retry_after_rate} | "
+        f"error_rate={args.error_rate}"
+    )
+
+    tasks = []
+    if args.join_rate:
+        tasks.append(asyncio.create_task(state.generate(args.join_rate, state.synthetic_join)))
+    if args.text_rate:
+        tasks.append(asyncio.create_task(state.generate(args.text_rate, state.synthetic_text)))
+    try:
+        while True:
+            await asyncio.sleep(args.stats_interval)
+            logging.info(f"FAKE_API | stats | {json.dumps(state.stats(), ensure_ascii=False)}")
+    finally:
+        for task in tasks:
+            task.cancel()
+        logging.info(f"FAKE_API | final | {json.dumps(state.stats(), ensure_ascii=False)}")
+        await runner.cleanup()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Fake Telegram Bot API server for Welcome Bot load tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--bot-id", type=int, default=123456, help="id returned by getMe (token prefix)")
+    parser.add_argument("--seed", type=int, default=1, help="RNG seed for faults and synthetic updates")
+    parser.add_argument("--chats", type=int, default=20, help="group chats for synthetic updates")
+    parser.add_argument("--join-rate", type=float, default=0.0, help="synthetic joins per second")
+    parser.add_argument("--text-rate", type=float, default=0.0, help="synthetic text messages per second")
+    parser.add_argument("--duration", type=float, default=0.0, help="stop generating after N seconds (0 = never)")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="fixed latency per API call")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="extra uniform random latency")
+    parser.add_argument("--retry-after-rate", type=float, default=0.0, help="share of calls answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after seconds in 429 answers")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of calls answered with 500")
+    parser.add_argument("--fault-methods", default="",
+                        help="comma-separated methods eligible for faults (default: all but getMe/getUpdates)")
+    parser.add_argument("--stats-interval", type=float, default=10.0, help="seconds between stats log lines")
+    args = parser.parse_args(argv)
+    args.fault_methods = {m.strip() for m in args.fault_methods.split(",") if m.strip()}
+    if args.retry_after_rate + args.error_rate > 1:
+        parser.error("--retry-after-rate + --error-rate must not exceed 1")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()